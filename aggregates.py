@@ -0,0 +1,161 @@
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+# Risoluzioni di default: nome -> (durata del bucket in secondi, bucket conservati in memoria)
+DEFAULT_RESOLUTIONS = {
+    "1m": (60, 360),    # ultime 6 ore
+    "1h": (3600, 168),  # ultimi 7 giorni
+}
+
+
+class InvalidResolution(ValueError):
+    pass
+
+
+class _Series:
+    __slots__ = ("open", "closed", "dirty")
+
+    def __init__(self):
+        self.open = {}              # inizio bucket (ns) -> [count, sum, min, max]
+        self.closed = OrderedDict()  # bucket chiusi, per le query
+        self.dirty = set()          # bucket chiusi che hanno ricevuto campioni in ritardo
+
+
+class PressureAggregator:
+    """Aggregati per dispositivo (count/min/max/media) su finestre da 1 minuto e 1 ora.
+
+    Ogni campione aggiorna in O(1) il bucket aperto di ogni risoluzione. flush()
+    chiude i bucket terminati da almeno `grace` secondi e li restituisce come
+    record line protocol (misure pressure_1m, pressure_1h), che i grafici su
+    intervalli lunghi leggono al posto dei dati grezzi. I bucket chiusi restano in
+    memoria per `retention` bucket e servono le query recenti senza InfluxDB.
+    Un campione in ritardo per un bucket già chiuso lo aggiorna e lo fa
+    riscrivere al flush successivo (stesso timestamp, InfluxDB sovrascrive il punto).
+    """
+
+    def __init__(self, resolutions=None, grace=5.0, measurement="pressure"):
+        self.resolutions = {
+            name: (int(width * 1e9), retention)
+            for name, (width, retention) in (resolutions or DEFAULT_RESOLUTIONS).items()
+        }
+        self.grace_ns = int(grace * 1e9)
+        self.measurement = measurement
+        self._series = {}  # (device_id, risoluzione) -> _Series
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"samples": 0, "late": 0, "expired": 0, "flushed": 0}
+
+    def add(self, device_id, value, timestamp):
+        """Aggiunge un campione (timestamp in ns) a tutte le risoluzioni."""
+        with self._lock:
+            self.stats["samples"] += 1
+            for name, (width, _) in self.resolutions.items():
+                series = self._series.get((device_id, name))
+                if series is None:
+                    series = self._series[(device_id, name)] = _Series()
+                start = timestamp - timestamp % width
+                bucket = series.closed.get(start)
+                if bucket is not None:
+                    series.dirty.add(start)
+                    self.stats["late"] += 1
+                else:
+                    bucket = series.open.get(start)
+                    if bucket is None:
+                        series.open[start] = [1, value, value, value]
+                        continue
+                bucket[0] += 1
+                bucket[1] += value
+                if value < bucket[2]:
+                    bucket[2] = value
+                if value > bucket[3]:
+                    bucket[3] = value
+
+    def _record(self, device_id, name, start, bucket):
+        count, total, low, high = bucket
+        return (f"{self.measurement}_{name},device={device_id} "
+                f"count={count}i,mean={total / count},min={float(low)},max={float(high)} {start}")
+
+    def flush(self, now):
+        """Chiude i bucket terminati prima di `now` (ns) e restituisce i record da scrivere."""
+        records = []
+        with self._lock:
+            for (device_id, name), series in self._series.items():
+                width, retention = self.resolutions[name]
+                cutoff = now - width * retention
+                for start in sorted(series.open):
+                    if start + width + self.grace_ns > now:
+                        continue
+                    bucket = series.open.pop(start)
+                    # Campioni più vecchi della retention: il bucket su InfluxDB è già stato
+                    # scritto completo e non va sovrascritto con un aggregato parziale
+                    if start < cutoff:
+                        self.stats["expired"] += bucket[0]
+                        continue
+                    series.closed[start] = bucket
+                    records.append(self._record(device_id, name, start, bucket))
+                for start in series.dirty:
+                    records.append(self._record(device_id, name, start, series.closed[start]))
+                series.dirty.clear()
+
+                while series.closed and next(iter(series.closed)) < cutoff:
+                    series.closed.popitem(last=False)
+            self.stats["flushed"] += len(records)
+        return records
+
+    def query(self, device_id, resolution, since=None, until=None):
+        """Bucket di un dispositivo tra since e until (ns), compreso quello ancora aperto (partial)."""
+        if resolution not in self.resolutions:
+            raise InvalidResolution(f"resolution must be one of {', '.join(self.resolutions)}")
+        with self._lock:
+            series = self._series.get((device_id, resolution))
+            if series is None:
+                return []
+            buckets = [(start, list(b), False) for start, b in series.closed.items()]
+            buckets += [(start, list(b), True) for start, b in series.open.items()]
+        result = []
+        for start, (count, total, low, high), partial in sorted(buckets):
+            if (since is not None and start < since) or (until is not None and start > until):
+                continue
+            result.append({
+                "start_ms": start // 1_000_000,
+                "count": count,
+                "mean": total / count,
+                "min": low,
+                "max": high,
+                "partial": partial,
+            })
+        return result
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["series"] = len(self._series)
+        return stats
+
+    # ----- Thread di flush ----- #
+    def start(self, on_flush, interval=10.0, clock=None):
+        """Chiama periodicamente on_flush(records) con i bucket chiusi."""
+        clock = clock or time.time_ns
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    records = self.flush(clock())
+                    if records:
+                        on_flush(records)
+                except Exception as e:
+                    log.error("aggregate flush failed", extra={"error": str(e)})
+
+        self._thread = threading.Thread(target=run, name="pressure-aggregates", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
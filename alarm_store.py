@@ -0,0 +1,202 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+# Dimensione massima di una pagina di GET /alarms
+MAX_PAGE_SIZE = 500
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+class AlarmStore:
+    """Archivio in memoria delle sveglie, indicizzato per (device_id, alarm_id).
+
+    Oltre all'indice principale mantiene un indice per dispositivo, così le
+    letture di un letto non scandiscono tutte le sveglie (quando suonano lo decide
+    AlarmScheduler). Le sveglie non vengono mai modificate sul posto: update()
+    sostituisce il dizionario, per cui chi ha ottenuto una lista (Flask o lo
+    scheduler) vede sempre uno stato coerente.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._alarms = {}       # (device_id, alarm_id) -> alarm
+        self._by_device = {}    # device_id -> {alarm_id: alarm}
+        self._version = 0
+
+    @staticmethod
+    def key(alarm):
+        return alarm["device_id"], alarm["alarm_id"]
+
+    @property
+    def version(self):
+        return self._version
+
+    # ----- Indici ----- #
+    def _index(self, key, alarm):
+        self._alarms[key] = alarm
+        self._by_device.setdefault(key[0], {})[key[1]] = alarm
+
+    def _unindex(self, key):
+        alarm = self._alarms.pop(key, None)
+        if alarm is None:
+            return None
+        device_alarms = self._by_device.get(key[0])
+        if device_alarms is not None:
+            device_alarms.pop(key[1], None)
+            if not device_alarms:
+                del self._by_device[key[0]]
+        return alarm
+
+    # ----- Operazioni ----- #
+    def add(self, alarm):
+        """Aggiunge una sveglia; restituisce False se l'ID esiste già per il dispositivo."""
+        key = self.key(alarm)
+        with self._lock:
+            if key in self._alarms:
+                return False
+            self._index(key, alarm)
+            self._version += 1
+        return True
+
+    def get(self, device_id, alarm_id):
+        return self._alarms.get((device_id, alarm_id))
+
+    def update(self, device_id, alarm_id, **changes):
+        """Sostituisce la sveglia con una copia aggiornata e la restituisce (None se non esiste)."""
+        key = (device_id, alarm_id)
+        with self._lock:
+            alarm = self._alarms.get(key)
+            if alarm is None:
+                return None
+            updated = {**alarm, **changes}
+            self._unindex(key)
+            self._index(key, updated)
+            self._version += 1
+        return updated
+
+    def remove(self, device_id, alarm_id):
+        with self._lock:
+            alarm = self._unindex((device_id, alarm_id))
+            if alarm is not None:
+                self._version += 1
+        return alarm
+
+    def remove_device(self, device_id):
+        ## Rimuove tutte le sveglie del dispositivo e le restituisce
+        with self._lock:
+            removed = list(self._by_device.get(device_id, {}).values())
+            for alarm in removed:
+                self._unindex(self.key(alarm))
+            if removed:
+                self._version += 1
+        return removed
+
+    # ----- Letture ----- #
+    def list(self, device_id=None):
+        """Restituisce una lista delle sveglie (di un dispositivo o di tutti)."""
+        with self._lock:
+            if device_id is not None:
+                return list(self._by_device.get(device_id, {}).values())
+            return list(self._alarms.values())
+
+    def query(self, device_id=None, active=None, frequency=None, offset=0, limit=None):
+        """Filtra le sveglie e restituisce (totale, pagina).
+
+        L'ordine (dispositivo, orario, ID) è stabile tra le richieste, per cui
+        offset e limit individuano sempre la stessa pagina se nulla cambia.
+        """
+        with self._lock:
+            if device_id is not None:
+                alarms = self._by_device.get(device_id, {}).values()
+            else:
+                alarms = self._alarms.values()
+            matches = [
+                alarm for alarm in alarms
+                if (active is None or bool(alarm.get("active")) == active)
+                and (frequency is None or alarm.get("alarm_frequency") == frequency)
+            ]
+        matches.sort(key=lambda alarm: (alarm["device_id"], alarm.get("alarm_time") or "", str(alarm["alarm_id"])))
+        end = offset + limit if limit is not None else None
+        return len(matches), matches[offset:end]
+
+    def count(self, device_id=None):
+        if device_id is not None:
+            return len(self._by_device.get(device_id, ()))
+        return len(self._alarms)
+
+    def __len__(self):
+        return len(self._alarms)
+
+    def __contains__(self, key):
+        return key in self._alarms
+
+
+def parse_listing_args(args):
+    """Converte i parametri di GET /alarms (active, frequency, offset, limit) nei filtri di query()."""
+    filters = {"active": None, "frequency": args.get("frequency") or None, "offset": 0, "limit": None}
+    active = args.get("active")
+    if active is not None:
+        if active.lower() not in ("true", "false"):
+            raise InvalidQuery("active must be true or false")
+        filters["active"] = active.lower() == "true"
+    for name in ("offset", "limit"):
+        value = args.get(name)
+        if value is None:
+            continue
+        try:
+            filters[name] = int(value)
+        except ValueError:
+            raise InvalidQuery(f"{name} must be an integer")
+        if filters[name] < 0:
+            raise InvalidQuery(f"{name} must be >= 0")
+    if filters["limit"] is not None:
+        filters["limit"] = min(filters["limit"], MAX_PAGE_SIZE)
+    return filters
+
+
+class AlarmListingCache:
+    """Cache LRU delle risposte JSON di GET /alarms.
+
+    Ogni voce ricorda la versione dell'AlarmStore con cui è stata serializzata:
+    qualsiasi modifica alle sveglie incrementa la versione e invalida la cache.
+    L'ETag è un hash del corpo, quindi resta valido anche dopo un riavvio.
+    """
+
+    def __init__(self, store, maxsize=128):
+        self.store = store
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # filtri -> (versione, etag, corpo)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, device_id, active=None, frequency=None, offset=0, limit=None):
+        """Restituisce (etag, corpo JSON in bytes) per la pagina richiesta."""
+        key = (device_id, active, frequency, offset, limit)
+        version = self.store.version
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+
+        total, page = self.store.query(device_id, active, frequency, offset, limit)
+        listing = {"device_id": device_id, "alarms": page, "total": total, "offset": offset, "limit": limit}
+        if limit is not None and offset + limit < total:
+            listing["next_offset"] = offset + limit
+        body = json.dumps(listing).encode("utf-8")
+        etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+
+        with self._lock:
+            self._entries[key] = (version, etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return etag, body
@@ -0,0 +1,871 @@
+"""Strumenti di misura per il proxy.
+
+load: avvia il proxy contro sostituti locali di InfluxDB e del broker MQTT
+(benchmark_fakes.py), simula N letti che inviano /sensor_data alla frequenza
+indicata e un flusso di comandi (update_sampling_rate) verso i dispositivi, poi
+riporta latenze p50/p95/p99, throughput e CPU/memoria del proxy. Con
+--save-baseline i risultati vengono salvati; con --compare vengono confrontati
+con un baseline e il comando esce con codice 1 se qualcosa peggiora oltre la
+tolleranza.
+
+delivery: verifica la consegna dei comandi MQTT (QoS 1, retained, conferme e
+ritentativi) contro il broker locale: dispositivi simulati che perdono una parte
+delle conferme e si disconnettono a intervalli; il comando esce con codice 1 se
+qualche comando resta senza conferma.
+
+cluster: avvia più worker in modalità cluster (lease su un file SQLite condiviso),
+crea sveglie per molti dispositivi tramite worker a caso e verifica che ognuna
+suoni esattamente una volta; poi termina un worker con SIGKILL e ripete la
+verifica sui suoi dispositivi, misurando il tempo di failover degli shard.
+
+startup: avvia più volte il proxy e misura il tempo dal lancio del processo a
+/readyz = 200 e quello riportato dal proxy stesso (dall'import a pronto); esce con
+codice 1 se la mediana supera il budget.
+
+live: avvia il proxy, apre molti client SSE su /live (alcuni dei quali non leggono
+mai) e simula N letti che inviano campioni; riporta quanti eventi hanno ricevuto i
+client veloci e con che latenza, ed esce con codice 1 se un client veloce è stato
+escluso o se quelli lenti non lo sono stati.
+
+spool: scrive nello spool su disco (spool.py) una notte simulata di campioni per
+N letti, riapre lo spool come dopo un crash e lo riproduce verso un write_fn che
+conta i punti; riporta byte per campione, dimensione totale e tempo di
+riproduzione, ed esce con codice 1 se mancano campioni o se la riproduzione
+supera --max-replay secondi.
+
+ingest-paths: invia campioni di pressione sia via HTTP (/sensor_data) sia via MQTT
+(iot/bed_alarm/<device>/pressure) a un proxy e a un broker Mosquitto locali, poi
+legge /ingest_stats per confrontare throughput e latenza dei due percorsi.
+
+Esempi:
+    python benchmark.py load --beds 50 --rate 2 --duration 30 --save-baseline benchmarks/baseline.json
+    python benchmark.py load --beds 50 --rate 2 --duration 30 --compare benchmarks/baseline.json
+    python benchmark.py delivery --devices 20 --commands 200 --drop-acks 0.3
+    python benchmark.py cluster --workers 3 --devices 60
+    python benchmark.py startup --runs 5 --budget 3
+    python benchmark.py live --clients 50 --slow 5 --beds 20 --rate 5
+    python benchmark.py spool --beds 2000 --hours 8 --interval 5
+    python benchmark.py ingest-paths --samples 2000
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import paho.mqtt.client as mqtt
+
+from benchmark_fakes import FakeInflux, FakeBroker
+from cluster import shard_of
+from samples import pressure_record
+from spool import SampleSpool
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# Metriche confrontate con il baseline: True se un valore più alto è peggiore
+BASELINE_METRICS = {
+    "sensor_data.p50_ms": True,
+    "sensor_data.p95_ms": True,
+    "sensor_data.p99_ms": True,
+    "sensor_data.throughput_per_s": False,
+    "sensor_data.error_rate": True,
+    "commands.p95_ms": True,
+    "commands.delivery_p95_ms": True,
+    "process.cpu_avg_percent": True,
+    "process.rss_max_mb": True,
+}
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": values[-1]}
+
+
+def wait_until_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{url}/readyz", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Proxy not ready at {url} after {timeout}s")
+
+
+def start_proxy(args, influx_url, broker_port, workdir, **extra_env):
+    ## Avvia proxy.py (o proxy_async.py) in un sottoprocesso configurato sui sostituti locali
+    env = dict(os.environ, **extra_env,
+               influx_url=influx_url, token="benchmark",
+               mqtt_broker="127.0.0.1", mqtt_port=str(broker_port),
+               port=str(args.proxy_port), bind=f"127.0.0.1:{args.proxy_port}",
+               flask_debug="false", weather_api_key="",
+               alarm_db=os.path.join(workdir, "alarms.db"),
+               ingest_spool_file=os.path.join(workdir, "ingest_spool.lp"),
+               ingest_spool_dir=os.path.join(workdir, "ingest_spool", extra_env.get("worker_id", "")))
+    script = "proxy_async.py" if args.server == "async" else "proxy.py"
+    return subprocess.Popen([sys.executable, script], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class ProcessMonitor:
+    """Campiona CPU e memoria residente di un processo (e dei suoi figli) con psutil."""
+
+    def __init__(self, pid, interval=0.5):
+        self.process = psutil.Process(pid) if psutil else None
+        self.interval = interval
+        self.cpu, self.rss = [], []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _tree(self):
+        return [self.process] + self.process.children(recursive=True)
+
+    def _run(self):
+        for process in self._tree():
+            process.cpu_percent(None)
+        while not self._stop.wait(self.interval):
+            try:
+                tree = self._tree()
+                self.cpu.append(sum(p.cpu_percent(None) for p in tree))
+                self.rss.append(sum(p.memory_info().rss for p in tree) / 1e6)
+            except psutil.Error:
+                return
+
+    def start(self):
+        if self.process is not None:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if not self.cpu:
+            return {"cpu_avg_percent": None, "cpu_max_percent": None, "rss_max_mb": None}
+        return {
+            "cpu_avg_percent": sum(self.cpu) / len(self.cpu),
+            "cpu_max_percent": max(self.cpu),
+            "rss_max_mb": max(self.rss),
+        }
+
+
+def run_bed(url, device_id, rate, stop_at, latencies, errors):
+    ## Un letto virtuale: invia un campione ogni 1/rate secondi fino a stop_at
+    session = requests.Session()
+    interval = 1.0 / rate
+    next_send = time.perf_counter()
+    i = 0
+    while next_send < stop_at:
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        start = time.perf_counter()
+        try:
+            resp = session.post(f"{url}/sensor_data", json={
+                "device_id": device_id,
+                "pressure_value": 4095 if (i // 20) % 2 else 1960,
+                "sent_at": time.time() * 1000,
+            }, timeout=5)
+            if resp.status_code >= 400:
+                errors.append(resp.status_code)
+        except requests.RequestException as e:
+            errors.append(type(e).__name__)
+        latencies.append((time.perf_counter() - start) * 1000)
+        i += 1
+        next_send += interval
+
+
+def run_commands(url, device_ids, rate, stop_at, latencies, sent, errors):
+    ## Invia update_sampling_rate a rotazione ai dispositivi; il valore identifica il comando
+    session = requests.Session()
+    interval = 1.0 / rate
+    next_send = time.perf_counter()
+    for value, device_id in zip(itertools.count(1000), itertools.cycle(device_ids)):
+        if next_send >= stop_at:
+            return
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        start = time.perf_counter()
+        sent[value] = start
+        try:
+            resp = session.post(f"{url}/devices/{device_id}/update_sampling_rate", json={"sampling_rate": value}, timeout=5)
+            if resp.status_code >= 400:
+                errors.append(resp.status_code)
+        except requests.RequestException as e:
+            errors.append(type(e).__name__)
+        latencies.append((time.perf_counter() - start) * 1000)
+        next_send += interval
+
+
+def command_observer(port, sent, delivered):
+    ## Client MQTT che fa da firmware: misura il tempo tra la richiesta HTTP e l'arrivo del comando
+    def on_message(client, userdata, msg):
+        received = time.perf_counter()
+        value = json.loads(msg.payload).get("sampling_rate")
+        if value in sent:
+            delivered.append((received - sent[value]) * 1000)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id="bench-observer")
+    client.on_message = on_message
+    client.connect("127.0.0.1", port, 60)
+    client.subscribe("iot/bed_alarm/+/sampling_rate")
+    client.loop_start()
+    return client
+
+
+def load(args):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    influx = FakeInflux().start()
+    broker = FakeBroker().start()
+    proxy = start_proxy(args, influx.url, broker.port, workdir)
+    url = f"http://127.0.0.1:{args.proxy_port}"
+
+    try:
+        wait_until_ready(url)
+        device_ids = [f"bench_{i:04d}" for i in range(args.beds)]
+        sensor_latencies, sensor_errors = [], []
+        command_latencies, command_errors, command_sent, command_delivered = [], [], {}, []
+        observer = command_observer(broker.port, command_sent, command_delivered)
+        monitor = ProcessMonitor(proxy.pid).start()
+
+        start = time.perf_counter()
+        stop_at = start + args.duration
+        with ThreadPoolExecutor(max_workers=args.beds + 1) as executor:
+            for device_id in device_ids:
+                executor.submit(run_bed, url, device_id, args.rate, stop_at, sensor_latencies, sensor_errors)
+            if args.command_rate > 0:
+                executor.submit(run_commands, url, device_ids, args.command_rate, stop_at,
+                                command_latencies, command_sent, command_errors)
+        elapsed = time.perf_counter() - start
+
+        # Lascia al proxy il tempo di svuotare la coda di ingest
+        time.sleep(2)
+        process = monitor.stop()
+        observer.loop_stop()
+        observer.disconnect()
+        ingest_stats = requests.get(f"{url}/ingest_stats", timeout=5).json()
+    finally:
+        proxy.terminate()
+        proxy.wait(timeout=10)
+        influx.stop()
+        broker.stop()
+
+    total = len(sensor_latencies)
+    return {
+        "config": {"server": args.server, "beds": args.beds, "rate": args.rate,
+                   "command_rate": args.command_rate, "duration": args.duration},
+        "environment": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "sensor_data": {
+            "requests": total,
+            "throughput_per_s": total / elapsed,
+            "target_per_s": args.beds * args.rate,
+            "error_rate": len(sensor_errors) / total if total else 0.0,
+            **percentiles(sensor_latencies),
+        },
+        "commands": {
+            "requests": len(command_latencies),
+            "errors": len(command_errors),
+            "delivered": len(command_delivered),
+            **percentiles(command_latencies),
+            **{f"delivery_{k}": v for k, v in percentiles(command_delivered).items()},
+        },
+        "process": process,
+        "influx": influx.get_stats(),
+        "ingest": {k: ingest_stats.get(k) for k in ("written", "dropped", "spooled", "queue_depth") if k in ingest_stats},
+    }
+
+
+def metric(results, name):
+    section, key = name.split(".")
+    return results.get(section, {}).get(key)
+
+
+def compare(results, baseline, tolerance):
+    """Stampa il confronto con il baseline e restituisce le metriche peggiorate."""
+    regressions = []
+    for name, higher_is_worse in BASELINE_METRICS.items():
+        current, previous = metric(results, name), metric(baseline, name)
+        if current is None or previous is None:
+            continue
+        change = (current - previous) / previous if previous else 0.0
+        worse = change > tolerance if higher_is_worse else change < -tolerance
+        # Sotto il millisecondo le differenze sono rumore
+        if worse and name.endswith("_ms") and abs(current - previous) < 1.0:
+            worse = False
+        print(f"{name:32} {previous:10.2f} -> {current:10.2f} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def print_results(results):
+    sensor, commands, process = results["sensor_data"], results["commands"], results["process"]
+    fmt = lambda v: "n/a" if v is None else f"{v:.1f}"
+    print(f"sensor_data  requests={sensor['requests']} throughput={sensor['throughput_per_s']:.0f}/s "
+          f"(target {sensor['target_per_s']:.0f}/s) errors={sensor['error_rate']:.2%} "
+          f"p50={fmt(sensor['p50_ms'])}ms p95={fmt(sensor['p95_ms'])}ms p99={fmt(sensor['p99_ms'])}ms")
+    print(f"commands     requests={commands['requests']} delivered={commands['delivered']} "
+          f"http p95={fmt(commands['p95_ms'])}ms delivery p50={fmt(commands['delivery_p50_ms'])}ms "
+          f"p95={fmt(commands['delivery_p95_ms'])}ms p99={fmt(commands['delivery_p99_ms'])}ms")
+    print(f"process      cpu avg={fmt(process['cpu_avg_percent'])}% max={fmt(process['cpu_max_percent'])}% "
+          f"rss max={fmt(process['rss_max_mb'])}MB" + ("" if psutil else " (install psutil for CPU/memory)"))
+    print(f"influx       writes={results['influx']['requests']} lines={results['influx']['lines']} ingest={results['ingest']}")
+
+
+def load_command(args):
+    results = load(args)
+    print_results(results)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        if baseline.get("config") != results["config"]:
+            print(f"Warning: baseline was recorded with {baseline.get('config')}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+def send_http(url, device_id, samples):
+    session = requests.Session()
+    start = time.perf_counter()
+    for i in range(samples):
+        session.post(f"{url}/sensor_data", json={
+            "device_id": device_id,
+            "pressure_value": 4095 if i % 2 else 1960,
+            "sent_at": time.time() * 1000,
+        }, timeout=5)
+    return time.perf_counter() - start
+
+
+def send_mqtt(broker, port, device_id, samples):
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"bench-{device_id}")
+    client.connect(broker, port, 60)
+    client.loop_start()
+    topic = f"iot/bed_alarm/{device_id}/pressure"
+    start = time.perf_counter()
+    for i in range(samples):
+        info = client.publish(topic, json.dumps({
+            "pressure_value": 4095 if i % 2 else 1960,
+            "sent_at": time.time() * 1000,
+        }))
+    info.wait_for_publish()
+    elapsed = time.perf_counter() - start
+    client.loop_stop()
+    client.disconnect()
+    return elapsed
+
+
+class SimulatedDevice:
+    """Firmware simulato: riceve i comandi, li conferma su <device>/ack e pubblica lo stato online."""
+
+    def __init__(self, device_id, port, drop_acks):
+        self.device_id = device_id
+        self.port = port
+        self.drop_acks = drop_acks
+        self.received = 0
+        self.prefix = f"iot/bed_alarm/{device_id}"
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"bench-device-{device_id}")
+        self.client.will_set(f"{self.prefix}/status", "offline", qos=1, retain=True)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+    def on_connect(self, client, userdata, flags, rc):
+        for command in ("sampling_rate", "trigger_alarm", "stop_alarm", "alarm_sound"):
+            client.subscribe(f"{self.prefix}/{command}", qos=1)
+        client.publish(f"{self.prefix}/status", "online", qos=1, retain=True)
+
+    def on_message(self, client, userdata, msg):
+        self.received += 1
+        cmd_id = json.loads(msg.payload).get("cmd_id")
+        if cmd_id is not None and random.random() >= self.drop_acks:
+            client.publish(f"{self.prefix}/ack", json.dumps({"cmd_id": cmd_id}))
+
+    def connect(self):
+        self.client.connect("127.0.0.1", self.port, 60)
+        self.client.loop_start()
+
+    def disconnect(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def read_gauges(url, prefix):
+    gauges = {}
+    for line in requests.get(f"{url}/metrics", timeout=5).text.splitlines():
+        if line.startswith(prefix):
+            name, value = line.rsplit(" ", 1)
+            gauges[name[len(prefix):]] = float(value)
+    return gauges
+
+
+def delivery(args):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    influx = FakeInflux().start()
+    broker = FakeBroker().start()
+    proxy = start_proxy(args, influx.url, broker.port, workdir,
+                        command_min_backoff=str(args.min_backoff), command_retry_interval="0.2")
+    url = f"http://127.0.0.1:{args.proxy_port}"
+    session = requests.Session()
+
+    try:
+        wait_until_ready(url)
+        fleet = [SimulatedDevice(f"bench_{i:04d}", broker.port, args.drop_acks) for i in range(args.devices)]
+        for device in fleet:
+            device.connect()
+
+        offline = set()
+        for i in range(args.commands):
+            device = fleet[i % len(fleet)]
+            # Ogni tanto un dispositivo perde la connessione e torna dopo qualche comando
+            if random.random() < args.flap and device.device_id not in offline:
+                device.disconnect()
+                offline.add(device.device_id)
+            elif device.device_id in offline and random.random() < 0.5:
+                device.connect()
+                offline.discard(device.device_id)
+            if i % 3 == 0:
+                session.post(f"{url}/devices/{device.device_id}/update_alarm_sound", json={"alarm_sound": i % 4 + 1}, timeout=5)
+            elif i % 3 == 1:
+                session.post(f"{url}/devices/{device.device_id}/update_sampling_rate", json={"sampling_rate": i % 10 + 1}, timeout=5)
+            else:
+                session.post(f"{url}/devices/{device.device_id}/update_stop_alarm", json={"stop_alarm": "true"}, timeout=5)
+            time.sleep(1.0 / args.rate)
+
+        for device in fleet:
+            if device.device_id in offline:
+                device.connect()
+
+        deadline = time.time() + args.timeout
+        while time.time() < deadline:
+            pending = sum(len(session.get(f"{url}/devices/{d.device_id}/delivery", timeout=5).json()["pending"]) for d in fleet)
+            if not pending:
+                break
+            time.sleep(0.5)
+        stats = read_gauges(url, "iot_delivery_")
+        for device in fleet:
+            device.disconnect()
+    finally:
+        proxy.terminate()
+        proxy.wait(timeout=10)
+        influx.stop()
+        broker.stop()
+
+    print(f"delivery     sent={stats.get('sent', 0):.0f} acked={stats.get('acked', 0):.0f} "
+          f"superseded={stats.get('superseded', 0):.0f} retries={stats.get('retries', 0):.0f} "
+          f"expired={stats.get('expired', 0):.0f} pending={pending}")
+    print(f"latency      p50={stats.get('latency_ms_p50', 0):.1f}ms p95={stats.get('latency_ms_p95', 0):.1f}ms "
+          f"max={stats.get('latency_ms_max', 0):.1f}ms")
+    if pending:
+        print(f"{pending} command(s) still unacknowledged after {args.timeout}s")
+        sys.exit(1)
+
+
+def cluster_owners(url):
+    try:
+        return requests.get(f"{url}/cluster", timeout=2).json()["owners"]
+    except (requests.RequestException, ValueError, KeyError):
+        return {}
+
+
+def wait_for_shards(urls, shards, workers, timeout):
+    ## Attende che ogni shard abbia un proprietario e che i proprietari siano `workers` worker distinti
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        owners = {}
+        for url in urls:
+            owners.update(cluster_owners(url))
+        if len(owners) == shards and len(set(owners.values())) == workers:
+            return owners
+        time.sleep(0.2)
+    raise RuntimeError(f"Shards not assigned to {workers} workers after {timeout}s")
+
+
+def create_alarms(urls, device_ids, timeout):
+    ## Crea una sveglia "once" al minuto corrente per ogni dispositivo, tramite un worker a caso
+    alarm_time = time.strftime("%H:%M")
+    deadline = time.time() + timeout
+    for device_id in device_ids:
+        while True:
+            try:
+                response = requests.post(f"{random.choice(urls)}/devices/{device_id}/set_new_alarm", json={
+                    "alarm_id": "bench", "alarm_time": alarm_time, "alarm_frequency": "once"}, timeout=5)
+                if response.status_code != 503:
+                    break
+            except requests.RequestException:
+                pass
+            if time.time() > deadline:
+                raise RuntimeError(f"Could not create alarm for {device_id} after {timeout}s")
+            time.sleep(0.2)
+
+
+def wait_for_triggers(fired, device_ids, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline and any(not fired.get(d) for d in device_ids):
+        time.sleep(0.2)
+    missing = [d for d in device_ids if not fired.get(d)]
+    duplicated = [d for d in device_ids if len(fired.get(d, ())) > 1]
+    return missing, duplicated
+
+
+def cluster(args):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    influx = FakeInflux().start()
+    broker = FakeBroker().start()
+    ports = [args.proxy_port + i for i in range(args.workers)]
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    workers = [
+        start_proxy(argparse.Namespace(**{**vars(args), "proxy_port": port}), influx.url, broker.port, workdir,
+                    cluster_db=os.path.join(workdir, "cluster.db"), worker_id=f"worker-{port}",
+                    cluster_shards=str(args.shards), cluster_lease_ttl=str(args.lease_ttl))
+        for port in ports
+    ]
+
+    # Ogni trigger porta un cmd_id: i ritentativi dello stesso comando non contano come doppioni
+    fired = {}
+    lock = threading.Lock()
+
+    def on_message(client, userdata, msg):
+        cmd_id = json.loads(msg.payload).get("cmd_id")
+        with lock:
+            fired.setdefault(msg.topic.split("/")[-2], set()).add(cmd_id)
+
+    observer = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id="bench-cluster-observer")
+    observer.on_message = on_message
+    observer.connect("127.0.0.1", broker.port, 60)
+    observer.subscribe("iot/bed_alarm/+/trigger_alarm")
+    observer.loop_start()
+
+    failed = False
+    try:
+        for url in urls:
+            wait_until_ready(url)
+        before = wait_for_shards(urls, args.shards, args.workers, timeout=4 * args.lease_ttl)
+        # Le sveglie sono per il minuto corrente: evita di crearle a cavallo del cambio di minuto
+        if time.localtime().tm_sec >= 45:
+            time.sleep(61 - time.localtime().tm_sec)
+
+        device_ids = [f"bench_{i:04d}" for i in range(args.devices)]
+        create_alarms(urls, device_ids, timeout=30)
+        missing, duplicated = wait_for_triggers(fired, device_ids, timeout=30)
+        print(f"steady       workers={args.workers} alarms={len(device_ids)} "
+              f"missing={len(missing)} duplicated={len(duplicated)}")
+        failed |= bool(missing or duplicated)
+
+        # Failover: il primo worker muore senza rilasciare i lease
+        victim = f"worker-{ports[0]}"
+        killed_at = time.time()
+        workers[0].send_signal(signal.SIGKILL)
+        survivors = urls[1:]
+        owners = wait_for_shards(survivors, args.shards, args.workers - 1, timeout=4 * args.lease_ttl)
+        failover = time.time() - killed_at
+        if victim in owners.values():
+            failed = True
+
+        if time.localtime().tm_sec >= 45:
+            time.sleep(61 - time.localtime().tm_sec)
+        # Dispositivi nuovi ma tutti negli shard del worker terminato
+        victim_shards = {int(shard) for shard, owner in before.items() if owner == victim}
+        if not victim_shards:
+            raise RuntimeError(f"{victim} owned no shards, nothing to fail over")
+        candidates = (f"bench_{i:04d}" for i in itertools.count(args.devices))
+        moved = list(itertools.islice((d for d in candidates if shard_of(d, args.shards) in victim_shards), args.devices))
+        create_alarms(survivors, moved, timeout=30)
+        missing, duplicated = wait_for_triggers(fired, moved, timeout=30)
+        print(f"failover     killed={victim} shards_reassigned_in={failover:.1f}s (lease_ttl={args.lease_ttl}s) "
+              f"alarms={len(moved)} missing={len(missing)} duplicated={len(duplicated)}")
+        failed |= bool(missing or duplicated)
+    finally:
+        observer.loop_stop()
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+                worker.wait(timeout=10)
+        influx.stop()
+        broker.stop()
+
+    if failed:
+        sys.exit(1)
+
+
+def startup(args):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    influx = FakeInflux().start()
+    broker = FakeBroker().start()
+    url = f"http://127.0.0.1:{args.proxy_port}"
+    spawn_to_ready, import_to_ready = [], []
+
+    try:
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            proxy = start_proxy(args, influx.url, broker.port, workdir, startup_budget=str(args.budget))
+            try:
+                deadline = started + args.timeout
+                while time.perf_counter() < deadline:
+                    try:
+                        response = requests.get(f"{url}/readyz", timeout=1)
+                        if response.status_code == 200:
+                            spawn_to_ready.append(time.perf_counter() - started)
+                            import_to_ready.append(response.json()["startup_s"])
+                            break
+                    except requests.RequestException:
+                        pass
+                    time.sleep(0.01)
+                else:
+                    raise RuntimeError(f"Proxy not ready after {args.timeout}s")
+            finally:
+                proxy.terminate()
+                proxy.wait(timeout=10)
+    finally:
+        influx.stop()
+        broker.stop()
+
+    spawn = percentiles([s * 1000 for s in spawn_to_ready])
+    imported = percentiles([s * 1000 for s in import_to_ready])
+    print(f"spawn->ready   p50={spawn['p50_ms']:.0f}ms max={spawn['max_ms']:.0f}ms")
+    print(f"import->ready  p50={imported['p50_ms']:.0f}ms max={imported['max_ms']:.0f}ms "
+          f"(budget {args.budget * 1000:.0f}ms)")
+    if imported["p50_ms"] > args.budget * 1000:
+        print("startup over budget")
+        sys.exit(1)
+
+
+def read_live(url, stop, received, latencies, evicted):
+    ## Client SSE veloce: conta gli eventi pressure e la latenza dal campione alla ricezione
+    with requests.get(f"{url}/live?events=pressure", stream=True, timeout=(5, 30)) as response:
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: ") and event == "pressure":
+                received.append(1)
+                latencies.append(time.time() * 1000 - json.loads(line[len("data: "):])["t"])
+            elif line.startswith("data: ") and event == "evicted":
+                evicted.append(1)
+                return
+            if stop.is_set():
+                return
+
+
+def open_slow_client(port):
+    ## Client SSE che non legge mai: il buffer di ricezione minimo si riempie subito
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(("127.0.0.1", port))
+    sock.sendall(f"GET /live HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nAccept: text/event-stream\r\n\r\n".encode())
+    return sock
+
+
+def live(args):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    influx = FakeInflux().start()
+    broker = FakeBroker().start()
+    proxy = start_proxy(args, influx.url, broker.port, workdir, live_client_buffer=str(args.buffer),
+                        live_max_clients=str(args.clients + args.slow + 10))
+    url = f"http://127.0.0.1:{args.proxy_port}"
+    stop = threading.Event()
+    received, latencies, evicted = [], [], []
+    slow = []
+
+    try:
+        wait_until_ready(url)
+        readers = [threading.Thread(target=read_live, args=(url, stop, received, latencies, evicted), daemon=True)
+                   for _ in range(args.clients)]
+        for reader in readers:
+            reader.start()
+        slow = [open_slow_client(args.proxy_port) for _ in range(args.slow)]
+        time.sleep(1)
+
+        stop_at = time.perf_counter() + args.duration
+        bed_latencies, errors = [], []
+        beds = [threading.Thread(target=run_bed, args=(url, f"bench_{i:04d}", args.rate, stop_at, bed_latencies, errors))
+                for i in range(args.beds)]
+        for bed in beds:
+            bed.start()
+        for bed in beds:
+            bed.join()
+        time.sleep(1)
+        stop.set()
+        stats = read_gauges(url, "iot_live_")
+    finally:
+        for sock in slow:
+            sock.close()
+        proxy.terminate()
+        proxy.wait(timeout=10)
+        influx.stop()
+        broker.stop()
+
+    sent = len(bed_latencies)
+    expected = sent * args.clients
+    latency = percentiles(latencies) if latencies else {"p50_ms": 0, "p95_ms": 0, "max_ms": 0}
+    print(f"live     clients={args.clients} slow={args.slow} samples={sent} "
+          f"received={len(received)}/{expected} ({len(received) / max(expected, 1):.1%})")
+    print(f"latency  p50={latency['p50_ms']:.1f}ms p95={latency['p95_ms']:.1f}ms max={latency['max_ms']:.1f}ms")
+    print(f"hub      published={stats.get('published', 0):.0f} delivered={stats.get('delivered', 0):.0f} "
+          f"evicted={stats.get('evicted', 0):.0f} dropped={stats.get('dropped', 0):.0f}")
+    if evicted or stats.get("evicted", 0) < args.slow:
+        print("unexpected eviction result")
+        sys.exit(1)
+
+
+def spool(args):
+    directory = tempfile.mkdtemp(prefix="bench-spool-")
+    device_ids = [f"bench_{i:04d}" for i in range(args.beds)]
+    steps = int(args.hours * 3600 / args.interval)
+    start_ns = time.time_ns() - int(args.hours * 3600 * 1e9)
+    rng = random.Random(1)
+
+    samples = SampleSpool(directory, max_bytes=args.max_mb * 1024 * 1024)
+    started = time.perf_counter()
+    for step in range(steps):
+        timestamp = start_ns + int(step * args.interval * 1e9)
+        samples.append([(device_id, rng.randint(0, 4095), timestamp) for device_id in device_ids])
+    append_time = time.perf_counter() - started
+    spooled = samples.get_stats()
+    # Nessun close(): il segmento attivo viene recuperato alla riapertura, come dopo un crash
+    samples = SampleSpool(directory, max_bytes=args.max_mb * 1024 * 1024)
+
+    written = [0]
+
+    def write(lines):
+        written[0] += len(lines)
+
+    started = time.perf_counter()
+    replayed = samples.drain(write, pressure_record, args.batch_size)
+    replay_time = time.perf_counter() - started
+
+    total = args.beds * steps
+    print(f"spool    samples={total} bytes={spooled['bytes']} ({spooled['bytes'] / total:.1f} B/sample, "
+          f"{spooled['bytes'] / 1e6:.1f} MB) segments={spooled['segments']} "
+          f"append_rate={total / append_time:.0f}/s")
+    print(f"replay   replayed={replayed} written={written[0]} in {replay_time:.2f}s "
+          f"({written[0] / max(replay_time, 1e-9):.0f}/s)")
+    if written[0] != total - spooled["evicted"] or replay_time > args.max_replay:
+        print("spool replay incomplete or too slow")
+        sys.exit(1)
+
+
+def ingest_paths(args):
+    before = requests.get(f"{args.url}/ingest_stats", timeout=5).json()["paths"]
+
+    http_time = send_http(args.url, "bench_http", args.samples)
+    mqtt_time = send_mqtt(args.broker, args.port, "bench_mqtt", args.samples)
+
+    # Attende che il proxy abbia consumato tutti i messaggi MQTT
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        after = requests.get(f"{args.url}/ingest_stats", timeout=5).json()["paths"]
+        if after["mqtt"]["samples"] - before["mqtt"]["samples"] >= args.samples:
+            break
+        time.sleep(0.2)
+
+    for name, elapsed in (("http", http_time), ("mqtt", mqtt_time)):
+        received = after[name]["samples"] - before[name]["samples"]
+        latency = after[name].get("latency_ms", {})
+        print(f"{name:5} sent={args.samples} received={received} "
+              f"client_rate={args.samples / elapsed:.0f}/s "
+              f"latency p50={latency.get('p50', 0):.1f}ms p95={latency.get('p95', 0):.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the IoT alarm proxy.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    bench = sub.add_parser("load", help="simulate N beds against local InfluxDB/MQTT stand-ins")
+    bench.add_argument("--server", choices=("sync", "async"), default="sync")
+    bench.add_argument("--proxy-port", type=int, default=5055)
+    bench.add_argument("--beds", type=int, default=20)
+    bench.add_argument("--rate", type=float, default=1.0, help="samples per second per bed")
+    bench.add_argument("--command-rate", type=float, default=2.0, help="MQTT commands per second (0 to disable)")
+    bench.add_argument("--duration", type=float, default=20.0)
+    bench.add_argument("--save-baseline", metavar="FILE")
+    bench.add_argument("--compare", metavar="FILE")
+    bench.add_argument("--tolerance", type=float, default=0.15)
+    bench.set_defaults(func=load_command)
+
+    deliver = sub.add_parser("delivery", help="check MQTT command delivery (acks, retries, reconnects)")
+    deliver.add_argument("--server", choices=("sync", "async"), default="sync")
+    deliver.add_argument("--proxy-port", type=int, default=5055)
+    deliver.add_argument("--devices", type=int, default=10)
+    deliver.add_argument("--commands", type=int, default=100)
+    deliver.add_argument("--rate", type=float, default=20.0, help="commands per second")
+    deliver.add_argument("--drop-acks", type=float, default=0.3, help="fraction of acks the devices lose")
+    deliver.add_argument("--flap", type=float, default=0.05, help="probability of a disconnect per command")
+    deliver.add_argument("--min-backoff", type=float, default=0.5)
+    deliver.add_argument("--timeout", type=float, default=60.0)
+    deliver.set_defaults(func=delivery)
+
+    shard = sub.add_parser("cluster", help="check sharded workers: alarms fire once, shards fail over")
+    shard.add_argument("--server", choices=("sync", "async"), default="sync")
+    shard.add_argument("--proxy-port", type=int, default=5055, help="port of the first worker")
+    shard.add_argument("--workers", type=int, default=3)
+    shard.add_argument("--devices", type=int, default=60)
+    shard.add_argument("--shards", type=int, default=64)
+    shard.add_argument("--lease-ttl", type=float, default=3.0)
+    shard.set_defaults(func=cluster)
+
+    boot = sub.add_parser("startup", help="measure time from launch to /readyz against a budget")
+    boot.add_argument("--server", choices=("sync", "async"), default="sync")
+    boot.add_argument("--proxy-port", type=int, default=5055)
+    boot.add_argument("--runs", type=int, default=5)
+    boot.add_argument("--budget", type=float, default=3.0, help="seconds from import to ready")
+    boot.add_argument("--timeout", type=float, default=30.0)
+    boot.set_defaults(func=startup)
+
+    stream = sub.add_parser("live", help="fan out /live SSE events to many clients, evicting slow ones")
+    stream.add_argument("--server", choices=("sync", "async"), default="sync")
+    stream.add_argument("--proxy-port", type=int, default=5055)
+    stream.add_argument("--clients", type=int, default=50)
+    stream.add_argument("--slow", type=int, default=5, help="clients that never read")
+    stream.add_argument("--beds", type=int, default=20)
+    stream.add_argument("--rate", type=float, default=5.0, help="samples per second per bed")
+    stream.add_argument("--duration", type=float, default=20.0)
+    stream.add_argument("--buffer", type=int, default=256, help="live_client_buffer")
+    stream.set_defaults(func=live)
+
+    offline = sub.add_parser("spool", help="measure on-disk spool size and replay time for a simulated night")
+    offline.add_argument("--beds", type=int, default=1000)
+    offline.add_argument("--hours", type=float, default=8.0)
+    offline.add_argument("--interval", type=float, default=5.0, help="seconds between samples of a bed")
+    offline.add_argument("--max-mb", type=int, default=256, help="spool size limit")
+    offline.add_argument("--batch-size", type=int, default=10000)
+    offline.add_argument("--max-replay", type=float, default=30.0, help="seconds")
+    offline.set_defaults(func=spool)
+
+    paths = sub.add_parser("ingest-paths", help="compare HTTP and MQTT ingest")
+    paths.add_argument("--url", default="http://localhost:5000")
+    paths.add_argument("--broker", default="localhost")
+    paths.add_argument("--port", type=int, default=1883)
+    paths.add_argument("--samples", type=int, default=1000)
+    paths.set_defaults(func=ingest_paths)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
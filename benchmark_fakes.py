@@ -0,0 +1,204 @@
+"""Sostituti locali di InfluxDB e del broker MQTT per benchmark.py.
+
+FakeInflux accetta le scritture in line protocol su /api/v2/write e le conta
+senza salvarle; FakeBroker implementa il minimo di MQTT 3.1.1 usato dal proxy e
+dal firmware (CONNECT, SUBSCRIBE con wildcard, PUBLISH QoS 0/1, retain, PING).
+Così il benchmark misura il proxy e non il database o Mosquitto.
+"""
+import socket
+import socketserver
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeInflux:
+    def __init__(self, host="127.0.0.1", port=0):
+        fake = self
+        self.lines = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.startswith("/api/v2/write"):
+                    with fake._lock:
+                        fake.requests += 1
+                        fake.lines += body.count(b"\n") + 1 if body else 0
+                self.send_response(204)
+                self.end_headers()
+
+            def do_GET(self):
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_stats(self):
+        with self._lock:
+            return {"requests": self.requests, "lines": self.lines}
+
+
+def topic_matches(topic_filter, topic):
+    """Confronta un topic con un filtro MQTT (wildcard + e #)."""
+    filter_parts, topic_parts = topic_filter.split("/"), topic.split("/")
+    for i, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _string(data):
+    return struct.pack("!H", len(data)) + data
+
+
+class FakeBroker:
+    def __init__(self, host="127.0.0.1", port=0):
+        broker = self
+        self.host = host
+        self._clients = {}   # sessione -> lista di filtri
+        self._retained = {}  # topic -> payload
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.write_lock = threading.Lock()
+                try:
+                    broker._serve(self)
+                except (ConnectionError, OSError):
+                    pass
+                finally:
+                    with broker._lock:
+                        broker._clients.pop(self, None)
+
+            def send(self, data):
+                with self.write_lock:
+                    self.request.sendall(data)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_stats(self):
+        with self._lock:
+            return {"clients": len(self._clients), "published": self.published, "delivered": self.delivered}
+
+    @staticmethod
+    def _read_exact(sock, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("client disconnected")
+            data += chunk
+        return bytes(data)
+
+    def _read_packet(self, sock):
+        header = self._read_exact(sock, 1)[0]
+        length, shift = 0, 0
+        while True:
+            byte = self._read_exact(sock, 1)[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header, self._read_exact(sock, length)
+
+    def _serve(self, session):
+        sock = session.request
+        while True:
+            header, body = self._read_packet(sock)
+            kind = header >> 4
+            if kind == 1:      # CONNECT
+                session.send(b"\x20\x02\x00\x00")
+            elif kind == 3:    # PUBLISH
+                self._on_publish(session, header, body)
+            elif kind == 8:    # SUBSCRIBE
+                self._on_subscribe(session, body)
+            elif kind == 10:   # UNSUBSCRIBE
+                session.send(b"\xb0\x02" + body[:2])
+            elif kind == 12:   # PINGREQ
+                session.send(b"\xd0\x00")
+            elif kind == 14:   # DISCONNECT
+                return
+
+    def _on_publish(self, session, header, body):
+        qos, retain = (header >> 1) & 0x03, header & 0x01
+        topic_length = struct.unpack("!H", body[:2])[0]
+        topic = body[2:2 + topic_length]
+        offset = 2 + topic_length
+        if qos:
+            session.send(b"\x40\x02" + body[offset:offset + 2])
+            offset += 2
+        payload = body[offset:]
+
+        # I messaggi vengono inoltrati sempre con QoS 0
+        packet = _string(topic) + payload
+        packet = b"\x30" + _encode_length(len(packet)) + packet
+        topic = topic.decode("utf-8")
+        with self._lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self._retained[topic] = packet
+                else:
+                    self._retained.pop(topic, None)
+            targets = [client for client, filters in self._clients.items()
+                       if any(topic_matches(f, topic) for f in filters)]
+            self.delivered += len(targets)
+        for client in targets:
+            try:
+                client.send(packet)
+            except OSError:
+                pass
+
+    def _on_subscribe(self, session, body):
+        packet_id, offset, filters = body[:2], 2, []
+        while offset < len(body):
+            length = struct.unpack("!H", body[offset:offset + 2])[0]
+            filters.append(body[offset + 2:offset + 2 + length].decode("utf-8"))
+            offset += 2 + length + 1
+        with self._lock:
+            self._clients.setdefault(session, []).extend(filters)
+            retained = [packet for topic, packet in self._retained.items()
+                        if any(topic_matches(f, topic) for f in filters)]
+        session.send(b"\x90" + _encode_length(2 + len(filters)) + packet_id + b"\x00" * len(filters))
+        for packet in retained:
+            # Bit di retain sui messaggi conservati
+            session.send(bytes([packet[0] | 0x01]) + packet[1:])
@@ -0,0 +1,225 @@
+"""Modalità cluster: più processi del proxy che si dividono i dispositivi.
+
+I dispositivi sono assegnati a un numero fisso di shard (hash del device ID) e
+gli shard ai worker vivi con hashing consistente, così quando un worker entra o
+esce si spostano solo i suoi shard. Il coordinamento passa da un file SQLite
+condiviso (tabelle workers e leases): ogni worker rinnova periodicamente il
+proprio heartbeat e i lease degli shard che gli spettano, e ne acquisisce di
+nuovi solo quando il lease precedente è stato rilasciato o è scaduto. Un worker
+che si ferma rilascia subito i lease; uno che muore li perde dopo `lease_ttl`.
+
+Lo stato dei dispositivi resta nel processo che possiede lo shard: le richieste
+per un dispositivo altrui vengono inoltrate al proprietario e le sveglie di uno
+shard vengono caricate da AlarmDB quando lo shard viene acquisito.
+"""
+import bisect
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def shard_of(device_id, shards):
+    return _hash(device_id) % shards
+
+
+class HashRing:
+    """Anello di hashing consistente con `vnodes` punti per worker."""
+
+    def __init__(self, members, vnodes=64):
+        self.members = sorted(members)
+        points = sorted((_hash(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self._keys = [point for point, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key):
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, _hash(str(key))) % len(self._keys)
+        return self._owners[index]
+
+
+class ShardCoordinator:
+    """Lease degli shard su un database SQLite condiviso dai worker dello stesso host (o volume).
+
+    tick() è l'unica operazione che scrive: aggiorna l'heartbeat, calcola sulla
+    base dei worker vivi quali shard spettano a questo worker, rinnova o acquisisce
+    i relativi lease e rilascia gli altri. Restituisce gli shard acquisiti e persi
+    dall'ultimo tick, che chi la usa trasforma in caricamento e scarico delle sveglie.
+    """
+
+    def __init__(self, db_file, worker_id=None, url=None, shards=64, lease_ttl=15.0, clock=time.time):
+        self.db_file = db_file
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.url = url
+        self.shards = shards
+        self.lease_ttl = lease_ttl
+        self.clock = clock
+        self._owned = set()
+        self._valid_until = 0.0
+        self._owners = {}  # shard -> (worker_id, url) secondo l'ultimo tick
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"ticks": 0, "acquired": 0, "released": 0, "errors": 0}
+
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None, timeout=10.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            " worker_id TEXT PRIMARY KEY,"
+            " url TEXT,"
+            " heartbeat REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            " shard INTEGER PRIMARY KEY,"
+            " owner TEXT NOT NULL,"
+            " expires REAL NOT NULL)"
+        )
+
+    # ----- Proprietà ----- #
+    def shard(self, device_id):
+        return shard_of(device_id, self.shards)
+
+    def owns(self, device_id):
+        """True se questo worker ha un lease valido sullo shard del dispositivo.
+
+        Il lease viene considerato perso un quarto di TTL prima della scadenza, così
+        un worker rallentato smette di far suonare sveglie prima che un altro possa
+        acquisire lo shard.
+        """
+        with self._lock:
+            return self.shard(device_id) in self._owned and self.clock() + self.lease_ttl / 4 < self._valid_until
+
+    def owner(self, device_id):
+        """(worker_id, url) del proprietario dello shard, o None se lo shard è in transizione."""
+        with self._lock:
+            return self._owners.get(self.shard(device_id))
+
+    def owned(self):
+        with self._lock:
+            return set(self._owned)
+
+    # ----- Coordinamento ----- #
+    def tick(self):
+        """Rinnova heartbeat e lease; restituisce (shard acquisiti, shard persi)."""
+        now = self.clock()
+        expires = now + self.lease_ttl
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO workers (worker_id, url, heartbeat) VALUES (?, ?, ?)"
+                " ON CONFLICT(worker_id) DO UPDATE SET url = excluded.url, heartbeat = excluded.heartbeat",
+                (self.worker_id, self.url, now),
+            )
+            conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - 4 * self.lease_ttl,))
+            live = [row[0] for row in conn.execute("SELECT worker_id FROM workers WHERE heartbeat >= ?",
+                                                   (now - self.lease_ttl,))]
+            ring = HashRing(live)
+            wanted = {shard for shard in range(self.shards) if ring.owner(shard) == self.worker_id}
+
+            # Gli shard che non spettano più a questo worker vengono rilasciati subito
+            conn.execute(
+                f"DELETE FROM leases WHERE owner = ? AND shard NOT IN ({','.join('?' * len(wanted))})",
+                (self.worker_id, *wanted),
+            )
+            # Rinnovo dei propri lease e acquisizione di quelli liberi o scaduti
+            for shard in wanted:
+                conn.execute(
+                    "INSERT INTO leases (shard, owner, expires) VALUES (?, ?, ?)"
+                    " ON CONFLICT(shard) DO UPDATE SET owner = excluded.owner, expires = excluded.expires"
+                    " WHERE leases.owner = excluded.owner OR leases.expires < ?",
+                    (shard, self.worker_id, expires, now),
+                )
+            rows = conn.execute(
+                "SELECT leases.shard, leases.owner, workers.url FROM leases"
+                " LEFT JOIN workers ON workers.worker_id = leases.owner WHERE leases.expires >= ?",
+                (now,),
+            ).fetchall()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        owners = {shard: (owner, url) for shard, owner, url in rows}
+        owned = {shard for shard, (owner, _) in owners.items() if owner == self.worker_id}
+        with self._lock:
+            acquired = owned - self._owned
+            lost = self._owned - owned
+            self._owned = owned
+            self._owners = owners
+            self._valid_until = expires
+            self.stats["ticks"] += 1
+            self.stats["acquired"] += len(acquired)
+            self.stats["released"] += len(lost)
+        return acquired, lost
+
+    def release_all(self):
+        """Rilascia lease e heartbeat (arresto pulito): gli shard passano subito agli altri worker."""
+        with self._lock:
+            lost = self._owned
+            self._owned = set()
+            self._valid_until = 0.0
+        self._conn.execute("DELETE FROM leases WHERE owner = ?", (self.worker_id,))
+        self._conn.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+        return lost
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["owned"] = len(self._owned)
+            stats["workers"] = len({owner for owner, _ in self._owners.values()})
+        return stats
+
+    def status(self):
+        with self._lock:
+            return {
+                "worker_id": self.worker_id,
+                "shards": self.shards,
+                "owned": sorted(self._owned),
+                "lease_valid_for_s": max(self._valid_until - self.clock(), 0.0),
+                "owners": {str(shard): owner for shard, (owner, _) in sorted(self._owners.items())},
+            }
+
+    # ----- Thread di coordinamento ----- #
+    def start(self, on_acquire, on_release, interval=None):
+        """Esegue tick() ogni `interval` secondi (di default un terzo del lease) e notifica i cambi di shard."""
+        interval = interval or self.lease_ttl / 3
+
+        def run():
+            while not self._stop.wait(interval):
+                self._tick_and_notify(on_acquire, on_release)
+
+        self._tick_and_notify(on_acquire, on_release)
+        self._thread = threading.Thread(target=run, name="shard-coordinator", daemon=True)
+        self._thread.start()
+
+    def _tick_and_notify(self, on_acquire, on_release):
+        try:
+            acquired, lost = self.tick()
+        except sqlite3.Error as e:
+            with self._lock:
+                self.stats["errors"] += 1
+            log.error("shard coordination failed", extra={"error": str(e)})
+            return
+        if lost:
+            on_release(lost)
+        if acquired:
+            on_acquire(acquired)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.release_all()
@@ -0,0 +1,178 @@
+import itertools
+import threading
+import time
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+# Comandi che descrivono uno stato: pubblicati retained, così un dispositivo che si
+# riconnette riceve subito l'ultimo valore. Gli altri (trigger_alarm, stop_alarm) sono
+# eventi: un retained li rieseguirebbe a ogni riconnessione.
+RETAINED_COMMANDS = frozenset({"sampling_rate", "alarm_sound"})
+
+# Dopo quanto tempo (secondi) si smette di ritentare un comando non confermato
+DEFAULT_EXPIRY = {"trigger_alarm": 15 * 60, "stop_alarm": 15 * 60}
+STATE_EXPIRY = 24 * 3600
+
+
+class _Pending:
+    __slots__ = ("cmd_id", "topic", "message", "retain", "first_sent", "attempts", "next_retry", "expires")
+
+    def __init__(self, cmd_id, topic, message, retain, now, expires):
+        self.cmd_id = cmd_id
+        self.topic = topic
+        self.message = message
+        self.retain = retain
+        self.first_sent = now
+        self.attempts = 1
+        self.next_retry = now
+        self.expires = expires
+
+
+class CommandDelivery:
+    """Stato di consegna dei comandi MQTT per dispositivo, con conferme e ritentativi.
+
+    Ogni comando riceve un cmd_id crescente che il firmware rimanda su
+    iot/bed_alarm/<device>/ack. Finché la conferma non arriva il comando resta in
+    attesa e viene ripubblicato con backoff esponenziale (min_backoff, max_backoff)
+    fino alla scadenza. Un nuovo comando dello stesso tipo sostituisce quello in
+    attesa, e stop_alarm annulla un trigger_alarm non ancora consegnato.
+
+    La classe non pubblica: prepare() e due() restituiscono (topic, messaggio, retain)
+    e chi la usa li invia con il proprio client MQTT (paho o aiomqtt).
+    """
+
+    def __init__(self, min_backoff=2.0, max_backoff=60.0, expiry=None, retained=RETAINED_COMMANDS,
+                 clock=time.monotonic):
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.expiry = {**DEFAULT_EXPIRY, **(expiry or {})}
+        self.retained = retained
+        self.clock = clock
+        # Primo ID preso dall'orologio (ms): dopo un riavvio del proxy gli ID non ripartono da 1
+        self._ids = itertools.count(int(time.time() * 1000) % 2**31)
+        self._pending = {}   # (device_id, comando) -> _Pending
+        self._by_id = {}     # cmd_id -> (device_id, comando)
+        self._acked = {}     # (device_id, comando) -> (cmd_id, latenza in s)
+        self._latencies = deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"sent": 0, "acked": 0, "retries": 0, "expired": 0, "superseded": 0}
+
+    def prepare(self, device, command, payload):
+        """Registra un nuovo comando e restituisce (topic, messaggio, retain) da pubblicare."""
+        now = self.clock()
+        cmd_id = next(self._ids)
+        message = {**payload, "cmd_id": cmd_id}
+        retain = command in self.retained
+        pending = _Pending(cmd_id, device.topic(command), message, retain, now,
+                           now + self.expiry.get(command, STATE_EXPIRY))
+        pending.next_retry = now + self.min_backoff
+        with self._lock:
+            self.stats["sent"] += 1
+            if self._discard((device.device_id, command)):
+                self.stats["superseded"] += 1
+            if command == "stop_alarm" and self._discard((device.device_id, "trigger_alarm")):
+                self.stats["superseded"] += 1
+            self._pending[(device.device_id, command)] = pending
+            self._by_id[cmd_id] = (device.device_id, command)
+        return pending.topic, message, retain
+
+    def _discard(self, key):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return None
+        del self._by_id[pending.cmd_id]
+        return pending
+
+    def ack(self, device_id, cmd_id):
+        """Conferma di un comando; restituisce la latenza di consegna in secondi (None se sconosciuto)."""
+        now = self.clock()
+        with self._lock:
+            key = self._by_id.get(cmd_id)
+            # Conferme duplicate o di un comando già sostituito vengono ignorate
+            if key is None or key[0] != device_id:
+                return None
+            pending = self._discard(key)
+            latency = now - pending.first_sent
+            self._acked[key] = (cmd_id, latency)
+            self._latencies.append(latency)
+            self.stats["acked"] += 1
+        return latency
+
+    def device_online(self, device_id):
+        ## Il dispositivo si è (ri)connesso: i comandi in attesa vengono ripubblicati subito
+        now = self.clock()
+        with self._lock:
+            for (pending_device, _), pending in self._pending.items():
+                if pending_device == device_id:
+                    pending.next_retry = now
+
+    def due(self):
+        """Comandi da ripubblicare adesso, come lista di (topic, messaggio, retain)."""
+        now = self.clock()
+        messages = []
+        with self._lock:
+            for key, pending in list(self._pending.items()):
+                if now >= pending.expires:
+                    self._discard(key)
+                    self.stats["expired"] += 1
+                    log.warning("command expired", extra={"device_id": key[0], "command": key[1], "attempts": pending.attempts})
+                    continue
+                if now < pending.next_retry:
+                    continue
+                backoff = min(self.min_backoff * 2 ** pending.attempts, self.max_backoff)
+                pending.attempts += 1
+                pending.next_retry = now + backoff
+                self.stats["retries"] += 1
+                messages.append((pending.topic, pending.message, pending.retain))
+        return messages
+
+    def device_status(self, device_id):
+        """Stato di consegna dei comandi del dispositivo: in attesa e ultime conferme."""
+        now = self.clock()
+        with self._lock:
+            pending = {
+                command: {"cmd_id": p.cmd_id, "attempts": p.attempts, "age_s": now - p.first_sent}
+                for (d, command), p in self._pending.items() if d == device_id
+            }
+            acked = {
+                command: {"cmd_id": cmd_id, "latency_ms": latency * 1000}
+                for (d, command), (cmd_id, latency) in self._acked.items() if d == device_id
+            }
+        return {"device_id": device_id, "pending": pending, "acked": acked}
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._pending)
+            latencies = sorted(self._latencies)
+        if latencies:
+            stats["latency_ms"] = {
+                "p50": latencies[len(latencies) // 2] * 1000,
+                "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+                "max": latencies[-1] * 1000,
+            }
+        return stats
+
+    # ----- Thread dei ritentativi ----- #
+    def start(self, publish_fn, interval=1.0):
+        """Ripubblica ogni `interval` secondi i comandi non confermati con publish_fn(topic, messaggio, retain)."""
+        def run():
+            while not self._stop.wait(interval):
+                for topic, message, retain in self.due():
+                    try:
+                        publish_fn(topic, message, retain)
+                    except Exception as e:
+                        log.error("command retry failed", extra={"topic": topic, "error": str(e)})
+
+        self._thread = threading.Thread(target=run, name="command-delivery", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
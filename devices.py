@@ -0,0 +1,88 @@
+import re
+import threading
+
+
+DEFAULT_DEVICE_ID = "default"
+TOPIC_PREFIX = "iot/bed_alarm"
+
+# Gli ID finiscono nei topic MQTT: niente '/', '+' o '#'
+_DEVICE_ID_RE = re.compile(r"[A-Za-z0-9_.-]{1,64}")
+
+
+class InvalidDeviceId(ValueError):
+    pass
+
+
+class Device:
+    """Stato e impostazioni di un singolo letto (le sveglie sono in AlarmStore)."""
+
+    def __init__(self, device_id, sampling_rate=5, alarm_sound=1, weather_location="Bologna"):
+        self.device_id = device_id
+        self.sampling_rate = sampling_rate
+        # Frequenza effettivamente inviata al firmware (vedi sampling.SamplingController)
+        self.adaptive_sampling = True
+        self.effective_sampling_rate = sampling_rate
+        self.sampling_mode = "baseline"
+        self.stop_alarm = False
+        # Ultimo stato pubblicato dal firmware su <device>/status (None se mai visto)
+        self.online = None
+        self.alarm_sound = alarm_sound
+        self.weather_location = weather_location
+
+    def topic(self, name):
+        """Restituisce il topic MQTT del dispositivo, es. iot/bed_alarm/<device>/trigger_alarm."""
+        return f"{TOPIC_PREFIX}/{self.device_id}/{name}"
+
+    def settings(self):
+        return {
+            "device_id": self.device_id,
+            "sampling_rate": self.sampling_rate,
+            "adaptive_sampling": self.adaptive_sampling,
+            "effective_sampling_rate": self.effective_sampling_rate,
+            "sampling_mode": self.sampling_mode,
+            "stop_alarm": self.stop_alarm,
+            "online": self.online,
+            "alarm_sound": self.alarm_sound,
+            "location": self.weather_location,
+        }
+
+
+class DeviceRegistry:
+    """Registro dei dispositivi indicizzato per device ID.
+
+    I dispositivi vengono creati alla prima richiesta con le impostazioni di default.
+    """
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def validate(device_id):
+        if not isinstance(device_id, str) or not _DEVICE_ID_RE.fullmatch(device_id):
+            raise InvalidDeviceId(f"Invalid device ID: {device_id!r}")
+        return device_id
+
+    def get(self, device_id):
+        """Restituisce il dispositivo, creandolo se non esiste ancora."""
+        device = self._devices.get(device_id)
+        if device is None:
+            self.validate(device_id)
+            with self._lock:
+                device = self._devices.get(device_id)
+                if device is None:
+                    device = Device(device_id, **self.defaults)
+                    self._devices[device_id] = device
+        return device
+
+    def find(self, device_id):
+        return self._devices.get(device_id)
+
+    def remove(self, device_id):
+        with self._lock:
+            return self._devices.pop(device_id, None)
+
+    def all(self):
+        with self._lock:
+            return list(self._devices.values())
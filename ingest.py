@@ -0,0 +1,484 @@
+import asyncio
+import math
+import os
+import queue
+import threading
+import time
+import logging
+from collections import deque
+from influxdb_client.rest import ApiException
+from samples import pressure_record
+
+log = logging.getLogger(__name__)
+
+# Errori 4xx di InfluxDB che non dipendono dai dati (credenziali, bucket, timeout, rate limit):
+# il batch resta valido e va ritentato come per un errore di rete
+TRANSIENT_STATUS = {401, 403, 404, 408, 429}
+
+
+def _rejected(error):
+    """True se InfluxDB ha rifiutato i dati del batch: riscriverlo darebbe sempre lo stesso errore."""
+    return isinstance(error, ApiException) and error.status is not None and 400 <= error.status < 500 \
+        and error.status not in TRANSIENT_STATUS
+
+
+class IngestPipeline:
+    """Coda di ingest limitata che scrive su InfluxDB a batch, in background.
+
+    I record (stringhe in line protocol) vengono accodati da put() e scritti da un
+    thread dedicato quando il batch raggiunge batch_size oppure quando il record più
+    vecchio supera max_batch_age secondi. Se la scrittura fallisce il batch viene
+    salvato su disco (spool_file) e la pipeline attende con backoff esponenziale
+    prima di ritentare; al primo flush riuscito lo spool viene riprodotto.
+
+    I campioni di pressione accodati con put_sample() restano tuple (device_id,
+    valore, timestamp) fino al flush: se la scrittura fallisce finiscono nello
+    spool compatto sample_spool (vedi spool.SampleSpool) invece che nel file di
+    testo, e un thread separato li riproduce a batch di replay_batch_size quando
+    InfluxDB torna raggiungibile, senza rallentare il percorso dei dati live.
+    """
+
+    def __init__(self, write_fn, max_queue=10000, batch_size=500, max_batch_age=1.0,
+                 spool_file="ingest_spool.lp", min_backoff=1.0, max_backoff=60.0,
+                 sample_spool=None, replay_batch_size=10000, replay_interval=1.0):
+        self.write_fn = write_fn
+        self.batch_size = batch_size
+        self.max_batch_age = max_batch_age
+        self.spool_file = spool_file
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.sample_spool = sample_spool
+        self.replay_batch_size = replay_batch_size
+        self.replay_interval = replay_interval
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._replay_thread = None
+
+        self._backoff = 0.0
+        self._retry_at = 0.0
+
+        self.stats = {
+            "enqueued": 0,
+            "written": 0,
+            "dropped": 0,
+            "spooled": 0,
+            "replayed": 0,
+            "flushes": 0,
+            "errors": 0,
+            "last_flush_latency_ms": 0.0,
+            "max_flush_latency_ms": 0.0,
+        }
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+            self._thread.start()
+        if self.sample_spool is not None and (self._replay_thread is None or not self._replay_thread.is_alive()):
+            self._replay_thread = threading.Thread(target=self._run_replay, name="ingest-replay", daemon=True)
+            self._replay_thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        ## Ferma il thread dopo aver svuotato la coda
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._replay_thread is not None:
+            self._replay_thread.join(timeout)
+        if self.sample_spool is not None:
+            self.sample_spool.close()
+
+    def put(self, record):
+        """Accoda un record senza bloccare. Restituisce False se la coda è piena."""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.stats["dropped"] += 1
+            return False
+        with self._lock:
+            self.stats["enqueued"] += 1
+        return True
+
+    def put_sample(self, device_id, value, timestamp):
+        """Accoda un campione di pressione (timestamp in ns); viene convertito in line protocol al flush."""
+        return self.put((device_id, value, timestamp))
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["queue_depth"] = self.queue.qsize()
+        stats["queue_capacity"] = self.queue.maxsize
+        stats["backoff_s"] = self._backoff
+        stats["spool_bytes"] = os.path.getsize(self.spool_file) if os.path.exists(self.spool_file) else 0
+        if self.sample_spool is not None:
+            stats["sample_spool"] = self.sample_spool.get_stats()
+        return stats
+
+    # ----- Thread di scrittura ----- #
+    def _run(self):
+        while not (self._stop.is_set() and self.queue.empty()):
+            batch = self._collect_batch()
+            if batch:
+                self._flush(batch)
+
+    def _collect_batch(self):
+        ## Raccoglie record finché il batch è pieno o il primo record è troppo vecchio
+        try:
+            first = self.queue.get(timeout=self.max_batch_age)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_batch_age
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        # Durante il backoff non si contatta InfluxDB: il batch va direttamente su disco
+        if time.monotonic() < self._retry_at:
+            self._spool(batch)
+            return
+
+        start = time.perf_counter()
+        try:
+            self.write_fn(_lines(batch))
+        except Exception as e:
+            if _rejected(e):
+                self._on_rejected(len(batch), e)
+                return
+            self._on_failure(e)
+            self._spool(batch)
+            return
+
+        latency_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.stats["written"] += len(batch)
+            self.stats["flushes"] += 1
+            self.stats["last_flush_latency_ms"] = latency_ms
+            self.stats["max_flush_latency_ms"] = max(self.stats["max_flush_latency_ms"], latency_ms)
+        self._backoff = 0.0
+        self._retry_at = 0.0
+
+        if os.path.exists(self.spool_file):
+            self._replay_spool()
+
+    def _on_failure(self, error):
+        self._backoff = min(self.max_backoff, max(self.min_backoff, self._backoff * 2))
+        self._retry_at = time.monotonic() + self._backoff
+        with self._lock:
+            self.stats["errors"] += 1
+        log.error("influx write failed", extra={"error": str(error), "retry_in_s": round(self._backoff, 1)})
+
+    def _on_rejected(self, points, error):
+        ## Batch rifiutato da InfluxDB: viene scartato invece di finire nello spool, dove
+        ## bloccherebbe la riproduzione; InfluxDB ha risposto, quindi niente backoff
+        with self._lock:
+            self.stats["dropped"] += points
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        log.error("influx rejected batch, dropped", extra={"points": points, "error": str(error)})
+
+    # ----- Spool su disco ----- #
+    def _spool(self, batch, count=True):
+        if self.sample_spool is not None:
+            samples = [record for record in batch if isinstance(record, tuple)]
+            if samples:
+                self._spool_samples(samples)
+                batch = [record for record in batch if not isinstance(record, tuple)]
+                if not batch:
+                    return
+        batch = _lines(batch)
+        try:
+            with open(self.spool_file, "a") as file:
+                file.write("\n".join(batch) + "\n")
+            if count:
+                with self._lock:
+                    self.stats["spooled"] += len(batch)
+        except OSError as e:
+            with self._lock:
+                self.stats["dropped"] += len(batch)
+            log.error("spool write failed", extra={"points": len(batch), "spool_file": self.spool_file, "error": str(e)})
+
+    def _spool_samples(self, samples):
+        try:
+            rejected = self.sample_spool.append(samples)
+        except OSError as e:
+            rejected = len(samples)
+            log.error("sample spool write failed", extra={"samples": len(samples), "directory": self.sample_spool.directory, "error": str(e)})
+        with self._lock:
+            self.stats["spooled"] += len(samples) - rejected
+            self.stats["dropped"] += rejected
+
+    def _replay_due(self):
+        ## Si riproduce solo se InfluxDB risponde (nessun backoff) o se il backoff è scaduto
+        return self.sample_spool.pending() and not (self._backoff and time.monotonic() < self._retry_at)
+
+    def _write_replayed(self, lines):
+        try:
+            self.write_fn(lines)
+        except Exception as e:
+            # Un batch rifiutato non si riprova: drain() passa ai record successivi
+            if not _rejected(e):
+                raise
+            self._on_rejected(len(lines), e)
+            return
+        with self._lock:
+            self.stats["replayed"] += len(lines)
+
+    def _run_replay(self):
+        ## Thread di riproduzione dello spool dei campioni, separato dal thread di scrittura
+        while not self._stop.wait(self.replay_interval):
+            if not self._replay_due():
+                continue
+            try:
+                replayed = self.sample_spool.drain(self._write_replayed, pressure_record, self.replay_batch_size)
+            except Exception as e:
+                self._on_failure(e)
+                continue
+            if replayed:
+                # InfluxDB ha accettato i dati: il percorso live esce dal backoff
+                self._backoff = 0.0
+                self._retry_at = 0.0
+                log.info("spooled samples replayed", extra={"samples": replayed})
+
+    def _replay_spool(self):
+        ## Riscrive su InfluxDB i record salvati su disco mentre il database non era raggiungibile
+        replay_file = self.spool_file + ".replay"
+        try:
+            os.replace(self.spool_file, replay_file)
+        except OSError:
+            return
+
+        with open(replay_file, "r") as file:
+            records = [line.rstrip("\n") for line in file if line.strip()]
+
+        for i in range(0, len(records), self.batch_size):
+            chunk = records[i:i + self.batch_size]
+            try:
+                self.write_fn(chunk)
+            except Exception as e:
+                if _rejected(e):
+                    self._on_rejected(len(chunk), e)
+                    continue
+                # Rimette su disco ciò che non è stato scritto e riprova più tardi
+                self._on_failure(e)
+                self._spool(records[i:], count=False)
+                break
+            with self._lock:
+                self.stats["replayed"] += len(chunk)
+
+        os.remove(replay_file)
+
+
+class AsyncIngestPipeline(IngestPipeline):
+    """Variante di IngestPipeline per asyncio: coda asyncio.Queue e write_fn coroutine.
+
+    Batch, backoff, spool su disco e statistiche sono gli stessi della versione a thread.
+    """
+
+    def __init__(self, write_fn, max_queue=10000, **kwargs):
+        super().__init__(write_fn, max_queue=max_queue, **kwargs)
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+        self._replay_task = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._stop.clear()
+            self._task = loop.create_task(self._run_async(), name="ingest-writer")
+        if self.sample_spool is not None and (self._replay_task is None or self._replay_task.done()):
+            self._replay_task = loop.create_task(self._run_replay_async(), name="ingest-replay")
+        return self
+
+    async def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                self._task.cancel()
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+        if self.sample_spool is not None:
+            self.sample_spool.close()
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+    async def _run_async(self):
+        while not (self._stop.is_set() and self.queue.empty()):
+            batch = await self._collect_batch_async()
+            if batch:
+                await self._flush_async(batch)
+
+    async def _collect_batch_async(self):
+        try:
+            first = await asyncio.wait_for(self.queue.get(), self.max_batch_age)
+        except asyncio.TimeoutError:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_batch_age
+        while len(batch) < self.batch_size:
+            # Prima prende ciò che è già in coda, poi attende fino alla scadenza del batch
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush_async(self, batch):
+        if time.monotonic() < self._retry_at:
+            self._spool(batch)
+            return
+
+        start = time.perf_counter()
+        try:
+            await self.write_fn(_lines(batch))
+        except Exception as e:
+            if _rejected(e):
+                self._on_rejected(len(batch), e)
+                return
+            self._on_failure(e)
+            self._spool(batch)
+            return
+
+        latency_ms = (time.perf_counter() - start) * 1000
+        self.stats["written"] += len(batch)
+        self.stats["flushes"] += 1
+        self.stats["last_flush_latency_ms"] = latency_ms
+        self.stats["max_flush_latency_ms"] = max(self.stats["max_flush_latency_ms"], latency_ms)
+        self._backoff = 0.0
+        self._retry_at = 0.0
+
+        if os.path.exists(self.spool_file):
+            await self._replay_spool_async()
+
+    async def _run_replay_async(self):
+        ## La lettura dei segmenti e la conversione in line protocol girano in un thread;
+        ## le scritture tornano sul loop, dove vive il client InfluxDB asincrono
+        loop = asyncio.get_running_loop()
+
+        def write(lines):
+            try:
+                asyncio.run_coroutine_threadsafe(self.write_fn(lines), loop).result()
+            except Exception as e:
+                if not _rejected(e):
+                    raise
+                self._on_rejected(len(lines), e)
+                return
+            with self._lock:
+                self.stats["replayed"] += len(lines)
+
+        while not self._stop.is_set():
+            await asyncio.sleep(self.replay_interval)
+            if not self._replay_due():
+                continue
+            try:
+                replayed = await asyncio.to_thread(self.sample_spool.drain, write, pressure_record,
+                                                   self.replay_batch_size)
+            except Exception as e:
+                self._on_failure(e)
+                continue
+            if replayed:
+                self._backoff = 0.0
+                self._retry_at = 0.0
+                log.info("spooled samples replayed", extra={"samples": replayed})
+
+    async def _replay_spool_async(self):
+        replay_file = self.spool_file + ".replay"
+        try:
+            os.replace(self.spool_file, replay_file)
+        except OSError:
+            return
+
+        with open(replay_file, "r") as file:
+            records = [line.rstrip("\n") for line in file if line.strip()]
+
+        for i in range(0, len(records), self.batch_size):
+            chunk = records[i:i + self.batch_size]
+            try:
+                await self.write_fn(chunk)
+            except Exception as e:
+                if _rejected(e):
+                    self._on_rejected(len(chunk), e)
+                    continue
+                self._on_failure(e)
+                self._spool(records[i:], count=False)
+                break
+            self.stats["replayed"] += len(chunk)
+
+        os.remove(replay_file)
+
+
+def _lines(batch):
+    ## I campioni accodati come tuple diventano line protocol solo al momento della scrittura
+    return [pressure_record(*record) if isinstance(record, tuple) else record for record in batch]
+
+
+class PathStats:
+    """Conteggio e latenza (invio dal dispositivo -> accodamento) per un percorso di ingest."""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._started = time.monotonic()
+        self.samples = 0
+
+    def record(self, sent_at_ms=None):
+        ## sent_at_ms è l'istante di invio dichiarato dal client, se presente:
+        ## un valore non numerico conta il campione ma non la latenza
+        latency = None
+        if sent_at_ms is not None and not isinstance(sent_at_ms, bool):
+            try:
+                latency = time.time() * 1000 - float(sent_at_ms)
+            except (TypeError, ValueError, OverflowError):
+                latency = None
+            if latency is not None and not math.isfinite(latency):
+                latency = None
+        with self._lock:
+            self.samples += 1
+            if latency is not None:
+                self._latencies.append(latency)
+
+    def get_stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                "samples": self.samples,
+                "rate_per_s": self.samples / max(time.monotonic() - self._started, 1e-9),
+            }
+        if latencies:
+            stats["latency_ms"] = {
+                "p50": latencies[len(latencies) // 2],
+                "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                "max": latencies[-1],
+            }
+        return stats
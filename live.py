@@ -0,0 +1,275 @@
+import asyncio
+import itertools
+import json
+import queue
+import threading
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+def sse_frame(event, data, event_id=None):
+    """Evento Server-Sent Events: `event` è il tipo, `data` viene serializzato in JSON su una riga."""
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+HEARTBEAT_FRAME = ": ping\n\n"
+EVICTED_FRAME = sse_frame("evicted", {"reason": "slow consumer"})
+
+
+class Subscriber:
+    """Client della dashboard: buffer limitato di frame SSE già serializzati.
+
+    device_ids e events (insiemi o None per tutti) filtrano cosa riceve il client.
+    Se il buffer è pieno il client viene escluso (evicted): la connessione si
+    chiude dopo l'ultimo frame e il browser (EventSource) si riconnette da solo,
+    ripartendo dallo snapshot.
+    """
+
+    def __init__(self, device_ids=None, events=None, buffer=256):
+        self.device_ids = device_ids
+        self.events = events
+        self.buffer = buffer
+        self.evicted = False
+        self.closed = False
+        self._frames = deque()
+        self._ready = threading.Condition()
+
+    def wants(self, event, device_id):
+        return (self.events is None or event in self.events) and \
+            (self.device_ids is None or device_id is None or device_id in self.device_ids)
+
+    def offer(self, frame):
+        ## Chiamato dal publisher; False se il client è troppo lento e va escluso
+        with self._ready:
+            if len(self._frames) >= self.buffer:
+                self.evicted = True
+                self._ready.notify()
+                return False
+            self._frames.append(frame)
+            self._ready.notify()
+        return True
+
+    def close(self):
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+
+    def _take(self):
+        frames = "".join(self._frames)
+        self._frames.clear()
+        return frames
+
+    def frames(self, heartbeat=15.0):
+        """Generatore dei frame da inviare: tutto ciò che è in buffer a ogni risveglio, o un heartbeat."""
+        while True:
+            with self._ready:
+                if not self._frames and not (self.evicted or self.closed):
+                    self._ready.wait(heartbeat)
+                frames = self._take()
+                evicted, closed = self.evicted, self.closed
+            if frames:
+                yield frames
+            if evicted:
+                yield EVICTED_FRAME
+                return
+            if closed:
+                return
+            if not frames:
+                yield HEARTBEAT_FRAME
+
+
+class LiveHub:
+    """Diffusione degli eventi live (pressione, occupazione, sveglie, configurazione) ai client SSE.
+
+    publish() non blocca: mette l'evento in una coda limitata (max_queue) e
+    restituisce subito; se non c'è nessun client connesso non fa nulla. Un solo
+    publisher (thread) prende gli eventi dalla coda, serializza ciascuno una
+    volta sola e copia il frame nei buffer dei client interessati. Ogni client ha
+    al massimo client_buffer frame in attesa: chi non li legge abbastanza in
+    fretta viene escluso invece di rallentare gli altri o far crescere la memoria.
+    """
+
+    subscriber_class = Subscriber
+
+    def __init__(self, client_buffer=256, max_queue=10000, max_clients=200, heartbeat=15.0):
+        self.client_buffer = client_buffer
+        self.max_clients = max_clients
+        self.heartbeat = heartbeat
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._clients = set()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"published": 0, "dropped": 0, "delivered": 0, "connected": 0, "rejected": 0, "evicted": 0}
+
+    # ----- Client ----- #
+    def subscribe(self, device_ids=None, events=None):
+        """Nuovo client, o None se è stato raggiunto max_clients."""
+        client = self.subscriber_class(device_ids, events, self.client_buffer)
+        with self._lock:
+            if len(self._clients) >= self.max_clients:
+                self.stats["rejected"] += 1
+                return None
+            self._clients.add(client)
+            self.stats["connected"] += 1
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    # ----- Pubblicazione ----- #
+    def publish(self, event, device_id, data):
+        """Accoda un evento per i client; restituisce False se non c'è nessuno o la coda è piena."""
+        if not self._clients:
+            return False
+        try:
+            self.queue.put_nowait((event, device_id, data))
+        except queue.Full:
+            with self._lock:
+                self.stats["dropped"] += 1
+            return False
+        return True
+
+    def fanout(self, event, device_id, data):
+        ## Serializza l'evento (una volta, solo se qualcuno lo vuole) e lo consegna ai client
+        with self._lock:
+            clients = list(self._clients)
+        frame = None
+        delivered = 0
+        evicted = []
+        for client in clients:
+            if not client.wants(event, device_id):
+                continue
+            if frame is None:
+                frame = sse_frame(event, {"device_id": device_id, **data}, next(self._ids))
+            if client.offer(frame):
+                delivered += 1
+            else:
+                evicted.append(client)
+        with self._lock:
+            self.stats["published"] += 1
+            self.stats["delivered"] += delivered
+            self.stats["evicted"] += len(evicted)
+            for client in evicted:
+                self._clients.discard(client)
+        if evicted:
+            log.warning("slow live clients evicted", extra={"clients": len(evicted)})
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["clients"] = len(self._clients)
+        stats["queue_depth"] = self.queue.qsize()
+        return stats
+
+    # ----- Thread del publisher ----- #
+    def start(self):
+        def run():
+            while not self._stop.is_set():
+                try:
+                    event, device_id, data = self.queue.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                try:
+                    self.fanout(event, device_id, data)
+                except Exception as e:
+                    log.error("live fanout failed", extra={"error": str(e)})
+
+        self._thread = threading.Thread(target=run, name="live-publisher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._close_all()
+
+    def _close_all(self):
+        with self._lock:
+            clients, self._clients = self._clients, set()
+        for client in clients:
+            client.close()
+
+
+class AsyncSubscriber(Subscriber):
+    """Variante di Subscriber per asyncio: il publisher gira sullo stesso event loop."""
+
+    def __init__(self, device_ids=None, events=None, buffer=256):
+        super().__init__(device_ids, events, buffer)
+        self._event = asyncio.Event()
+
+    def offer(self, frame):
+        if len(self._frames) >= self.buffer:
+            self.evicted = True
+            self._event.set()
+            return False
+        self._frames.append(frame)
+        self._event.set()
+        return True
+
+    def close(self):
+        self.closed = True
+        self._event.set()
+
+    async def frames(self, heartbeat=15.0):
+        while True:
+            if not self._frames and not (self.evicted or self.closed):
+                try:
+                    await asyncio.wait_for(self._event.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    pass
+            self._event.clear()
+            frames = self._take()
+            if frames:
+                yield frames
+            if self.evicted:
+                yield EVICTED_FRAME
+                return
+            if self.closed:
+                return
+            if not frames:
+                yield HEARTBEAT_FRAME
+
+
+class AsyncLiveHub(LiveHub):
+    """Variante di LiveHub per asyncio: coda asyncio.Queue e publisher come task sul loop."""
+
+    subscriber_class = AsyncSubscriber
+
+    def __init__(self, max_queue=10000, **kwargs):
+        super().__init__(max_queue=max_queue, **kwargs)
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+
+    def publish(self, event, device_id, data):
+        if not self._clients:
+            return False
+        try:
+            self.queue.put_nowait((event, device_id, data))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            return False
+        return True
+
+    def start(self):
+        async def run():
+            while True:
+                event, device_id, data = await self.queue.get()
+                try:
+                    self.fanout(event, device_id, data)
+                except Exception as e:
+                    log.error("live fanout failed", extra={"error": str(e)})
+
+        self._task = asyncio.get_running_loop().create_task(run(), name="live-publisher")
+        return self
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._close_all()
@@ -8,15 +8,24 @@
 #define SPEAKER_PIN 32          // Pin collegato allo speaker
 #define PRESSURE_SENSOR_PIN 33  // Pin collegato al sensore di pressione
 #define PRESSURE_THRESHOLD 4060 // Soglia per attivare LED e speaker
+#define TELEMETRY_OVER_MQTT 1   // 1 = invia i campioni via MQTT, 0 = via HTTP POST a /sensor_data
 
 // Configurazione porta MQTT
 const int mqtt_port = 1883;   
 
-// Configurazione topic MQTT
-const char* mqtt_topic_sampling_rate = "iot/bed_alarm/sampling_rate"; 
-const char* mqtt_topic_trigger_alarm = "iot/bed_alarm/trigger_alarm"; 
-const char* mqtt_topic_stop_alarm = "iot/bed_alarm/stop_alarm"; 
-const char* mqtt_topic_alarm_sound = "iot/bed_alarm/alarm_sound";
+// Identificativo del letto: deve essere unico per ogni dispositivo collegato al proxy
+// ("default" è il dispositivo usato dagli endpoint senza prefisso /devices/<device_id>)
+const char* device_id = "default";
+
+// Configurazione topic MQTT (iot/bed_alarm/<device_id>/<comando>)
+const String mqtt_topic_prefix = String("iot/bed_alarm/") + device_id;
+const String mqtt_topic_sampling_rate = mqtt_topic_prefix + "/sampling_rate";
+const String mqtt_topic_trigger_alarm = mqtt_topic_prefix + "/trigger_alarm";
+const String mqtt_topic_stop_alarm = mqtt_topic_prefix + "/stop_alarm";
+const String mqtt_topic_alarm_sound = mqtt_topic_prefix + "/alarm_sound";
+const String mqtt_topic_pressure = mqtt_topic_prefix + "/pressure";
+const String mqtt_topic_ack = mqtt_topic_prefix + "/ack";        // conferme dei comandi ({"cmd_id": ...})
+const String mqtt_topic_status = mqtt_topic_prefix + "/status";  // "online" / "offline" (last will), retained
 
 WiFiClient espClient;          
 PubSubClient client(espClient); 
@@ -27,6 +36,10 @@ unsigned long last_sample_time = 0;
 unsigned long sampling_rate = 5000;
 unsigned int alarm_sound = 1; 
 
+// Ultimo trigger_alarm eseguito: il proxy ritenta i comandi non confermati,
+// un trigger già ricevuto viene solo riconfermato
+long last_trigger_cmd_id = -1;
+
 // Variabili per il calcolo della media dei valori del sensore
 long pressureSum = 0;              
 unsigned int pressureCount = 0;    
@@ -74,8 +87,12 @@ void loop() {
     // Gestione dell'allarme
     handleAlert(pressureAverage);
 
-    // Invio dei dati al server e misurazione della latenza
-    sendPressureData(pressureAverage);
+    // Invio dei dati al server (sulla connessione MQTT già aperta oppure via HTTP)
+    if (TELEMETRY_OVER_MQTT) {
+      publishPressureData(pressureAverage);
+    } else {
+      sendPressureData(pressureAverage);
+    }
 
     // Reset dei contatori per il prossimo intervallo
     pressureSum = 0;
@@ -99,14 +116,19 @@ void connectToWiFi() {
 void connectToMQTT() {
   while (!client.connected()) {
     Serial.print("Connecting to MQTT...");
-    if (client.connect("ESP32Client")) { 
+    // Last will: se la connessione cade il broker pubblica "offline" al posto del dispositivo
+    if (client.connect(device_id, mqtt_topic_status.c_str(), 1, true, "offline")) { 
       Serial.println("connected");
 
-      // Sottoscrizione ai topic MQTT
-      client.subscribe(mqtt_topic_sampling_rate);
-      client.subscribe(mqtt_topic_trigger_alarm);
-      client.subscribe(mqtt_topic_stop_alarm);
-      client.subscribe(mqtt_topic_alarm_sound);
+      // Sottoscrizione ai topic MQTT con QoS 1: sampling_rate e alarm_sound sono retained
+      // e arrivano subito dopo ogni riconnessione
+      client.subscribe(mqtt_topic_sampling_rate.c_str(), 1);
+      client.subscribe(mqtt_topic_trigger_alarm.c_str(), 1);
+      client.subscribe(mqtt_topic_stop_alarm.c_str(), 1);
+      client.subscribe(mqtt_topic_alarm_sound.c_str(), 1);
+
+      // Segnala al proxy la riconnessione, così ripubblica subito i comandi non confermati
+      client.publish(mqtt_topic_status.c_str(), "online", true);
     } else {
       Serial.print("failed, rc=");
       Serial.print(client.state());
@@ -137,6 +159,13 @@ void mqttCallback(char* topic, byte* payload, unsigned int length) {
     return;
   }
 
+  // Conferma al proxy la ricezione del comando
+  long cmd_id = doc["cmd_id"] | -1L;
+  if (cmd_id >= 0) {
+    String ack = "{\"cmd_id\": " + String(cmd_id) + "}";
+    client.publish(mqtt_topic_ack.c_str(), ack.c_str());
+  }
+
   // Gestione dei messaggi ricevuti dai topic MQTT
   if (doc.containsKey("sampling_rate")) {
     int new_sampling_rate = doc["sampling_rate"];
@@ -146,7 +175,11 @@ void mqttCallback(char* topic, byte* payload, unsigned int length) {
   }
 
   if (doc.containsKey("trigger_alarm")) {
-    alert_active = true;
+    // Un ritentativo dello stesso trigger (conferma persa) non riattiva l'allarme
+    if (cmd_id < 0 || cmd_id != last_trigger_cmd_id) {
+      alert_active = true;
+      last_trigger_cmd_id = cmd_id;
+    }
   }
 
   if (doc.containsKey("stop_alarm")) {
@@ -161,13 +194,21 @@ void mqttCallback(char* topic, byte* payload, unsigned int length) {
   }
 }
 
+// Funzione per pubblicare i dati sul topic di telemetria MQTT
+void publishPressureData(int pressureValue) {
+  String payload = "{\"pressure_value\": " + String(pressureValue) + "}";
+  if (!client.publish(mqtt_topic_pressure.c_str(), payload.c_str())) {
+    Serial.println("Errore nella pubblicazione dei dati MQTT");
+  }
+}
+
 // Funzione per inviare i dati al server Flask e misurare la latenza
 void sendPressureData(int pressureValue) {
   if (WiFi.status() == WL_CONNECTED) {
     HTTPClient http;
     http.begin(serverName);
     http.addHeader("Content-Type", "application/json");
-    String payload = "{\"pressure_value\": " + String(pressureValue) + "}";
+    String payload = "{\"device_id\": \"" + String(device_id) + "\", \"pressure_value\": " + String(pressureValue) + "}";
     
     // Registra il tempo prima dell'invio
     unsigned long tStart = millis();
@@ -0,0 +1,216 @@
+"""Metriche in formato Prometheus e logging strutturato per il proxy.
+
+Le metriche sono tenute in memoria (contatori e istogrammi a bucket fissi, con
+etichette) e vengono esposte da /metrics nel formato testuale di Prometheus.
+Le statistiche già raccolte dai componenti (ingest, scheduler, cache meteo)
+vengono lette solo al momento dello scrape tramite collector.
+
+Il logging sostituisce i print: ogni riga è un oggetto JSON con i campi passati
+in `extra`, e un filtro limita i messaggi ripetuti per non pagare su stdout il
+costo di un log per campione.
+"""
+import json
+import logging
+import math
+import threading
+import time
+
+
+# Bucket (secondi) per le latenze delle richieste e delle scritture
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series = {}  # etichette -> [conteggi per bucket, somma, totale]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        # Ricerca lineare: i bucket sono pochi e le latenze tipiche cadono nei primi
+        index = 0
+        while value > self.buckets[index]:
+            index += 1
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items())
+        names = self.label_names + ("le",)
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (_number(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(self.prefix + name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self.prefix + name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collect_stats(self, name, get_stats):
+        """Espone come gauge i valori numerici di un get_stats() (dizionari annidati appiattiti con '_')."""
+        self._collectors.append((self.prefix + name, get_stats))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, get_stats in self._collectors:
+            try:
+                stats = get_stats()
+            except Exception as e:
+                logging.getLogger(__name__).warning("stats collector failed", extra={"collector": name, "error": str(e)})
+                continue
+            for key, value in _flatten(stats):
+                metric = f"{name}_{key}"
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _flatten(stats, prefix=""):
+    for key, value in stats.items():
+        key = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{key}_")
+        elif isinstance(value, bool):
+            yield key, int(value)
+        elif isinstance(value, (int, float)):
+            yield key, value
+
+
+# ----- Logging ----- #
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Una riga JSON per record: timestamp, livello, logger, messaggio e i campi di `extra`."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lascia passare al massimo `burst` record per messaggio ogni `interval` secondi.
+
+    Il messaggio è il template non formattato (record.msg), per cui i log con lo
+    stesso testo e campi diversi in `extra` contano insieme. Alla riapertura
+    della finestra il primo record riporta quanti ne sono stati soppressi.
+    ERROR e CRITICAL non vengono mai filtrati.
+    """
+
+    def __init__(self, interval=10.0, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}  # (logger, msg) -> [inizio finestra, emessi, soppressi]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def configure_logging(level="INFO", json_lines=True, interval=10.0, burst=5):
+    """Configura il logger root con output JSON e limite sui messaggi ripetuti."""
+    handler = logging.StreamHandler()
+    if json_lines:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler.addFilter(RateLimitFilter(interval, burst))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
@@ -0,0 +1,194 @@
+import json
+import math
+import os
+import threading
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+# Feature calcolate sulla finestra mobile di ogni dispositivo (stesse definizioni usate in training.py)
+FEATURES = ("value", "mean", "min", "max", "std", "delta")
+
+# Modello di default equivalente alla soglia del firmware (PRESSURE_THRESHOLD in main.ino) sulla media
+DEFAULT_MODEL = {
+    "type": "tree",
+    "window": 5,
+    "features": ["mean"],
+    "feature": [0, -1, -1],
+    "threshold": [4060.0, 0.0, 0.0],
+    "left": [1, -1, -1],
+    "right": [2, -1, -1],
+    "value": [0.0, 0.0, 1.0],
+}
+
+
+class TreeModel:
+    """Albero di decisione compilato in array paralleli (formato di sklearn.tree_).
+
+    Un nodo con left == -1 è una foglia e value contiene la probabilità di letto occupato.
+    """
+
+    def __init__(self, spec):
+        self.feature = [int(f) for f in spec["feature"]]
+        self.threshold = [float(t) for t in spec["threshold"]]
+        self.left = [int(n) for n in spec["left"]]
+        self.right = [int(n) for n in spec["right"]]
+        self.value = [float(v) for v in spec["value"]]
+
+    def predict_proba(self, x):
+        node = 0
+        left, right, feature, threshold = self.left, self.right, self.feature, self.threshold
+        while left[node] != -1:
+            node = left[node] if x[feature[node]] <= threshold[node] else right[node]
+        return self.value[node]
+
+
+class LogisticModel:
+    """Regressione logistica con standardizzazione delle feature: p = sigmoid(w·(x-mean)/scale + b)."""
+
+    def __init__(self, spec):
+        self.weights = [float(w) for w in spec["weights"]]
+        self.bias = float(spec["bias"])
+        n = len(self.weights)
+        self.mean = [float(m) for m in spec.get("mean", [0.0] * n)]
+        self.scale = [float(s) or 1.0 for s in spec.get("scale", [1.0] * n)]
+
+    def predict_proba(self, x):
+        z = self.bias
+        for xi, w, m, s in zip(x, self.weights, self.mean, self.scale):
+            z += w * (xi - m) / s
+        if z < -60:
+            return 0.0
+        return 1.0 / (1.0 + math.exp(-z))
+
+
+MODEL_TYPES = {"tree": TreeModel, "logistic": LogisticModel}
+
+
+def load_model(model_file=None):
+    """Carica la specifica del modello da JSON; se il file non esiste usa DEFAULT_MODEL."""
+    spec = DEFAULT_MODEL
+    if model_file and os.path.exists(model_file):
+        try:
+            with open(model_file, "r") as file:
+                spec = json.load(file)
+            log.info("occupancy model loaded", extra={"model_file": model_file})
+        except (OSError, json.JSONDecodeError) as e:
+            log.error("occupancy model not loaded, using default", extra={"model_file": model_file, "error": str(e)})
+            spec = DEFAULT_MODEL
+
+    unknown = [name for name in spec["features"] if name not in FEATURES]
+    if unknown or spec["type"] not in MODEL_TYPES:
+        raise ValueError(f"Unsupported occupancy model: type={spec['type']}, features={unknown}")
+    return spec
+
+
+class _DeviceWindow:
+    __slots__ = ("values", "total", "total_sq", "occupied", "probability", "streak", "since")
+
+    def __init__(self, window):
+        self.values = deque(maxlen=window)
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.occupied = None
+        self.probability = 0.0
+        self.streak = 0
+        self.since = None
+
+
+class OccupancyEngine:
+    """Classificatore in streaming dell'occupazione del letto, per dispositivo.
+
+    Ogni campione aggiorna la finestra mobile del dispositivo (somme correnti,
+    O(1) per media e deviazione standard), calcola le feature richieste dal
+    modello e applica un'isteresi: lo stato passa a "occupato" solo dopo
+    `confirm` campioni consecutivi con probabilità >= on_threshold e torna
+    "libero" dopo `confirm` campioni con probabilità <= off_threshold.
+    """
+
+    def __init__(self, spec=None, on_threshold=0.7, off_threshold=0.3, confirm=2):
+        spec = spec or DEFAULT_MODEL
+        self.spec = spec
+        self.model = MODEL_TYPES[spec["type"]](spec)
+        self.window = int(spec.get("window", 5))
+        self.features = [FEATURES.index(name) for name in spec["features"]]
+        self.on_threshold = on_threshold
+        self.off_threshold = off_threshold
+        self.confirm = confirm
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def _features(self, state, value, previous):
+        values = state.values
+        n = len(values)
+        mean = state.total / n
+        variance = max(state.total_sq / n - mean * mean, 0.0)
+        all_features = (
+            value,
+            mean,
+            min(values),
+            max(values),
+            math.sqrt(variance),
+            value - previous if previous is not None else 0.0,
+        )
+        return [all_features[i] for i in self.features]
+
+    def update(self, device_id, value, timestamp=None):
+        """Aggiorna lo stato del dispositivo con un nuovo campione.
+
+        Restituisce un dizionario con il nuovo stato se c'è stata una transizione,
+        altrimenti None.
+        """
+        value = float(value)
+        with self._lock:
+            state = self._devices.get(device_id)
+            if state is None:
+                state = self._devices[device_id] = _DeviceWindow(self.window)
+
+            values = state.values
+            previous = values[-1] if values else None
+            if len(values) == values.maxlen:
+                old = values[0]
+                state.total -= old
+                state.total_sq -= old * old
+            values.append(value)
+            state.total += value
+            state.total_sq += value * value
+
+            probability = self.model.predict_proba(self._features(state, value, previous))
+            state.probability = probability
+
+            if probability >= self.on_threshold:
+                candidate = True
+            elif probability <= self.off_threshold:
+                candidate = False
+            else:
+                state.streak = 0
+                return None
+
+            if candidate == state.occupied:
+                state.streak = 0
+                return None
+
+            # Il primo campione di un dispositivo fissa lo stato iniziale senza conferma
+            state.streak += 1
+            if state.occupied is not None and state.streak < self.confirm:
+                return None
+
+            state.occupied = candidate
+            state.streak = 0
+            state.since = timestamp
+            return {"device_id": device_id, "occupied": candidate, "probability": probability, "timestamp": timestamp}
+
+    def state(self, device_id):
+        state = self._devices.get(device_id)
+        if state is None:
+            return None
+        return {
+            "device_id": device_id,
+            "occupied": state.occupied,
+            "probability": state.probability,
+            "since": state.since,
+        }
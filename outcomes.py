@@ -0,0 +1,204 @@
+import threading
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# Esiti di una sveglia
+GOT_UP, MISSED, NOT_IN_BED = "got_up", "missed", "not_in_bed"
+
+
+class _Session:
+    __slots__ = ("alarm_id", "fired", "got_up", "last_up", "snoozes", "stopped")
+
+    def __init__(self, alarm_id, fired):
+        self.alarm_id = alarm_id
+        self.fired = fired       # ns
+        self.got_up = None       # prima uscita dal letto dopo il trigger (ns)
+        self.last_up = None      # ultima uscita dal letto, None se l'utente è (tornato) a letto
+        self.snoozes = 0
+        self.stopped = None      # stop manuale (Telegram/HTTP) arrivato con l'utente ancora a letto
+
+
+class AlarmOutcomes:
+    """Esito di ogni sveglia ricavato dal flusso di occupazione del letto.
+
+    Al trigger si apre una sessione per il dispositivo; le transizioni di
+    occupazione successive dicono quando l'utente si è alzato. Se torna a letto
+    prima di essere rimasto in piedi per `settle` secondi il rientro conta come
+    snooze e si attende la successiva uscita. La sessione si chiude quando
+    l'utente resta fuori dal letto per `settle` secondi (got_up, con latenza
+    dall'ultima uscita), oppure dopo `timeout` secondi senza che si sia alzato
+    (missed). Se al trigger il letto è già libero l'esito è not_in_bed.
+
+    Ogni esito aggiorna un riepilogo per dispositivo (conteggi, somma/min/max
+    delle latenze e ultimi `recent` esiti), mantenuto in modo incrementale:
+    on_outcome(device_id, esito, riepilogo) lo riceve per salvarlo.
+    """
+
+    def __init__(self, settle=300.0, timeout=3600.0, recent=20, clock=time.time_ns):
+        self.settle = settle
+        self.timeout = timeout
+        self.recent = recent
+        self.clock = clock
+        self._sessions = {}   # device_id -> _Session aperta
+        self._summaries = {}  # device_id -> riepilogo
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"fired": 0, "got_up": 0, "missed": 0, "not_in_bed": 0, "snoozes": 0}
+
+    # ----- Eventi ----- #
+    def fired(self, device_id, alarm_id, timestamp, occupied):
+        """Trigger di una sveglia; occupied è lo stato del letto in quel momento (None se sconosciuto).
+
+        Restituisce gli esiti chiusi da questo evento, come tick().
+        """
+        finished = []
+        with self._lock:
+            self.stats["fired"] += 1
+            # Una sveglia che suona mentre la precedente è ancora aperta chiude quella
+            previous = self._sessions.pop(device_id, None)
+            if previous is not None:
+                finished.append(self._finish(device_id, previous))
+            session = _Session(alarm_id, timestamp)
+            if occupied is False:
+                finished.append(self._record(device_id, session, NOT_IN_BED))
+            else:
+                self._sessions[device_id] = session
+        return finished
+
+    def transition(self, device_id, occupied, timestamp):
+        with self._lock:
+            session = self._sessions.get(device_id)
+            # Campioni arrivati in ritardo, precedenti al trigger, non contano
+            if session is None or timestamp < session.fired:
+                return
+            if not occupied:
+                if session.last_up is None:
+                    session.last_up = timestamp
+                    if session.got_up is None:
+                        session.got_up = timestamp
+            elif session.last_up is not None:
+                session.last_up = None
+                session.snoozes += 1
+
+    def stopped(self, device_id, timestamp):
+        ## Allarme fermato a mano: conta solo se l'utente non si era ancora alzato
+        with self._lock:
+            session = self._sessions.get(device_id)
+            if session is not None and session.stopped is None and session.last_up is None:
+                session.stopped = timestamp
+
+    # ----- Chiusura delle sessioni ----- #
+    def tick(self, now=None):
+        """Chiude le sessioni concluse; restituisce [(device_id, esito, riepilogo)]."""
+        now = now or self.clock()
+        settle, timeout = int(self.settle * 1e9), int(self.timeout * 1e9)
+        finished = []
+        with self._lock:
+            for device_id, session in list(self._sessions.items()):
+                settled = session.last_up is not None and now - session.last_up >= settle
+                if settled or now - session.fired >= timeout:
+                    del self._sessions[device_id]
+                    finished.append(self._finish(device_id, session))
+        return finished
+
+    def _finish(self, device_id, session):
+        if session.last_up is not None:
+            return self._record(device_id, session, GOT_UP)
+        return self._record(device_id, session, MISSED)
+
+    def _record(self, device_id, session, result):
+        outcome = {
+            "alarm_id": session.alarm_id,
+            "fired_at": session.fired // 1_000_000,
+            "outcome": result,
+            "latency_s": (session.last_up - session.fired) / 1e9 if result == GOT_UP else None,
+            "first_get_up_s": (session.got_up - session.fired) / 1e9 if session.got_up is not None else None,
+            "snoozes": session.snoozes,
+            "stopped_manually": session.stopped is not None,
+        }
+        summary = self._summaries.get(device_id)
+        if summary is None:
+            summary = self._summaries[device_id] = self._empty_summary()
+        summary["alarms"] += 1
+        summary[result] += 1
+        summary["snoozes"] += session.snoozes
+        summary["manual_stops"] += int(outcome["stopped_manually"])
+        if result == GOT_UP:
+            latency = outcome["latency_s"]
+            summary["latency_sum_s"] += latency
+            summary["latency_min_s"] = latency if summary["latency_min_s"] is None else min(summary["latency_min_s"], latency)
+            summary["latency_max_s"] = latency if summary["latency_max_s"] is None else max(summary["latency_max_s"], latency)
+        summary["recent"] = ([outcome] + summary["recent"])[:self.recent]
+        self.stats[result] += 1
+        self.stats["snoozes"] += session.snoozes
+        return device_id, outcome, self._view(summary)
+
+    @staticmethod
+    def _empty_summary():
+        return {"alarms": 0, GOT_UP: 0, MISSED: 0, NOT_IN_BED: 0, "snoozes": 0, "manual_stops": 0,
+                "latency_sum_s": 0.0, "latency_min_s": None, "latency_max_s": None, "recent": []}
+
+    @staticmethod
+    def _view(summary):
+        view = dict(summary, recent=list(summary["recent"]))
+        view["latency_mean_s"] = summary["latency_sum_s"] / summary[GOT_UP] if summary[GOT_UP] else None
+        view["snoozes_per_alarm"] = summary["snoozes"] / summary["alarms"] if summary["alarms"] else None
+        return view
+
+    # ----- Lettura e persistenza ----- #
+    def load(self, summaries):
+        """Riepiloghi salvati (device_id -> riepilogo), ad esempio all'avvio o all'acquisizione di uno shard."""
+        with self._lock:
+            for device_id, summary in summaries.items():
+                empty = self._empty_summary()
+                self._summaries[device_id] = {**empty, **{key: summary[key] for key in empty if key in summary}}
+
+    def forget(self, device_id):
+        with self._lock:
+            self._sessions.pop(device_id, None)
+            self._summaries.pop(device_id, None)
+
+    def summary(self, device_id):
+        """Riepilogo del dispositivo, con la sessione eventualmente in corso."""
+        now = self.clock()
+        with self._lock:
+            summary = self._summaries.get(device_id)
+            view = self._view(summary if summary is not None else self._empty_summary())
+            session = self._sessions.get(device_id)
+            if session is not None:
+                view["open"] = {
+                    "alarm_id": session.alarm_id,
+                    "fired_at": session.fired // 1_000_000,
+                    "elapsed_s": (now - session.fired) / 1e9,
+                    "out_of_bed": session.last_up is not None,
+                    "snoozes": session.snoozes,
+                }
+        view.pop("latency_sum_s")
+        return {"device_id": device_id, **view}
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, "open": len(self._sessions), "devices": len(self._summaries)}
+
+    # ----- Thread di chiusura ----- #
+    def start(self, on_outcome, interval=10.0):
+        """Esegue tick() ogni `interval` secondi e chiama on_outcome(device_id, esito, riepilogo)."""
+        def run():
+            while not self._stop.wait(interval):
+                for device_id, outcome, summary in self.tick():
+                    try:
+                        on_outcome(device_id, outcome, summary)
+                    except Exception as e:
+                        log.error("alarm outcome handler failed", extra={"error": str(e)})
+
+        self._thread = threading.Thread(target=run, name="alarm-outcomes", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -1,315 +1,517 @@
-from datetime import datetime
-import random
-import threading
 import time
-from flask import Flask, request, jsonify, render_template
-from influxdb_client import InfluxDBClient, Point, WriteOptions
+# Inizio dell'import del modulo: /readyz riporta il tempo da qui a quando il proxy è pronto
+IMPORT_STARTED = time.perf_counter()
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import logging
+import random
+from flask import Flask, request, jsonify, render_template, g
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import SYNCHRONOUS
 import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
 import os
 import json
-from utils import get_weather_data, load_alarms_from, save_alarms_to
+import signal
+import sys
+import threading
+import requests
+from ingest import IngestPipeline
+from devices import InvalidDeviceId, DEFAULT_DEVICE_ID, TOPIC_PREFIX
+from scheduler import AlarmScheduler
+from alarm_store import InvalidQuery
+from live import LiveHub, sse_frame
+from observability import configure_logging
+from timeseries import PRESSURE_QUERY, OCCUPANCY_QUERY, history_from_tables
+from service import (ProxyService, Result, ingest_settings, live_settings, scheduler_settings,
+                     FORWARD_HEADER, HOP_BY_HOP_HEADERS, DEFAULT_ALARM_SOUND, mqtt_topic_pressure, mqtt_topic_ack,
+                     mqtt_topic_status)
 
 
 # Carica le variabili d'ambiente
 load_dotenv(".env")
 
-
-# Configurazione API_KEY OpenWeatherMap
-WEATHER_API_KEY = os.getenv("weather_api_key")
+log = logging.getLogger("proxy")
 
 
 # Configurazione di InfluxDB
 token = os.getenv("token")
 org = "IotAlarmSystem"
 bucket = "Prova"
-client = InfluxDBClient(url="http://localhost:8086", token=token, org=org)
-write_api = client.write_api(write_options=WriteOptions(batch_size=1))
+influx_url = os.getenv("influx_url", "http://localhost:8086")
+# Client creati da create_app(), non all'import
+client = None
+write_api = None
+query_api = None
+
+
+def connect_influx():
+    global client, write_api, query_api
+    # Il pool di connessioni è condiviso da scritture e query di lettura (/pressure)
+    client = InfluxDBClient(url=influx_url, token=token, org=org,
+                            connection_pool_maxsize=int(os.getenv("influx_pool_size", 10)),
+                            timeout=int(float(os.getenv("influx_timeout", 10)) * 1000))
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+    query_api = client.query_api()
+
+
+def check_influx():
+    ## Ping di InfluxDB: all'avvio apre la prima connessione del pool, poi serve a /readyz
+    try:
+        ok = client.ping()
+    except Exception:
+        ok = False
+    service.set_ready("influxdb", ok)
+    return ok
+
+
+# Pipeline di ingest: i campioni vengono accodati e scritti a batch da un thread in background
+def write_batch(records):
+    start = time.perf_counter()
+    try:
+        write_api.write(bucket=bucket, record=records)
+    except Exception:
+        influx_writes.inc("error")
+        raise
+    finally:
+        influx_latency.observe(time.perf_counter() - start)
+    influx_writes.inc("ok")
+
+
+# Legge da InfluxDB l'intervallo [since, until) (ns) non coperto dalla memoria
+def query_history(device_id, since, until):
+    params = {
+        "_bucket": bucket,
+        "_device": device_id,
+        "_start": datetime.fromtimestamp(since / 1e9, timezone.utc),
+        "_stop": datetime.fromtimestamp(until / 1e9, timezone.utc),
+    }
+    start = time.perf_counter()
+    try:
+        pressure = query_api.query(PRESSURE_QUERY, params=params)
+        occupancy = query_api.query(OCCUPANCY_QUERY, params=params)
+    except Exception:
+        influx_queries.inc("error")
+        raise
+    finally:
+        influx_query_latency.observe(time.perf_counter() - start)
+    influx_queries.inc("ok")
+    return history_from_tables(pressure, occupancy)
+
+
+# ----- Alarm clock ----- #
+# Callback dello scheduler: chiamata una volta per ogni sveglia nel minuto in cui deve suonare
+def trigger_alarm(key, alarm, fire_time):
+    device = service.alarm_device(key, alarm)
+    if device is None:
+        return None
+    # Il meteo è già in cache grazie al prefetch: nessuna chiamata di rete prima della pubblicazione
+    try:
+        sound = service.alarm_sound(device.weather_location, stale_ok=True)
+    except Exception as e:
+        # Un errore del meteo non deve mai impedire alla sveglia di suonare
+        log.error("alarm sound lookup failed", extra={"device_id": device.device_id, "error": str(e)})
+        sound = DEFAULT_ALARM_SOUND
+    perform(service.ring(device, sound))
+    published_at = datetime.now()
+    perform(service.alarm_fired(device, key, alarm, fire_time, published_at))
+    return published_at
+
+
+# Callback dello scheduler: scarica in background il meteo per le sveglie in arrivo
+def prefetch_weather(key, alarm, fire_time):
+    location = service.prefetch_location(alarm)
+    if location:
+        prefetch_executor.submit(service.weather_cache.get, location)
+
+
+prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="weather-prefetch")
+
+
+# Stato e logica del proxy (vedi service.py): qui restano Flask, paho e il client InfluxDB
+service = ProxyService(
+    IngestPipeline(write_batch, **ingest_settings()),
+    # Eventi live per la dashboard (SSE su /live): un solo publisher, buffer limitato per client
+    LiveHub(**live_settings()),
+    AlarmScheduler(trigger_alarm, on_prefetch=prefetch_weather, **scheduler_settings()),
+    started_at=IMPORT_STARTED,
+)
+live = service.live
+
+# Metriche esposte su /metrics (formato Prometheus); le statistiche dei componenti le registra il servizio
+metrics = service.metrics
+http_requests = metrics.counter("http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+http_latency = metrics.histogram("http_request_duration_seconds", "HTTP request latency by route", ("route",))
+influx_writes = metrics.counter("influx_writes_total", "InfluxDB batch writes by result", ("result",))
+influx_latency = metrics.histogram("influx_write_duration_seconds", "InfluxDB batch write latency")
+influx_queries = metrics.counter("influx_queries_total", "InfluxDB history queries by result", ("result",))
+influx_query_latency = metrics.histogram("influx_query_duration_seconds", "InfluxDB history query latency")
+mqtt_publishes = metrics.counter("mqtt_publish_total", "MQTT messages published by command and result", ("command", "result"))
+
+
+# Modalità cluster (opzionale): con cluster_db più processi si dividono i dispositivi per shard,
+# coordinandosi con lease su un file SQLite condiviso (vedi cluster.py)
+port = int(os.getenv("port", 5000))
+forward_session = requests.Session()
 
 
 # Configurazione MQTT
-mqtt_broker = "localhost"
-mqtt_port = 1883
-mqtt_topic_sampling_rate = "iot/bed_alarm/sampling_rate"
-mqtt_topic_stop_alarm = "iot/bed_alarm/stop_alarm"
-mqtt_topic_alarm_sound = "iot/bed_alarm/alarm_sound"  
-mqtt_topic_trigger_alarm = "iot/bed_alarm/trigger_alarm"
-
-
-# Variabili globali con valori di default
-sampling_rate = 5  
-stop_alarm = False
-alarm_sound = 1 
-weather_location = "Bologna"  
-
-# Caricamento delle sveglie da file
-alarm_filename = "alarms.json" 
-alarms = []  
+# I topic sono per dispositivo: iot/bed_alarm/<device_id>/<comando> (vedi Device.topic)
+mqtt_broker = os.getenv("mqtt_broker", "localhost")
+mqtt_port = int(os.getenv("mqtt_port", 1883))
 
 
 # Callback MQTT
 def on_connect(client, userdata, flags, rc):
     client.subscribe("iot/bed_alarm")
+    client.subscribe(f"{TOPIC_PREFIX}/+/{mqtt_topic_pressure}")
+    client.subscribe(f"{TOPIC_PREFIX}/+/{mqtt_topic_ack}", qos=1)
+    client.subscribe(f"{TOPIC_PREFIX}/+/{mqtt_topic_status}", qos=1)
+    service.set_ready("mqtt", rc == 0)
+
+
+def on_disconnect(client, userdata, rc):
+    service.set_ready("mqtt", False)
+    if rc != 0:
+        log.warning("mqtt connection lost", extra={"rc": rc})
+
+
+# Conferma di un comando dal firmware: {"cmd_id": ...}
+def on_ack_message(client, userdata, msg):
+    service.on_ack(msg.topic, msg.payload)
+
+
+# Stato della connessione del firmware (retained, "offline" è il last will)
+def on_status_message(client, userdata, msg):
+    service.on_status(msg.topic, msg.payload)
+
+
+# Telemetria via MQTT: iot/bed_alarm/<device_id>/pressure con payload {"pressure_value": ...} o un numero
+def on_pressure_message(client, userdata, msg):
+    perform(service.on_pressure(msg.topic, msg.payload))
 
-mqtt_client = mqtt.Client(f"PythonClient-{random.randint(1000, 9999)}")
+mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"PythonClient-{random.randint(1000, 9999)}")
 mqtt_client.on_connect = on_connect
-mqtt_client.connect(mqtt_broker, mqtt_port, 60)
-mqtt_client.loop_start()
+mqtt_client.on_disconnect = on_disconnect
+mqtt_client.message_callback_add(f"{TOPIC_PREFIX}/+/{mqtt_topic_pressure}", on_pressure_message)
+mqtt_client.message_callback_add(f"{TOPIC_PREFIX}/+/{mqtt_topic_ack}", on_ack_message)
+mqtt_client.message_callback_add(f"{TOPIC_PREFIX}/+/{mqtt_topic_status}", on_status_message)
+
+
+def connect_mqtt():
+    # Connessione nel thread di paho: l'avvio non aspetta il broker e, se manca, paho ritenta da solo
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=30)
+    mqtt_client.connect_async(mqtt_broker, mqtt_port, 60)
+    mqtt_client.loop_start()
+
+
+# Pubblica con QoS 1 sul topic di un dispositivo, contando gli esiti per /metrics
+def publish(topic, payload, retain=False):
+    command = topic.rsplit("/", 1)[-1]
+    info = mqtt_client.publish(topic, json.dumps(payload), qos=1, retain=retain)
+    result = "ok" if info.rc == mqtt.MQTT_ERR_SUCCESS else "error"
+    mqtt_publishes.inc(command, result)
+    if result == "error":
+        # Il comando resta in attesa in CommandDelivery e verrà ripubblicato
+        log.warning("mqtt publish failed", extra={"topic": topic, "rc": info.rc})
+    return info
+
+
+# Invia un comando al firmware e ne traccia la consegna fino alla conferma
+def send_command(device, command, payload):
+    topic, message, retain = service.commands.prepare(device, command, payload)
+    return publish(topic, message, retain)
+
+
+# Esegue l'I/O chiesto dal servizio: comandi e messaggi MQTT (paho non blocca), scritture su AlarmDB
+def perform(result):
+    for device, command, payload in result.commands:
+        send_command(device, command, payload)
+    for topic, payload, retain in result.messages:
+        publish(topic, payload, retain)
+    for write, args in result.writes:
+        write(*args)
+    for owner_url, device_id, samples in result.forwards:
+        forward_samples(result, owner_url, device_id, samples)
+    return result
+
+
+def forward_samples(result, owner_url, device_id, samples):
+    ## Campioni di shard di altri worker, inoltrati come batch JSON al proprietario
+    try:
+        response = forward_session.post(f"{owner_url}/devices/{device_id}/sensor_data/batch", json={"samples": samples},
+                                        headers={FORWARD_HEADER: service.cluster.worker_id}, timeout=10)
+    except requests.RequestException as e:
+        return service.forward_failed(result, owner_url, device_id, str(e))
+    if response.status_code != 201:
+        service.forward_failed(result, owner_url, device_id, f"HTTP {response.status_code}")
+
+
+def respond(result):
+    perform(result)
+    body = result.body if isinstance(result.body, str) else jsonify(result.body)
+    return body, result.status, result.headers
 
 
 # Inizializza Flask
 app = Flask(__name__)
 
 
-# Endpoint per aggiornare il sampling rate
-@app.route('/update_sampling_rate', methods=['POST'])
-def update_sampling_rate():
-    global sampling_rate
-    data = request.json
-    if 'sampling_rate' in data:
-        sampling_rate = int(data['sampling_rate'])
-        mqtt_client.publish(mqtt_topic_sampling_rate, json.dumps({"sampling_rate": sampling_rate}))
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+# In modalità cluster le richieste per un dispositivo di un altro shard vanno al worker proprietario
+@app.before_request
+def route_to_owner():
+    device_id = (request.view_args or {}).get("device_id")
+    if device_id is None:
+        return None
+    owner = service.route(device_id, forwarded=bool(request.headers.get(FORWARD_HEADER)))
+    if owner is None:
+        return None
+    if isinstance(owner, Result):
+        # Shard in transizione (lease scaduto o non ancora acquisito): il client ritenta
+        return respond(owner)
+    return forward(owner, device_id)
+
+
+def forward(owner_url, device_id):
+    ## Inoltra la richiesta così com'è al worker proprietario e ne restituisce la risposta
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    headers[FORWARD_HEADER] = service.cluster.worker_id
+    try:
+        response = forward_session.request(request.method, owner_url + request.full_path, headers=headers,
+                                           data=request.get_data(), timeout=10)
+    except requests.RequestException as e:
+        log.warning("forward to shard owner failed", extra={"device_id": device_id, "owner": owner_url, "error": str(e)})
+        return jsonify({"status": "error", "message": "Device shard owner unreachable, retry"}), 503, {"Retry-After": "1"}
+    return app.response_class(response.content, status=response.status_code, headers=[
+        (k, v) for k, v in response.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS
+    ])
+
+
+@app.after_request
+def record_request(response):
+    # Le metriche usano la regola della route (non l'URL) per non moltiplicare le serie per ogni device
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    http_requests.inc(route, request.method, response.status_code)
+    http_latency.observe(time.perf_counter() - g.request_start, route)
+    return response
+
+
+# Gli endpoint senza prefisso /devices/<device_id> agiscono sul dispositivo di default
+def device_route(rule, **options):
+    def decorator(f):
+        app.route(rule, defaults={"device_id": DEFAULT_DEVICE_ID}, **options)(f)
+        return app.route(f"/devices/<device_id>{rule}", **options)(f)
+    return decorator
 
-    print("------ Updated Sampling Rate ------")
-    print(f"Sampling Rate: {sampling_rate} seconds")
-    print("-----------------------------------")
 
-    return jsonify({"sampling_rate": sampling_rate, "status": "success"})
+@app.errorhandler(InvalidDeviceId)
+def invalid_device_id(e):
+    return jsonify({"status": "error", "message": str(e)}), 400
+
+
+# Endpoint per elencare i dispositivi registrati
+@app.route('/devices', methods=['GET'])
+def get_devices():
+    return respond(service.list_devices())
+
+
+# Endpoint per aggiornare il sampling rate
+@device_route('/update_sampling_rate', methods=['POST'])
+def update_sampling_rate(device_id):
+    return respond(service.update_sampling_rate(device_id, request.json))
 
 
 # Endpoint per aggiornare lo stato di stop_alarm
-@app.route('/update_stop_alarm', methods=['POST'])
-def update_stop_alarm():
-    global stop_alarm
-    data = request.json
-    if 'stop_alarm' in data:
-        stop_alarm = data['stop_alarm'] == "true"
-        mqtt_client.publish(mqtt_topic_stop_alarm, json.dumps({"stop_alarm": stop_alarm}))
-        print(f"Published stop_alarm: {stop_alarm} to {mqtt_topic_stop_alarm}")
-    
-    print("------ Updated Stop Alarm ------")
-    print(f"Stop Alarm: {stop_alarm}")
-    print("--------------------------------")
-    
-    return jsonify({"stop_alarm": stop_alarm, "status": "success"})
+@device_route('/update_stop_alarm', methods=['POST'])
+def update_stop_alarm(device_id):
+    return respond(service.update_stop_alarm(device_id, request.json))
 
 
 # Endpoint per aggiornare l'alarm sound
-@app.route('/update_alarm_sound', methods=['POST'])
-def update_alarm_sound():
-    global alarm_sound
-    data = request.json
-    if 'alarm_sound' in data:
-        alarm_sound = data['alarm_sound']
-        mqtt_client.publish(mqtt_topic_alarm_sound, json.dumps({"alarm_sound": alarm_sound}))
-        print(f"Published alarm_sound: {alarm_sound} to {mqtt_topic_alarm_sound}")
-    
-    print("------ Trigger alarm_sound ------")
-    print(f"Alarm Sound: {alarm_sound}")
-    print("-----------------------------------")
-    
-    return jsonify({"alarm_sound": alarm_sound, "status": "success"})
+@device_route('/update_alarm_sound', methods=['POST'])
+def update_alarm_sound(device_id):
+    return respond(service.update_alarm_sound(device_id, request.json))
 
 
 # Endpoint per impostare una nuova sveglia (data, orario, frequenza)
-@app.route('/set_new_alarm', methods=['POST'])
-def set_new_alarm():
-    data = request.json
-    global alarms
-
-    alarm_id = data.get("alarm_id")
-    alarm_time = data.get("alarm_time")
-    alarm_frequency = data.get("alarm_frequency")
-
-    # Controllo se alarm_id è già presente
-    if any(alarm['alarm_id'] == alarm_id for alarm in alarms):
-        return jsonify({"status": "error", "message": "Alarm ID already exists"}), 400
-
-    # Controllo se alarm_time è presente e valido
-    if not alarm_time:
-        return jsonify({"status": "error", "message": "Missing required fields"}), 400
-
-    alarm = {
-        "alarm_id": alarm_id,
-        "alarm_time": alarm_time,
-        "alarm_frequency": alarm_frequency,
-        "active": True
-    }
+@device_route('/set_new_alarm', methods=['POST'])
+def set_new_alarm(device_id):
+    return respond(service.set_new_alarm(device_id, request.json))
 
-    print(alarm)
-    alarms.append(alarm)
-    save_alarms_to(alarm_filename, alarms)
 
-    return jsonify({"status": "success", "message": "Alarm set successfully"}), 201
+# Endpoint per ottenere le sveglie (filtri e paginazione, risposte in cache con ETag)
+@device_route('/alarms', methods=['GET'])
+def get_alarms(device_id):
+    try:
+        etag, body = service.alarm_listing(device_id, request.args)
+    except InvalidQuery as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
 
-
-# Endpoint per ottenere tutte le sveglie
-@app.route('/alarms', methods=['GET'])
-def get_alarms():
-    global alarms
-    return jsonify({"alarms": alarms}), 201
+    # Se il client ha già questa versione della lista risponde 304 senza corpo
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, status=200, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 # Endpoint per modificare una sveglia
-@app.route('/update_alarm/<alarm_id>', methods=['PUT'])
-def modify_alarm(alarm_id):
+@device_route('/update_alarm/<alarm_id>', methods=['PUT'])
+def modify_alarm(device_id, alarm_id):
+    return respond(service.modify_alarm(device_id, alarm_id, request.json))
 
-    data = request.json
-    global alarms
 
-    for alarm in alarms:
-        if alarm["alarm_id"] == alarm_id:
-            alarm["alarm_time"] = data.get("alarm_time", alarm["alarm_time"])
-            alarm["alarm_frequency"] = data.get("alarm_frequency", alarm["alarm_frequency"])
-            alarm["active"] = data.get("active", str(alarm["active"])).lower() == "true"  
-            save_alarms_to(alarm_filename, alarms)
-            return jsonify({"message": "Alarm updated successfully", "alarm": alarm}), 201
+# Endpoint per eliminare una sveglia
+@device_route('/remove_alarm/<alarm_id>', methods=['DELETE'])
+def remove_alarm(device_id, alarm_id):
+    return respond(service.remove_alarm(device_id, alarm_id))
 
-    return jsonify({"error": "Alarm not found"}), 400
 
+# Endpoint per eliminare tutte le sveglie
+@device_route('/remove_all_alarms', methods=['DELETE'])
+def remove_all_alarms(device_id):
+    return respond(service.remove_all_alarms(device_id))
 
-# Endpoint per eliminare una sveglia
-@app.route('/remove_alarm/<alarm_id>', methods=['DELETE'])
-def remove_alarm(alarm_id):
-    global alarms
 
-    tmp = len(alarms)
-    alarms = [alarm for alarm in alarms if alarm["alarm_id"] != alarm_id]
+# Endpoint per impostare la location della sveglia
+@device_route('/set_alarm_location', methods=['POST'])
+def set_alarm_location(device_id):
+    return respond(service.set_alarm_location(device_id, request.json))
 
-    if len(alarms) == tmp:
-        return jsonify({"message": "Alarm was not deleted."}), 400
-    
-    save_alarms_to(alarm_filename, alarms)  
 
-    return jsonify({"message": "Alarm deleted successfully"}), 201
+# Endpoint per ricevere i dati dal sensore e accodarli per la scrittura su InfluxDB
+@device_route('/sensor_data', methods=['POST'])
+def sensor_data(device_id):
+    return respond(service.sensor_data(device_id, request.json, forwarded=bool(request.headers.get(FORWARD_HEADER))))
 
 
-# Endpoint per eliminare tutte le sveglie
-@app.route('/remove_all_alarms', methods=['DELETE'])
-def remove_all_alarms():
-    global alarms
+# Endpoint per ricevere più campioni (anche di più dispositivi) in una sola richiesta:
+# JSON, NDJSON o binario compatto (vedi samples.parse_batch)
+@device_route('/sensor_data/batch', methods=['POST'])
+def sensor_data_batch(device_id):
+    return respond(service.sensor_data_batch(device_id, request.get_data(cache=False), request.content_type,
+                                             forwarded=bool(request.headers.get(FORWARD_HEADER))))
 
-    alarms = []
-    save_alarms_to(alarm_filename, alarms)  
 
-    return jsonify({"message": "All alarms deleted successfully"}), 201
+# Endpoint per leggere lo stato di occupazione stimato del letto
+@device_route('/occupancy', methods=['GET'])
+def get_occupancy(device_id):
+    return respond(service.occupancy_state(device_id))
 
 
-# Endpoint per impostare la location della sveglia
-@app.route('/set_alarm_location', methods=['POST'])
-def set_alarm_location():
-    data = request.json
-    global weather_location
-
-    # Se non viene fornita una location, utilizza quella di default
-    location = data.get("location", weather_location)
-
-    weather_location = location
-
-    return jsonify({"location": weather_location, "status": "success"}), 201
-
-
-# Funzione per generare i dati da inviare al database InfluxDB
-def generate_data(pressure_value):
-    return [
-        {"measurement": "pressure", "fields": {"value": pressure_value}},
-    ]
-
-# Endpoint per ricevere i dati dal sensore e inviarli al database InfluxDB
-@app.route('/sensor_data', methods=['POST'])
-def sensor_data():
-    data = request.json
-
-    if data and 'pressure_value' in data:
-        pressure_value = data['pressure_value']
-        print(f"Received pressure value: {pressure_value}")
-
-        tmp = generate_data(pressure_value)
-        for point in tmp:
-            try:
-                write_api.write(bucket=bucket, record=Point.from_dict(point))
-                print(f"Dato scritto: {point}")
-            except Exception as e:
-                print(f"Errore durante la scrittura dei dati: {e}")
-                
-    return "OK", 201
-
-
-# Funzione per ottenere le condizioni meteo tramite OpenWeatherMap API
-def get_weather_conditions():
-    global weather_location, WEATHER_API_KEY
-    if WEATHER_API_KEY:
-        if weather_location:
-            weather_condition = get_weather_data(weather_location, WEATHER_API_KEY)
-            sound_mapping = {
-                "Clear": 1,  # Soleggiato = Energico
-                "Clouds": 2,  # Nuvoloso = Medio
-                "Mist": 2,  # Nebbia = Medio
-                "Rain": 3,  # Pioggia = Rilassante
-                "Drizzle": 3,  # Piovigginoso = Rilassante
-                "Snow": 3,  # Neve = Rilassante
-                "Thunderstorm": 4  # Temporale = Allerta
-            }
-
-            selected_sound = sound_mapping.get(weather_condition, 1)  
-            print(f"Condizione meteo: {weather_condition}, Suono selezionato: {selected_sound}")
-            return selected_sound
-        
-    return 1  # Default sound
-
-
-# ----- Alarm clock thread ----- #
-def alarm_clock():
-    global alarms, mqtt_client, mqtt_topic_alarm_sound, mqtt_topic_trigger_alarm
-
-    saved_time = ""   # Memorizza l'ultima volta che la sveglia è stata attivata in modo che la stessa sveglia non venga attivata più volte nello stesso minuto
-
-    while True:
-        now = datetime.now()
-        current_time = now.strftime("%H:%M")  
-        current_weekday = now.weekday()  
-
-        for alarm in alarms:
-            alarm_time = alarm.get("alarm_time")
-            alarm_active = alarm.get("active", False)
-            alarm_frequency = alarm.get("alarm_frequency", "once")
-
-            if alarm_active and alarm_time == current_time: # Se la sveglia è attiva e l'orario corrisponde
-                should_trigger = False
-                
-                if alarm_frequency == "everyday":
-                    should_trigger = True
-                elif alarm_frequency == "weekdays" and current_weekday < 5:
-                    should_trigger = True
-                elif alarm_frequency == "weekends" and current_weekday >= 5:
-                    should_trigger = True
-                elif alarm_frequency == "once" and saved_time != current_time:
-                    should_trigger = True
-                    alarm["active"] = False  # Disattiva la sveglia dopo il trigger once perché non deve essere più attiva, negli altri casi rimane attiva per la prossima esecuzione
-                    save_alarms_to(alarm_filename, alarms) 
-                elif alarm_frequency.startswith("every_"):
-                    # Mappa per controllare i giorni della settimana
-                    weekdays_map = {
-                        "every_monday": 0,
-                        "every_tuesday": 1,
-                        "every_wednesday": 2,
-                        "every_thursday": 3,
-                        "every_friday": 4,
-                        "every_saturday": 5,
-                        "every_sunday": 6
-                    }
-                    if weekdays_map.get(alarm_frequency) == current_weekday:
-                        should_trigger = True
-
-                if should_trigger and saved_time != current_time:
-                    saved_time = current_time
-                    # Ottieni le condizioni meteo e pubblica il suono della sveglia associata
-                    weather_sound = get_weather_conditions()
-                    mqtt_client.publish(mqtt_topic_alarm_sound, json.dumps({"alarm_sound": weather_sound}))
-                    mqtt_client.publish(mqtt_topic_trigger_alarm, json.dumps({"trigger_alarm": "trigger_alarm"}))
-                    print(f"Alarm {alarm.get('alarm_id', 'unknown')} triggered at {current_time} on weekday {current_weekday}")
-
-        time.sleep(10)
+# Endpoint per leggere dalla memoria gli aggregati recenti (min/max/media per minuto o per ora)
+@device_route('/pressure/aggregates', methods=['GET'])
+def get_pressure_aggregates(device_id):
+    return respond(service.pressure_aggregates(device_id, request.args))
+
+
+# Endpoint per leggere pressione e occupazione grezze di un intervallo (since/until in ms,
+# oppure gli ultimi `minutes` minuti): dalla memoria se recente, altrimenti anche da InfluxDB
+@device_route('/pressure', methods=['GET'])
+def get_pressure(device_id):
+    query = service.pressure_query(device_id, request.args)
+    if isinstance(query, Result):
+        return respond(query)
+    since, until, covered, series = query
+    history = None
+    if since < covered:
+        try:
+            history = query_history(device_id, since, min(until, covered))
+        except Exception as e:
+            log.warning("history query failed", extra={"device": device_id, "error": str(e)})
+            return jsonify({"status": "error", "message": "History not available"}), 502
+    return respond(service.pressure_result(device_id, since, until, covered, series, history))
+
+
+# Endpoint per lo stato di consegna dei comandi MQTT del dispositivo (in attesa di conferma e latenze)
+@device_route('/delivery', methods=['GET'])
+def get_delivery(device_id):
+    return respond(service.delivery_status(device_id))
+
+
+# Endpoint per l'esito delle sveglie: tempo per alzarsi, snooze e ultimi risvegli del dispositivo
+@device_route('/alarm_outcomes', methods=['GET'])
+def get_alarm_outcomes(device_id):
+    return respond(service.alarm_outcomes(device_id))
+
+
+# Stream live per la dashboard (Server-Sent Events): prima uno snapshot dello stato, poi gli eventi
+# pressure, occupancy, alarm, outcome, device (impostazioni) e alarms. Filtri opzionali:
+# ?device=<id> (ripetibile) e ?events=pressure,occupancy,...
+# In modalità cluster ogni worker trasmette solo i dispositivi dei propri shard.
+@app.route('/live', methods=['GET'])
+def live_stream():
+    device_ids, events = service.live_filters(request.args)
+    client = live.subscribe(device_ids, events)
+    if client is None:
+        return jsonify({"status": "error", "message": "Too many live clients"}), 503, {"Retry-After": "5"}
+    snapshot = service.live_snapshot(device_ids)
+
+    def stream():
+        try:
+            yield sse_frame("snapshot", snapshot)
+            yield from client.frames(live.heartbeat)
+        finally:
+            live.unsubscribe(client)
+
+    return app.response_class(stream(), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# Endpoint per monitorare la pipeline di ingest (profondità coda, latenza flush, punti scartati)
+@app.route('/ingest_stats', methods=['GET'])
+def ingest_stats():
+    return respond(service.ingest_stats())
+
+
+# Endpoint per monitorare la cache del meteo (hit/miss, errori)
+@app.route('/weather_stats', methods=['GET'])
+def weather_stats():
+    return respond(service.weather_stats())
+
+
+# Shard acquisiti: le loro sveglie vengono caricate dal database condiviso e pianificate
+def load_shards(shards):
+    service.load_shards(shards, service.alarm_db.load_all(), service.alarm_db.load_outcomes())
+
+
+# Endpoint per lo stato del cluster: shard di questo worker e proprietari degli altri
+@app.route('/cluster', methods=['GET'])
+def cluster_status():
+    return respond(service.cluster_status())
+
+
+# Endpoint per monitorare lo scheduler (sveglie in attesa, latenza dal minuto programmato alla pubblicazione MQTT)
+@app.route('/scheduler_stats', methods=['GET'])
+def scheduler_stats():
+    return respond(service.scheduler_stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# Liveness: il processo risponde (per il riavvio da parte dell'orchestratore)
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return respond(service.healthz())
+
+
+# Readiness: 200 solo quando l'avvio è completo e InfluxDB e MQTT sono raggiungibili
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    if service.readiness["started"] and not service.readiness["influxdb"]:
+        check_influx()
+    return respond(service.readyz())
 
 
 # Web App
@@ -318,11 +520,55 @@ def index():
     return render_template('index.html')
 
 
-if __name__ == "__main__":
-
-    alarms = load_alarms_from(alarm_filename)
+# Avvio: importare il modulo non apre connessioni né file; create_app() crea i client,
+# carica le sveglie e avvia i thread. Usabile anche da un server WSGI: gunicorn 'proxy:create_app()'
+def create_app():
+    if service.readiness["started"]:
+        return app
+
+    # Anche con un server WSGI: log JSON con il limite sui messaggi ripetuti
+    configure_logging(os.getenv("log_level", "INFO"), json_lines=os.getenv("log_format", "json") == "json")
+
+    # Le connessioni partono subito e in parallelo al caricamento delle sveglie:
+    # InfluxDB con un ping in un thread, MQTT nel thread di rete di paho
+    connect_influx()
+    warmup = threading.Thread(target=check_influx, name="influx-warmup", daemon=True)
+    warmup.start()
+    connect_mqtt()
+
+    alarm_db = service.open_alarm_db()
+    cluster = service.open_cluster(f"http://127.0.0.1:{port}")
+    if cluster is not None:
+        # Le sveglie vengono caricate per shard man mano che i lease vengono acquisiti
+        cluster.start(load_shards, service.unload_shards)
+    else:
+        service.load_alarms(alarm_db.load_all(), alarm_db.load_outcomes())
+
+    service.ingest.start()
+    service.aggregates.start(service.write_aggregates, interval=float(os.getenv("aggregate_flush_interval", 10)))
+    service.scheduler.start()
+    service.commands.start(publish, interval=float(os.getenv("command_retry_interval", 1)))
+    service.sampler.start(lambda device: perform(service.apply_sampling_rate(device)),
+                          interval=float(os.getenv("sampling_interval", 15)))
+    service.outcomes.start(lambda *outcome: perform(service.record_outcome(*outcome)),
+                           interval=float(os.getenv("outcome_interval", 10)))
+    live.start()
+    service.set_ready("started", True)
+    return app
 
-    alarm_thread = threading.Thread(target=alarm_clock, daemon=True)
-    alarm_thread.start()
 
-    app.run(host="0.0.0.0", port=5000, debug=True, threaded=True)
+if __name__ == "__main__":
+    # flask_debug=false disabilita il reloader (un solo processo, es. per benchmark.py);
+    # in modalità cluster il reloader è sempre disattivato perché ogni processo è un worker
+    debug = os.getenv("flask_debug", "true").lower() == "true" and not os.getenv("cluster_db")
+    # Con il reloader il processo padre osserva solo i file: l'avvio avviene nel processo figlio
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        create_app()
+    if service.cluster is not None:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        app.run(host="0.0.0.0", port=port, debug=debug, threaded=True)
+    finally:
+        if service.cluster is not None:
+            # Arresto pulito: i lease rilasciati passano subito agli altri worker
+            service.cluster.stop()
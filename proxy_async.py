@@ -0,0 +1,626 @@
+"""Modalità asincrona (ASGI) del proxy.
+
+Espone gli stessi endpoint di proxy.py con Quart (API compatibile con Flask) su un
+singolo event loop: scritture su InfluxDB con il client asincrono, MQTT con aiomqtt
+e lo scheduler delle sveglie come task. Pensata per molte connessioni concorrenti
+dei dispositivi senza un thread per richiesta. La logica degli endpoint è la
+stessa di proxy.py (vedi service.py): qui c'è solo il trasporto asincrono.
+
+Avvio in produzione:
+    hypercorn proxy_async:app --bind 0.0.0.0:5000 --worker-class uvloop
+oppure:
+    python proxy_async.py
+"""
+import time
+# Inizio dell'import del modulo, per il tempo import -> ready riportato da /readyz
+IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import json
+import os
+import random
+import signal
+import sqlite3
+import logging
+from datetime import datetime, timezone
+
+import aiohttp
+import aiomqtt
+from dotenv import load_dotenv
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+from quart import Quart, request, jsonify, render_template, g, make_response
+
+from alarm_store import InvalidQuery
+from devices import InvalidDeviceId, DEFAULT_DEVICE_ID, TOPIC_PREFIX
+from ingest import AsyncIngestPipeline
+from scheduler import AsyncAlarmScheduler
+from observability import configure_logging
+from live import AsyncLiveHub, sse_frame
+from timeseries import PRESSURE_QUERY, OCCUPANCY_QUERY, history_from_tables
+from service import (ProxyService, Result, ingest_settings, live_settings, scheduler_settings,
+                     FORWARD_HEADER, HOP_BY_HOP_HEADERS, DEFAULT_ALARM_SOUND, mqtt_topic_pressure, mqtt_topic_ack,
+                     mqtt_topic_status)
+
+
+# Carica le variabili d'ambiente
+load_dotenv(".env")
+
+log = logging.getLogger("proxy_async")
+
+# Configurazione di InfluxDB
+token = os.getenv("token")
+org = "IotAlarmSystem"
+bucket = "Prova"
+influx_url = os.getenv("influx_url", "http://localhost:8086")
+
+# Configurazione MQTT (stessi topic per dispositivo di proxy.py)
+mqtt_broker = os.getenv("mqtt_broker", "localhost")
+mqtt_port = int(os.getenv("mqtt_port", 1883))
+
+# Client creati all'avvio del server, sull'event loop
+influx_client = None
+mqtt_client = None
+forward_session = None
+
+
+async def check_influx():
+    try:
+        ok = await influx_client.ping()
+    except Exception:
+        ok = False
+    service.set_ready("influxdb", ok)
+    return ok
+
+
+async def write_batch(records):
+    start = time.perf_counter()
+    try:
+        await influx_client.write_api().write(bucket=bucket, record=records)
+    except Exception:
+        influx_writes.inc("error")
+        raise
+    finally:
+        influx_latency.observe(time.perf_counter() - start)
+    influx_writes.inc("ok")
+
+
+async def query_history(device_id, since, until):
+    params = {
+        "_bucket": bucket,
+        "_device": device_id,
+        "_start": datetime.fromtimestamp(since / 1e9, timezone.utc),
+        "_stop": datetime.fromtimestamp(until / 1e9, timezone.utc),
+    }
+    query_api = influx_client.query_api()
+    start = time.perf_counter()
+    try:
+        pressure, occupancy = await asyncio.gather(
+            query_api.query(PRESSURE_QUERY, params=params),
+            query_api.query(OCCUPANCY_QUERY, params=params),
+        )
+    except Exception:
+        influx_queries.inc("error")
+        raise
+    finally:
+        influx_query_latency.observe(time.perf_counter() - start)
+    influx_queries.inc("ok")
+    return history_from_tables(pressure, occupancy)
+
+
+# ----- Alarm clock ----- #
+async def trigger_alarm(key, alarm, fire_time):
+    device = service.alarm_device(key, alarm)
+    if device is None:
+        return None
+    # WeatherCache usa requests: la chiamata gira in un thread per non bloccare il loop
+    try:
+        sound = await asyncio.to_thread(service.alarm_sound, device.weather_location, True)
+    except Exception as e:
+        # Un errore del meteo non deve mai impedire alla sveglia di suonare
+        log.error("alarm sound lookup failed", extra={"device_id": device.device_id, "error": str(e)})
+        sound = DEFAULT_ALARM_SOUND
+    await perform(service.ring(device, sound))
+    published_at = datetime.now()
+    await perform(service.alarm_fired(device, key, alarm, fire_time, published_at))
+    return published_at
+
+
+async def prefetch_weather(key, alarm, fire_time):
+    location = service.prefetch_location(alarm)
+    if location:
+        spawn(asyncio.to_thread(service.weather_cache.get, location))
+
+
+# Stato e logica condivisi con la modalità sincrona (vedi service.py)
+service = ProxyService(
+    AsyncIngestPipeline(write_batch, **ingest_settings()),
+    AsyncLiveHub(**live_settings()),
+    AsyncAlarmScheduler(trigger_alarm, on_prefetch=prefetch_weather, **scheduler_settings()),
+    started_at=IMPORT_STARTED,
+)
+live = service.live
+
+# Stesse metriche di proxy.py
+metrics = service.metrics
+http_requests = metrics.counter("http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+http_latency = metrics.histogram("http_request_duration_seconds", "HTTP request latency by route", ("route",))
+influx_writes = metrics.counter("influx_writes_total", "InfluxDB batch writes by result", ("result",))
+influx_latency = metrics.histogram("influx_write_duration_seconds", "InfluxDB batch write latency")
+influx_queries = metrics.counter("influx_queries_total", "InfluxDB history queries by result", ("result",))
+influx_query_latency = metrics.histogram("influx_query_duration_seconds", "InfluxDB history query latency")
+mqtt_publishes = metrics.counter("mqtt_publish_total", "MQTT messages published by command and result", ("command", "result"))
+
+
+# ----- MQTT ----- #
+async def publish(topic, payload, retain=False):
+    ## Pubblica con QoS 1; se il broker non è raggiungibile i comandi restano in CommandDelivery
+    command = topic.rsplit("/", 1)[-1]
+    if mqtt_client is None:
+        mqtt_publishes.inc(command, "dropped")
+        log.warning("mqtt not connected, dropping message", extra={"topic": topic})
+        return
+    try:
+        await mqtt_client.publish(topic, json.dumps(payload), qos=1, retain=retain)
+    except aiomqtt.MqttError as e:
+        mqtt_publishes.inc(command, "error")
+        log.warning("mqtt publish failed", extra={"topic": topic, "error": str(e)})
+        return
+    mqtt_publishes.inc(command, "ok")
+
+
+async def send_command(device, command, payload):
+    topic, message, retain = service.commands.prepare(device, command, payload)
+    await publish(topic, message, retain)
+
+
+async def perform(result):
+    ## Esegue l'I/O chiesto dal servizio: comandi e messaggi MQTT, scritture su AlarmDB in un thread
+    for device, command, payload in result.commands:
+        await send_command(device, command, payload)
+    for topic, payload, retain in result.messages:
+        await publish(topic, payload, retain)
+    for write, args in result.writes:
+        await asyncio.to_thread(write, *args)
+    for owner_url, device_id, samples in result.forwards:
+        await forward_samples(result, owner_url, device_id, samples)
+    return result
+
+
+async def forward_samples(result, owner_url, device_id, samples):
+    ## Campioni di shard di altri worker, inoltrati come batch JSON al proprietario
+    try:
+        async with forward_session.post(f"{owner_url}/devices/{device_id}/sensor_data/batch", json={"samples": samples},
+                                        headers={FORWARD_HEADER: service.cluster.worker_id}) as response:
+            status = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return service.forward_failed(result, owner_url, device_id, str(e))
+    if status != 201:
+        service.forward_failed(result, owner_url, device_id, f"HTTP {status}")
+
+
+def perform_later(result):
+    ## Come perform() ma in un task, per non fermare chi riceve i campioni
+    if result.has_io():
+        spawn(perform(result))
+
+
+# Task lanciati senza attenderne la fine (perform_later, prefetch del meteo): l'event loop
+# ne tiene solo riferimenti deboli, quindi restano qui finché non terminano
+pending_tasks = set()
+
+
+def spawn(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    pending_tasks.add(task)
+    task.add_done_callback(task_done)
+    return task
+
+
+def task_done(task):
+    pending_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("background task failed", extra={"task": task.get_name(), "error": str(task.exception())})
+
+
+async def respond(result):
+    await perform(result)
+    body = result.body if isinstance(result.body, str) else jsonify(result.body)
+    return body, result.status, result.headers
+
+
+async def retry_commands(interval):
+    ## Ripubblica i comandi non ancora confermati dal firmware
+    while True:
+        await asyncio.sleep(interval)
+        for topic, message, retain in service.commands.due():
+            await publish(topic, message, retain)
+
+
+async def mqtt_loop():
+    ## Mantiene la connessione al broker e consuma la telemetria, riconnettendosi in caso di errore
+    global mqtt_client
+    while True:
+        try:
+            async with aiomqtt.Client(mqtt_broker, mqtt_port, identifier=f"PythonAsyncClient-{random.randint(1000, 9999)}") as client:
+                mqtt_client = client
+                await client.subscribe(f"{TOPIC_PREFIX}/+/{mqtt_topic_pressure}")
+                await client.subscribe(f"{TOPIC_PREFIX}/+/{mqtt_topic_ack}", qos=1)
+                await client.subscribe(f"{TOPIC_PREFIX}/+/{mqtt_topic_status}", qos=1)
+                service.set_ready("mqtt", True)
+                async for message in client.messages:
+                    topic = str(message.topic)
+                    kind = topic.rsplit("/", 1)[-1]
+                    if kind == mqtt_topic_pressure:
+                        perform_later(service.on_pressure(topic, message.payload))
+                    elif kind == mqtt_topic_ack:
+                        service.on_ack(topic, message.payload)
+                    elif kind == mqtt_topic_status:
+                        service.on_status(topic, message.payload)
+        except aiomqtt.MqttError as e:
+            mqtt_client = None
+            service.set_ready("mqtt", False)
+            log.warning("mqtt connection lost, reconnecting in 5 seconds", extra={"error": str(e)})
+            await asyncio.sleep(5)
+
+
+# ----- Task periodici ----- #
+async def flush_aggregates(interval):
+    ## Scrive periodicamente i bucket chiusi degli aggregati tramite la pipeline di ingest
+    while True:
+        await asyncio.sleep(interval)
+        service.write_aggregates(service.aggregates.flush(time.time_ns()))
+
+
+async def outcome_loop(interval):
+    ## Chiude le sessioni delle sveglie concluse e salva gli esiti
+    while True:
+        await asyncio.sleep(interval)
+        for outcome in service.outcomes.tick():
+            await perform(service.record_outcome(*outcome))
+
+
+async def sampling_loop(interval):
+    ## Ricalcola periodicamente le frequenze di tutti i dispositivi
+    while True:
+        await asyncio.sleep(interval)
+        for device in service.sampler.plan():
+            await perform(service.apply_sampling_rate(device))
+
+
+# ----- Cluster ----- #
+async def coordinate_shards(cluster, interval):
+    ## Rinnova i lease (SQLite, in un thread) e carica o scarica le sveglie degli shard cambiati
+    while True:
+        try:
+            acquired, lost = await asyncio.to_thread(cluster.tick)
+        except sqlite3.Error as e:
+            log.error("shard coordination failed", extra={"error": str(e)})
+        else:
+            if lost:
+                service.unload_shards(lost)
+            if acquired:
+                rows = await asyncio.to_thread(service.alarm_db.load_all)
+                summaries = await asyncio.to_thread(service.alarm_db.load_outcomes)
+                service.load_shards(acquired, rows, summaries)
+        await asyncio.sleep(interval)
+
+
+# ----- Applicazione ----- #
+app = Quart(__name__)
+background_tasks = []
+
+
+@app.before_serving
+async def startup():
+    global influx_client, forward_session
+    # Anche con "hypercorn proxy_async:app": log JSON con il limite sui messaggi ripetuti
+    configure_logging(os.getenv("log_level", "INFO"), json_lines=os.getenv("log_format", "json") == "json")
+
+    # Le connessioni partono per prime e procedono mentre le sveglie vengono caricate
+    influx_client = InfluxDBClientAsync(url=influx_url, token=token, org=org,
+                                        connection_pool_maxsize=int(os.getenv("influx_pool_size", 10)))
+    background_tasks.append(asyncio.get_running_loop().create_task(check_influx()))
+    background_tasks.append(asyncio.get_running_loop().create_task(mqtt_loop()))
+
+    # SQLite (apertura, migrazione da alarms.json, lease del cluster) non gira sull'event loop
+    alarm_db = await asyncio.to_thread(service.open_alarm_db)
+    cluster = await asyncio.to_thread(
+        service.open_cluster, f"http://127.0.0.1:{os.getenv('bind', '0.0.0.0:5000').rsplit(':', 1)[1]}")
+    if cluster is not None:
+        forward_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        background_tasks.append(asyncio.get_running_loop().create_task(
+            coordinate_shards(cluster, cluster.lease_ttl / 3)))
+    else:
+        rows = await asyncio.to_thread(alarm_db.load_all)
+        service.load_alarms(rows, await asyncio.to_thread(alarm_db.load_outcomes))
+
+    background_tasks.append(asyncio.get_running_loop().create_task(
+        flush_aggregates(float(os.getenv("aggregate_flush_interval", 10)))))
+    background_tasks.append(asyncio.get_running_loop().create_task(
+        sampling_loop(float(os.getenv("sampling_interval", 15)))))
+    background_tasks.append(asyncio.get_running_loop().create_task(
+        retry_commands(float(os.getenv("command_retry_interval", 1)))))
+    background_tasks.append(asyncio.get_running_loop().create_task(
+        outcome_loop(float(os.getenv("outcome_interval", 10)))))
+    live.start()
+    service.ingest.start()
+    service.scheduler.start()
+    service.set_ready("started", True)
+
+
+@app.after_serving
+async def shutdown():
+    await service.scheduler.stop()
+    await live.stop()
+    await service.ingest.stop()
+    for task in background_tasks:
+        task.cancel()
+    if service.cluster is not None:
+        # Arresto pulito: i lease rilasciati passano subito agli altri worker
+        await asyncio.to_thread(service.cluster.release_all)
+        await forward_session.close()
+    await influx_client.close()
+
+
+@app.before_request
+async def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+async def route_to_owner():
+    ## In modalità cluster le richieste per un dispositivo di un altro shard vanno al worker proprietario
+    device_id = (request.view_args or {}).get("device_id")
+    if device_id is None:
+        return None
+    owner = service.route(device_id, forwarded=bool(request.headers.get(FORWARD_HEADER)))
+    if owner is None:
+        return None
+    if isinstance(owner, Result):
+        return await respond(owner)
+    return await forward(owner, device_id)
+
+
+async def forward(owner_url, device_id):
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    headers[FORWARD_HEADER] = service.cluster.worker_id
+    try:
+        async with forward_session.request(request.method, owner_url + request.full_path, headers=headers,
+                                           data=await request.get_data()) as response:
+            body = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.warning("forward to shard owner failed", extra={"device_id": device_id, "owner": owner_url, "error": str(e)})
+        return jsonify({"status": "error", "message": "Device shard owner unreachable, retry"}), 503, {"Retry-After": "1"}
+    return app.response_class(body, status=response.status, headers=[
+        (k, v) for k, v in response.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS
+    ])
+
+
+@app.after_request
+async def record_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    http_requests.inc(route, request.method, response.status_code)
+    http_latency.observe(time.perf_counter() - g.request_start, route)
+    return response
+
+
+def device_route(rule, **options):
+    def decorator(f):
+        app.route(rule, defaults={"device_id": DEFAULT_DEVICE_ID}, **options)(f)
+        return app.route(f"/devices/<device_id>{rule}", **options)(f)
+    return decorator
+
+
+@app.errorhandler(InvalidDeviceId)
+async def invalid_device_id(e):
+    return jsonify({"status": "error", "message": str(e)}), 400
+
+
+@app.route('/devices', methods=['GET'])
+async def get_devices():
+    return await respond(service.list_devices())
+
+
+@device_route('/update_sampling_rate', methods=['POST'])
+async def update_sampling_rate(device_id):
+    return await respond(service.update_sampling_rate(device_id, await request.get_json()))
+
+
+@device_route('/update_stop_alarm', methods=['POST'])
+async def update_stop_alarm(device_id):
+    return await respond(service.update_stop_alarm(device_id, await request.get_json()))
+
+
+@device_route('/update_alarm_sound', methods=['POST'])
+async def update_alarm_sound(device_id):
+    return await respond(service.update_alarm_sound(device_id, await request.get_json()))
+
+
+@device_route('/set_new_alarm', methods=['POST'])
+async def set_new_alarm(device_id):
+    return await respond(service.set_new_alarm(device_id, await request.get_json()))
+
+
+@device_route('/alarms', methods=['GET'])
+async def get_alarms(device_id):
+    try:
+        etag, body = service.alarm_listing(device_id, request.args)
+    except InvalidQuery as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    # Se il client ha già questa versione della lista risponde 304 senza corpo
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, status=200, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@device_route('/update_alarm/<alarm_id>', methods=['PUT'])
+async def modify_alarm(device_id, alarm_id):
+    return await respond(service.modify_alarm(device_id, alarm_id, await request.get_json()))
+
+
+@device_route('/remove_alarm/<alarm_id>', methods=['DELETE'])
+async def remove_alarm(device_id, alarm_id):
+    return await respond(service.remove_alarm(device_id, alarm_id))
+
+
+@device_route('/remove_all_alarms', methods=['DELETE'])
+async def remove_all_alarms(device_id):
+    return await respond(service.remove_all_alarms(device_id))
+
+
+@device_route('/set_alarm_location', methods=['POST'])
+async def set_alarm_location(device_id):
+    return await respond(service.set_alarm_location(device_id, await request.get_json()))
+
+
+@device_route('/sensor_data', methods=['POST'])
+async def sensor_data(device_id):
+    return await respond_sensor_data(service.sensor_data(
+        device_id, await request.get_json(), forwarded=bool(request.headers.get(FORWARD_HEADER))))
+
+
+@device_route('/sensor_data/batch', methods=['POST'])
+async def sensor_data_batch(device_id):
+    return await respond_sensor_data(service.sensor_data_batch(
+        device_id, await request.get_data(), request.content_type, forwarded=bool(request.headers.get(FORWARD_HEADER))))
+
+
+async def respond_sensor_data(result):
+    if result.forwards:
+        # L'esito dipende dal worker proprietario: la risposta attende l'inoltro
+        return await respond(result)
+    # Le pubblicazioni delle transizioni di occupazione non ritardano la risposta al firmware
+    perform_later(result)
+    body = result.body if isinstance(result.body, str) else jsonify(result.body)
+    return body, result.status, result.headers
+
+
+@device_route('/pressure/aggregates', methods=['GET'])
+async def get_pressure_aggregates(device_id):
+    return await respond(service.pressure_aggregates(device_id, request.args))
+
+
+@device_route('/pressure', methods=['GET'])
+async def get_pressure(device_id):
+    query = service.pressure_query(device_id, request.args)
+    if isinstance(query, Result):
+        return await respond(query)
+    since, until, covered, series = query
+    history = None
+    if since < covered:
+        try:
+            history = await query_history(device_id, since, min(until, covered))
+        except Exception as e:
+            log.warning("history query failed", extra={"device": device_id, "error": str(e)})
+            return jsonify({"status": "error", "message": "History not available"}), 502
+    return await respond(service.pressure_result(device_id, since, until, covered, series, history))
+
+
+@app.route('/cluster', methods=['GET'])
+async def cluster_status():
+    return await respond(service.cluster_status())
+
+
+@device_route('/delivery', methods=['GET'])
+async def get_delivery(device_id):
+    return await respond(service.delivery_status(device_id))
+
+
+@device_route('/occupancy', methods=['GET'])
+async def get_occupancy(device_id):
+    return await respond(service.occupancy_state(device_id))
+
+
+@device_route('/alarm_outcomes', methods=['GET'])
+async def get_alarm_outcomes(device_id):
+    return await respond(service.alarm_outcomes(device_id))
+
+
+# Stream live per la dashboard (Server-Sent Events), come in proxy.py
+@app.route('/live', methods=['GET'])
+async def live_stream():
+    device_ids, events = service.live_filters(request.args)
+    client = live.subscribe(device_ids, events)
+    if client is None:
+        return jsonify({"status": "error", "message": "Too many live clients"}), 503, {"Retry-After": "5"}
+    snapshot = service.live_snapshot(device_ids)
+
+    async def stream():
+        try:
+            yield sse_frame("snapshot", snapshot).encode()
+            async for frames in client.frames(live.heartbeat):
+                yield frames.encode()
+        finally:
+            live.unsubscribe(client)
+
+    response = await make_response(stream(), {"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                                              "X-Accel-Buffering": "no"})
+    response.timeout = None  # lo stream resta aperto finché il client è connesso
+    return response
+
+
+@app.route('/ingest_stats', methods=['GET'])
+async def ingest_stats():
+    return await respond(service.ingest_stats())
+
+
+@app.route('/weather_stats', methods=['GET'])
+async def weather_stats():
+    return await respond(service.weather_stats())
+
+
+@app.route('/scheduler_stats', methods=['GET'])
+async def scheduler_stats():
+    return await respond(service.scheduler_stats())
+
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/healthz', methods=['GET'])
+async def healthz():
+    return await respond(service.healthz())
+
+
+@app.route('/readyz', methods=['GET'])
+async def readyz():
+    if service.readiness["started"] and not service.readiness["influxdb"]:
+        await check_influx()
+    return await respond(service.readyz())
+
+
+@app.route('/')
+async def index():
+    return await render_template('index.html')
+
+
+if __name__ == "__main__":
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+    config = Config()
+    config.bind = [os.getenv("bind", "0.0.0.0:5000")]
+    config.backlog = 4096
+    config.keep_alive_timeout = 75
+
+    async def main():
+        # SIGTERM chiude il server in modo ordinato (after_serving rilascia i lease del cluster)
+        shutdown = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signum, shutdown.set)
+        await serve(app, config, shutdown_trigger=shutdown.wait)
+
+    asyncio.run(main())
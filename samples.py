@@ -0,0 +1,133 @@
+import json
+import math
+import struct
+import time
+from devices import DeviceRegistry
+
+
+# Formato binario compatto (per un solo dispositivo): timestamp in ms (int64) + valore (float32), little endian
+BINARY_RECORD = struct.Struct("<qf")
+
+# Limite di campioni per richiesta, per non bloccare un thread su payload enormi
+MAX_BATCH_SAMPLES = 10000
+
+# Range della lettura ADC del sensore di pressione
+MIN_PRESSURE = 0
+MAX_PRESSURE = 4095
+
+# Timestamp accettati (ms): dal 2020 a un giorno nel futuro
+_MIN_TIMESTAMP_MS = 1577836800000
+
+
+class InvalidBatch(ValueError):
+    pass
+
+
+# Record in line protocol per InfluxDB. Gli ID dei dispositivi sono già validati
+# (solo [A-Za-z0-9_.-]) e non richiedono escape.
+def pressure_record(device_id, pressure_value, timestamp):
+    # Il campo value è intero (lettura ADC 0-4095), come nei dati già presenti su InfluxDB
+    return f"pressure,device={device_id} value={int(round(pressure_value))}i {timestamp}"
+
+
+def occupancy_record(device_id, occupied, probability, timestamp):
+    return f"occupancy,device={device_id} occupied={int(occupied)}i,probability={float(probability)} {timestamp}"
+
+
+def outcome_record(device_id, outcome, timestamp):
+    ## Esito di una sveglia (outcomes.AlarmOutcomes), con il tag alarm_id e la latenza per alzarsi
+    fields = [f"outcome=\"{outcome['outcome']}\"", f"snoozes={int(outcome['snoozes'])}i",
+              f"stopped_manually={str(outcome['stopped_manually']).lower()}"]
+    if outcome["latency_s"] is not None:
+        fields.append(f"latency_s={float(outcome['latency_s'])}")
+    return f"alarm_outcome,device={device_id},alarm_id={_escape_tag(outcome['alarm_id'])} {','.join(fields)} {timestamp}"
+
+
+def _escape_tag(value):
+    return str(value).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def _timestamp_ns(timestamp_ms, now_ms):
+    if timestamp_ms is None:
+        return now_ms * 1_000_000
+    if isinstance(timestamp_ms, bool) or not isinstance(timestamp_ms, (int, float)):
+        raise ValueError("timestamp must be a number (ms since epoch)")
+    if not _MIN_TIMESTAMP_MS <= timestamp_ms <= now_ms + 86_400_000:
+        raise ValueError("timestamp out of range")
+    return int(timestamp_ms) * 1_000_000
+
+
+def validate_pressure(value):
+    ## Il valore finisce nel campo intero di pressure_record: fuori dal range dell'ADC
+    ## InfluxDB rifiuterebbe il batch (es. 1e300 non sta in un int64)
+    if not math.isfinite(value) or not MIN_PRESSURE <= value <= MAX_PRESSURE:
+        raise ValueError(f"pressure_value must be between {MIN_PRESSURE} and {MAX_PRESSURE}")
+    return value
+
+
+def _pressure_value(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("pressure_value must be a number")
+    return validate_pressure(value)
+
+
+def _from_objects(objects, default_device):
+    now_ms = time.time_ns() // 1_000_000
+    samples, errors = [], []
+    for i, obj in enumerate(objects):
+        try:
+            if not isinstance(obj, dict) or "pressure_value" not in obj:
+                raise ValueError("missing pressure_value")
+            device_id = DeviceRegistry.validate(obj.get("device_id", default_device))
+            samples.append((device_id, _pressure_value(obj["pressure_value"]), _timestamp_ns(obj.get("timestamp"), now_ms)))
+        except ValueError as e:
+            errors.append({"index": i, "error": str(e)})
+    return samples, errors
+
+
+def sample_json(device_id, pressure_value, timestamp_ns):
+    ## Campione nel formato JSON di parse_batch (timestamp in ms), per inoltrarlo a un altro worker
+    return {"device_id": device_id, "pressure_value": pressure_value, "timestamp": timestamp_ns // 1_000_000}
+
+
+def parse_batch(body, content_type, default_device):
+    """Decodifica un batch di campioni in una lista di (device_id, pressure_value, timestamp_ns).
+
+    Formati supportati:
+      - application/json: lista di oggetti oppure {"samples": [...]}, ogni oggetto con
+        pressure_value e opzionalmente device_id e timestamp (ms);
+      - application/x-ndjson: un oggetto JSON per riga;
+      - application/octet-stream: record BINARY_RECORD per il dispositivo dell'URL.
+
+    Se anche un solo campione non è valido solleva InvalidBatch con l'elenco degli errori.
+    """
+    content_type = (content_type or "application/json").split(";")[0].strip().lower()
+
+    if content_type == "application/octet-stream":
+        if len(body) % BINARY_RECORD.size:
+            raise InvalidBatch([{"error": f"binary payload size must be a multiple of {BINARY_RECORD.size}"}])
+        if len(body) // BINARY_RECORD.size > MAX_BATCH_SAMPLES:
+            raise InvalidBatch([{"error": f"too many samples (max {MAX_BATCH_SAMPLES})"}])
+        objects = [{"timestamp": ts, "pressure_value": value} for ts, value in BINARY_RECORD.iter_unpack(body)]
+    else:
+        try:
+            if content_type in ("application/x-ndjson", "application/jsonl"):
+                objects = [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+            else:
+                objects = json.loads(body)
+                if isinstance(objects, dict):
+                    objects = objects.get("samples")
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise InvalidBatch([{"error": f"malformed payload: {e}"}])
+        if not isinstance(objects, list):
+            raise InvalidBatch([{"error": "expected a list of samples"}])
+        if len(objects) > MAX_BATCH_SAMPLES:
+            raise InvalidBatch([{"error": f"too many samples (max {MAX_BATCH_SAMPLES})"}])
+
+    samples, errors = _from_objects(objects, default_device)
+    if errors:
+        raise InvalidBatch(errors)
+
+    # L'ordine temporale serve al classificatore di occupazione
+    samples.sort(key=lambda sample: sample[2])
+    return samples
@@ -0,0 +1,130 @@
+import threading
+import logging
+from datetime import datetime, timedelta
+from scheduler import next_fire_time
+
+log = logging.getLogger(__name__)
+
+
+# Motivi della frequenza scelta, esposti in Device.settings() e nelle metriche
+FAST, BASELINE, STABLE, IDLE, MANUAL = "alarm_window", "baseline", "stable", "idle", "manual"
+
+
+class SamplingController:
+    """Regola automaticamente il sampling rate (secondi tra due campioni) di ogni letto.
+
+    - Nei minuti intorno a una sveglia (da `before` prima a `after` dopo il trigger)
+      usa `fast_rate`: il firmware ferma l'allarme sulla media dell'intervallo, quindi
+      un intervallo breve vuol dire accorgersi subito che l'utente si è alzato.
+      La finestra dopo il trigger si chiude appena il letto risulta libero o
+      l'allarme viene fermato.
+    - Se il letto è libero da almeno `stable_after` usa `idle_rate`; se è occupato
+      senza transizioni da almeno `stable_after` usa `stable_rate`.
+    - Altrimenti usa il sampling rate impostato a mano per il dispositivo.
+
+    I dispositivi con adaptive_sampling disattivato restano sempre al valore manuale.
+    """
+
+    def __init__(self, devices, alarms, occupancy, fast_rate=1, stable_rate=30, idle_rate=60,
+                 stable_after=timedelta(minutes=10), before=timedelta(minutes=5), after=timedelta(minutes=30),
+                 now=datetime.now):
+        self.devices = devices
+        self.alarms = alarms
+        self.occupancy = occupancy
+        self.fast_rate = fast_rate
+        self.stable_rate = stable_rate
+        self.idle_rate = idle_rate
+        self.stable_after = stable_after
+        self.before = before
+        self.after = after
+        self.now = now
+        self._fired = {}  # device_id -> ultimo trigger ancora nella finestra
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"changes": 0}
+
+    # ----- Eventi ----- #
+    def alarm_fired(self, device_id, fire_time):
+        with self._lock:
+            self._fired[device_id] = fire_time
+
+    def alarm_stopped(self, device_id):
+        with self._lock:
+            self._fired.pop(device_id, None)
+
+    # ----- Decisione ----- #
+    def _in_alarm_window(self, device_id, now):
+        fired = self._fired.get(device_id)
+        if fired is not None:
+            state = self.occupancy.state(device_id)
+            got_up = state is not None and state["occupied"] is False and \
+                state["since"] is not None and state["since"] >= fired.timestamp() * 1e9
+            if now <= fired + self.after and not got_up:
+                return True
+            with self._lock:
+                if self._fired.get(device_id) is fired:
+                    del self._fired[device_id]
+
+        for alarm in self.alarms.list(device_id):
+            fire_time = next_fire_time(alarm, now)
+            if fire_time is not None and fire_time - self.before <= now:
+                return True
+        return False
+
+    def target(self, device, now=None):
+        """Restituisce (sampling rate, motivo) per il dispositivo."""
+        now = now or self.now()
+        if not device.adaptive_sampling:
+            return device.sampling_rate, MANUAL
+        if self._in_alarm_window(device.device_id, now):
+            return min(self.fast_rate, device.sampling_rate), FAST
+
+        state = self.occupancy.state(device.device_id)
+        if state is not None and state["occupied"] is not None and state["since"] is not None:
+            stable_for = now.timestamp() - state["since"] / 1e9
+            if stable_for >= self.stable_after.total_seconds():
+                rate = self.stable_rate if state["occupied"] else self.idle_rate
+                return max(rate, device.sampling_rate), STABLE if state["occupied"] else IDLE
+        return device.sampling_rate, BASELINE
+
+    def refresh(self, device, now=None):
+        """Aggiorna la frequenza effettiva del dispositivo; restituisce True se è cambiata."""
+        rate, reason = self.target(device, now)
+        device.sampling_mode = reason
+        if rate == device.effective_sampling_rate:
+            return False
+        device.effective_sampling_rate = rate
+        with self._lock:
+            self.stats["changes"] += 1
+        return True
+
+    def plan(self, now=None):
+        """Aggiorna tutti i dispositivi e restituisce quelli la cui frequenza è cambiata."""
+        now = now or self.now()
+        return [device for device in self.devices.all() if self.refresh(device, now)]
+
+    def get_stats(self):
+        modes = {}
+        for device in self.devices.all():
+            modes[device.sampling_mode] = modes.get(device.sampling_mode, 0) + 1
+        return {**self.stats, "modes": modes}
+
+    # ----- Thread di controllo ----- #
+    def start(self, on_change, interval=15.0):
+        """Ricalcola le frequenze ogni `interval` secondi e chiama on_change(device) per ogni cambio."""
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    for device in self.plan():
+                        on_change(device)
+                except Exception as e:
+                    log.error("sampling controller failed", extra={"error": str(e)})
+
+        self._thread = threading.Thread(target=run, name="sampling-controller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
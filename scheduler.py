@@ -0,0 +1,346 @@
+import asyncio
+import heapq
+import inspect
+import itertools
+import threading
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+
+# Giorni della settimana (datetime.weekday()) in cui può suonare ogni frequenza
+FREQUENCY_WEEKDAYS = {
+    "once": frozenset(range(7)),
+    "everyday": frozenset(range(7)),
+    "weekdays": frozenset(range(5)),
+    "weekends": frozenset({5, 6}),
+    "every_monday": frozenset({0}),
+    "every_tuesday": frozenset({1}),
+    "every_wednesday": frozenset({2}),
+    "every_thursday": frozenset({3}),
+    "every_friday": frozenset({4}),
+    "every_saturday": frozenset({5}),
+    "every_sunday": frozenset({6}),
+}
+
+
+class InvalidAlarm(ValueError):
+    pass
+
+
+def validate_alarm(alarm_time, alarm_frequency):
+    """Controlla orario (HH:MM) e frequenza di una sveglia; solleva InvalidAlarm se non sono validi.
+
+    Restituisce l'orario come datetime (solo ore e minuti significativi).
+    """
+    try:
+        parsed = datetime.strptime(alarm_time, "%H:%M")
+    except (TypeError, ValueError):
+        raise InvalidAlarm(f"alarm_time must be HH:MM, got {alarm_time!r}")
+    if alarm_frequency is not None and (not isinstance(alarm_frequency, str) or alarm_frequency not in FREQUENCY_WEEKDAYS):
+        raise InvalidAlarm(f"alarm_frequency must be one of {', '.join(FREQUENCY_WEEKDAYS)}")
+    return parsed
+
+
+def next_fire_time(alarm, after):
+    """Calcola il prossimo istante (>= after) in cui la sveglia deve suonare.
+
+    Restituisce None se la sveglia non è attiva o se orario/frequenza non sono validi.
+    """
+    if not alarm.get("active", False):
+        return None
+
+    frequency = alarm.get("alarm_frequency") or "once"
+    try:
+        alarm_time = validate_alarm(alarm.get("alarm_time"), frequency)
+    except InvalidAlarm:
+        return None
+    weekdays = FREQUENCY_WEEKDAYS[frequency]
+
+    candidate = after.replace(hour=alarm_time.hour, minute=alarm_time.minute, second=0, microsecond=0)
+    for _ in range(8):
+        if candidate >= after and candidate.weekday() in weekdays:
+            return candidate
+        candidate += timedelta(days=1)
+    return None
+
+
+# Tipi di voce nell'heap: il prefetch precede sempre il trigger della stessa sveglia
+PREFETCH, FIRE = 0, 1
+
+
+class AlarmScheduler:
+    """Scheduler delle sveglie basato su un heap ordinato per prossimo trigger.
+
+    Il thread dorme fino alla sveglia più vicina; schedule() e unschedule() lo
+    risvegliano per ricalcolare l'attesa. Le voci dell'heap rimpiazzate o rimosse
+    vengono scartate quando arrivano in cima (cancellazione lazy), per cui ogni
+    operazione costa O(log n).
+
+    Se è impostato on_prefetch, viene chiamato prefetch_window prima di ogni trigger
+    per preparare ciò che serve (es. il meteo) fuori dal percorso critico.
+    """
+
+    # Attesa massima tra due controlli, per seguire eventuali cambi dell'orologio di sistema
+    MAX_SLEEP = 30.0
+
+    def __init__(self, on_fire, on_prefetch=None, prefetch_window=timedelta(minutes=5), now=datetime.now):
+        self.on_fire = on_fire
+        self.on_prefetch = on_prefetch
+        self.prefetch_window = prefetch_window
+        self.now = now
+        self._heap = []
+        self._entries = {}   # key -> (fire_time, seq, alarm)
+        self._firing = {}    # sveglie in esecuzione, da ripianificare dopo il trigger
+        self._fired = {}     # key -> ultimo minuto in cui la sveglia ha suonato
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+        # Latenza dal minuto programmato alla fine di on_fire (pubblicazione MQTT)
+        self._latencies = deque(maxlen=1000)
+        self.stats = {"fired": 0, "prefetched": 0, "errors": 0}
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop = False
+            self._thread = threading.Thread(target=self._run, name="alarm-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def schedule(self, key, alarm, after=None):
+        """Inserisce o aggiorna la sveglia `key` e risveglia il thread.
+
+        Di default viene considerato anche il minuto corrente, così una sveglia
+        creata per l'orario attuale suona subito. Una sveglia che ha già suonato
+        viene ripianificata dal minuto successivo, anche se modificata nel minuto
+        in cui ha suonato.
+        """
+        if after is None:
+            after = self.now().replace(second=0, microsecond=0)
+        with self._cond:
+            fired = self._fired.get(key)
+            if fired is not None and fired + timedelta(minutes=1) > after:
+                after = fired + timedelta(minutes=1)
+            fire_time = next_fire_time(alarm, after)
+            self._firing.pop(key, None)
+            if fire_time is None:
+                self._entries.pop(key, None)
+            else:
+                seq = next(self._seq)
+                self._entries[key] = (fire_time, seq, alarm)
+                self._push(fire_time, seq, key)
+                self._compact()
+            self._wake()
+        return fire_time
+
+    def unschedule(self, key):
+        with self._cond:
+            removed = self._entries.pop(key, None) is not None
+            removed = self._firing.pop(key, None) is not None or removed
+            self._wake()
+        return removed
+
+    def clear(self):
+        with self._cond:
+            self._entries.clear()
+            self._firing.clear()
+            self._fired.clear()
+            self._heap = []
+            self._wake()
+
+    def next_fire(self, key):
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def pending(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._entries)
+            latencies = sorted(self._latencies)
+        if latencies:
+            stats["latency_ms"] = {
+                "last": self._latencies[-1] * 1000,
+                "p50": latencies[len(latencies) // 2] * 1000,
+                "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+                "max": latencies[-1] * 1000,
+            }
+        return stats
+
+    def _push(self, fire_time, seq, key):
+        if self.on_prefetch is not None:
+            heapq.heappush(self._heap, (fire_time - self.prefetch_window, PREFETCH, seq, key))
+        heapq.heappush(self._heap, (fire_time, FIRE, seq, key))
+
+    def _compact(self):
+        ## Ricostruisce l'heap quando le voci obsolete superano quelle valide
+        if len(self._heap) > 4 * len(self._entries) + 64:
+            self._heap = []
+            for key, (fire_time, seq, _) in self._entries.items():
+                if self.on_prefetch is not None:
+                    self._heap.append((fire_time - self.prefetch_window, PREFETCH, seq, key))
+                self._heap.append((fire_time, FIRE, seq, key))
+            heapq.heapify(self._heap)
+
+    def _valid_top(self):
+        ## Scarta le voci obsolete in cima all'heap e restituisce la prima valida
+        while self._heap:
+            when, kind, seq, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == seq:
+                return when, kind, key, entry
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop_due(self, now):
+        ## Estrae tutte le voci scadute (prefetch e trigger)
+        due = []
+        while True:
+            top = self._valid_top()
+            if top is None or top[0] > now:
+                break
+            heapq.heappop(self._heap)
+            when, kind, key, (fire_time, seq, alarm) = top
+            if kind == FIRE:
+                del self._entries[key]
+                self._firing[key] = alarm
+                self._forget_fired(fire_time)
+                self._fired[key] = fire_time
+            due.append((kind, key, alarm, fire_time))
+        return due
+
+    def _forget_fired(self, minute):
+        ## I minuti già passati non servono più: schedule() parte comunque dal minuto corrente
+        for key in [key for key, fired in self._fired.items() if fired < minute]:
+            del self._fired[key]
+
+    def _wake(self):
+        ## Risveglia il thread dello scheduler (da chiamare con il lock acquisito)
+        self._cond.notify()
+
+    def _take_due(self):
+        ## Restituisce le voci scadute e i secondi di attesa fino alla prossima (con il lock acquisito)
+        now = self.now()
+        due = self._pop_due(now)
+        if due:
+            return due, 0.0
+        top = self._valid_top()
+        delay = self.MAX_SLEEP if top is None else min((top[0] - now).total_seconds(), self.MAX_SLEEP)
+        return due, max(delay, 0.0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stop:
+                    return
+                due, delay = self._take_due()
+                if not due:
+                    self._cond.wait(delay)
+                    continue
+
+            for kind, key, alarm, fire_time in due:
+                callback = self.on_prefetch if kind == PREFETCH else self.on_fire
+                try:
+                    result = callback(key, alarm, fire_time)
+                except Exception as e:
+                    self._done(kind, key, alarm, fire_time, error=e)
+                else:
+                    self._done(kind, key, alarm, fire_time, published_at=result)
+
+    def _done(self, kind, key, alarm, fire_time, published_at=None, error=None):
+        ## Aggiorna le statistiche dopo una callback e ripianifica la sveglia se necessario
+        with self._cond:
+            if error is not None:
+                self.stats["errors"] += 1
+            else:
+                self.stats["prefetched" if kind == PREFETCH else "fired"] += 1
+        if error is not None:
+            log.error("alarm callback failed", extra={"device_id": key[0], "alarm_id": key[1],
+                                                      "kind": "prefetch" if kind == PREFETCH else "fire", "error": str(error)})
+        if kind == PREFETCH:
+            return
+
+        if error is None:
+            # on_fire può restituire l'istante di pubblicazione, altrimenti si usa l'istante attuale
+            latency = ((published_at or self.now()) - fire_time).total_seconds()
+            with self._cond:
+                self._latencies.append(latency)
+
+        # Le sveglie ricorrenti vengono ripianificate dal minuto successivo,
+        # a meno che nel frattempo non siano state modificate o rimosse
+        with self._cond:
+            if self._firing.get(key) is not alarm:
+                return
+        self.schedule(key, alarm, after=fire_time + timedelta(minutes=1))
+
+
+class AsyncAlarmScheduler(AlarmScheduler):
+    """Variante di AlarmScheduler che gira come task sull'event loop asyncio.
+
+    Le callback possono essere funzioni normali o coroutine. schedule() e
+    unschedule() possono essere chiamati anche da altri thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = None
+        self._event = None
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stop = False
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+            self._task = self._loop.create_task(self._run_async(), name="alarm-scheduler")
+        return self
+
+    async def stop(self, timeout=5.0):
+        with self._cond:
+            self._stop = True
+            self._wake()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                self._task.cancel()
+
+    def _wake(self):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    async def _run_async(self):
+        while not self._stop:
+            self._event.clear()
+            with self._cond:
+                due, delay = self._take_due()
+            if not due:
+                try:
+                    await asyncio.wait_for(self._event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for kind, key, alarm, fire_time in due:
+                callback = self.on_prefetch if kind == PREFETCH else self.on_fire
+                try:
+                    result = callback(key, alarm, fire_time)
+                    if inspect.isawaitable(result):
+                        result = await result
+                except Exception as e:
+                    self._done(kind, key, alarm, fire_time, error=e)
+                else:
+                    self._done(kind, key, alarm, fire_time, published_at=result)
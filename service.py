@@ -0,0 +1,855 @@
+"""Logica del proxy condivisa tra la modalità sincrona (proxy.py) e quella asincrona (proxy_async.py).
+
+ProxyService contiene i componenti (dispositivi, sveglie, occupazione, ...) e le
+operazioni degli endpoint HTTP, dei messaggi MQTT, dello scheduler e del cluster.
+Le operazioni aggiornano lo stato in memoria e restituiscono un Result con la
+risposta e l'I/O ancora da fare (comandi e messaggi MQTT, scritture su AlarmDB):
+ogni proxy lo esegue con i propri client, direttamente in proxy.py e con await o
+asyncio.to_thread in proxy_async.py. Ai due proxy resta solo il livello di
+trasporto: richieste e risposte HTTP, client MQTT e InfluxDB, thread o task.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from datetime import timedelta
+
+from aggregates import PressureAggregator, InvalidResolution
+from alarm_store import AlarmStore, AlarmListingCache, parse_listing_args
+from cluster import ShardCoordinator
+from delivery import CommandDelivery
+from devices import DeviceRegistry, InvalidDeviceId, DEFAULT_DEVICE_ID
+from ingest import PathStats
+from observability import Registry
+from occupancy import OccupancyEngine, load_model
+from outcomes import AlarmOutcomes
+from spool import SampleSpool
+from samples import parse_batch, sample_json, validate_pressure, InvalidBatch, occupancy_record, outcome_record
+from sampling import SamplingController
+from scheduler import InvalidAlarm, validate_alarm
+from timeseries import RecentSeries, concat, to_json
+from utils import AlarmDB, load_alarms_from
+from weather import WeatherCache, weather_sound
+
+
+log = logging.getLogger(__name__)
+
+# Topic MQTT per dispositivo: iot/bed_alarm/<device_id>/<comando> (vedi Device.topic)
+mqtt_topic_sampling_rate = "sampling_rate"
+mqtt_topic_stop_alarm = "stop_alarm"
+mqtt_topic_alarm_sound = "alarm_sound"
+mqtt_topic_trigger_alarm = "trigger_alarm"
+mqtt_topic_occupancy = "occupancy"
+mqtt_topic_pressure = "pressure"
+mqtt_topic_ack = "ack"
+mqtt_topic_status = "status"
+
+# Finestra massima di GET /pressure?minutes=... (una settimana)
+MAX_QUERY_MINUTES = 7 * 24 * 60
+
+# Suono usato quando il meteo non è disponibile
+DEFAULT_ALARM_SOUND = 1
+
+# Header aggiunto alle richieste inoltrate al worker proprietario dello shard (modalità cluster)
+FORWARD_HEADER = "X-Forwarded-By-Worker"
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "content-encoding", "host"}
+
+
+def ingest_settings():
+    """Parametri della pipeline di ingest (IngestPipeline o AsyncIngestPipeline) dalle variabili d'ambiente."""
+    return {
+        "max_queue": int(os.getenv("ingest_max_queue", 10000)),
+        "batch_size": int(os.getenv("ingest_batch_size", 500)),
+        "max_batch_age": float(os.getenv("ingest_max_batch_age", 1.0)),
+        "spool_file": os.getenv("ingest_spool_file", "ingest_spool.lp"),
+        # I campioni di pressione non scritti vanno nello spool compatto a segmenti
+        # (una directory per worker in modalità cluster: i segmenti non si condividono)
+        "sample_spool": SampleSpool(
+            os.getenv("ingest_spool_dir", os.path.join("ingest_spool", os.getenv("worker_id", ""))),
+            segment_bytes=int(float(os.getenv("spool_segment_mb", 4)) * 1024 * 1024),
+            max_bytes=int(float(os.getenv("spool_max_mb", 256)) * 1024 * 1024),
+        ),
+        "replay_batch_size": int(os.getenv("spool_replay_batch_size", 10000)),
+    }
+
+
+def live_settings():
+    """Parametri dell'hub degli eventi live (LiveHub o AsyncLiveHub)."""
+    return {
+        "client_buffer": int(os.getenv("live_client_buffer", 256)),
+        "max_clients": int(os.getenv("live_max_clients", 200)),
+        "heartbeat": float(os.getenv("live_heartbeat", 15)),
+    }
+
+
+def scheduler_settings():
+    """Parametri dello scheduler delle sveglie (AlarmScheduler o AsyncAlarmScheduler)."""
+    return {"prefetch_window": timedelta(minutes=float(os.getenv("weather_prefetch_minutes", 5)))}
+
+
+class Result:
+    """Esito di un'operazione: risposta HTTP (corpo, status, header) e I/O da eseguire.
+
+    body è un oggetto da serializzare in JSON oppure una stringa da restituire così com'è.
+    """
+
+    def __init__(self, body=None, status=200, headers=None):
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+        self.commands = []   # (device, comando, payload): consegnati e tracciati da CommandDelivery
+        self.messages = []   # (topic, payload, retain): pubblicati senza attendere conferma
+        self.writes = []     # (funzione, argomenti): scritture bloccanti su AlarmDB
+        self.forwards = []   # (url, device_id, campioni): campioni di altri shard da inoltrare al proprietario
+
+    def command(self, device, command, payload):
+        self.commands.append((device, command, payload))
+        return self
+
+    def publish(self, topic, payload, retain=False):
+        self.messages.append((topic, payload, retain))
+        return self
+
+    def write(self, fn, *args):
+        self.writes.append((fn, args))
+        return self
+
+    def forward(self, owner_url, device_id, samples):
+        self.forwards.append((owner_url, device_id, samples))
+        return self
+
+    def has_io(self):
+        return bool(self.commands or self.messages or self.writes or self.forwards)
+
+
+def error(message, status=400, headers=None):
+    return Result({"status": "error", "message": message}, status, headers)
+
+
+class ProxyService:
+    """Stato e operazioni del proxy, indipendenti dal trasporto.
+
+    I componenti che dipendono dalla modalità (pipeline di ingest, hub live,
+    scheduler) vengono creati dal proxy e passati al costruttore; gli altri sono
+    configurati qui dalle variabili d'ambiente. alarm_db e cluster vengono aperti
+    all'avvio del proxy (open_alarm_db(), open_cluster()), non alla creazione.
+    """
+
+    def __init__(self, ingest, live, scheduler, started_at=None):
+        self.ingest = ingest
+        self.live = live
+        self.scheduler = scheduler
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+
+        # Cache delle condizioni meteo per location (TTL in secondi)
+        self.weather_api_key = os.getenv("weather_api_key")
+        self.weather_cache = WeatherCache(
+            self.weather_api_key,
+            ttl=float(os.getenv("weather_ttl", 600)),
+            api_url=os.getenv("weather_api_url", "http://api.openweathermap.org/data/2.5/weather"),
+        )
+
+        # Registro dei dispositivi: ogni letto ha le proprie impostazioni e sveglie
+        self.devices = DeviceRegistry(sampling_rate=5, alarm_sound=1, weather_location="Bologna")
+
+        # Sveglie di tutti i dispositivi: indice in memoria (AlarmStore) e archivio su SQLite (AlarmDB)
+        self.alarms = AlarmStore()
+        self.alarm_listings = AlarmListingCache(self.alarms)
+        self.alarm_filename = os.getenv("alarm_db", "alarms.db")
+        self.legacy_alarm_filename = "alarms.json"
+        self.alarm_db = None
+
+        # Modalità cluster (opzionale): con cluster_db più processi si dividono i dispositivi per shard
+        self.cluster = None
+
+        # Classificatore di occupazione del letto (modello esportato da training.py, se presente)
+        self.occupancy = OccupancyEngine(load_model(os.getenv("occupancy_model", "occupancy_model.json")))
+
+        # Statistiche per percorso di ingest (HTTP e MQTT), per confrontarne throughput e latenza
+        self.ingest_paths = {"http": PathStats(), "mqtt": PathStats()}
+
+        # Comandi QoS 1 con conferma dal firmware su <device>/ack e ritentativi finché non arriva
+        self.commands = CommandDelivery(
+            min_backoff=float(os.getenv("command_min_backoff", 2)),
+            max_backoff=float(os.getenv("command_max_backoff", 60)),
+        )
+
+        # Aggregati per dispositivo su 1 minuto e 1 ora, scritti su InfluxDB come misure separate
+        self.aggregates = PressureAggregator(grace=float(os.getenv("aggregate_grace", 5)))
+
+        # Ultimi campioni e transizioni per dispositivo in memoria, per le letture recenti senza InfluxDB
+        self.recent = RecentSeries(capacity=int(os.getenv("recent_capacity", 65536)))
+
+        # Controller del sampling rate: frequenza alta intorno alle sveglie, bassa con il letto vuoto o stabile
+        self.sampler = SamplingController(
+            self.devices, self.alarms, self.occupancy,
+            fast_rate=int(os.getenv("sampling_fast_rate", 1)),
+            stable_rate=int(os.getenv("sampling_stable_rate", 30)),
+            idle_rate=int(os.getenv("sampling_idle_rate", 60)),
+            stable_after=timedelta(minutes=float(os.getenv("sampling_stable_minutes", 10))),
+            before=timedelta(minutes=float(os.getenv("sampling_alarm_before_minutes", 5))),
+            after=timedelta(minutes=float(os.getenv("sampling_alarm_after_minutes", 30))),
+        )
+
+        # Esito delle sveglie: tempo per alzarsi e rientri a letto, dal flusso di occupazione
+        self.outcomes = AlarmOutcomes(
+            settle=float(os.getenv("outcome_settle_minutes", 5)) * 60,
+            timeout=float(os.getenv("outcome_timeout_minutes", 60)) * 60,
+        )
+
+        # Stato di avvio per /healthz e /readyz: il proxy è pronto quando l'avvio è finito
+        # e InfluxDB e il broker MQTT rispondono
+        self.readiness = {"started": False, "influxdb": False, "mqtt": False}
+        self.startup_stats = {"ready_after_s": None}
+        self.startup_budget = float(os.getenv("startup_budget", 3.0))
+        self._readiness_lock = threading.Lock()
+
+        # Metriche esposte su /metrics (formato Prometheus); quelle di HTTP, InfluxDB e MQTT le aggiunge il proxy
+        self.metrics = Registry(prefix="iot_")
+        self.metrics.collect_stats("ingest", self.ingest.get_stats)
+        self.metrics.collect_stats("ingest_path", lambda: {name: path.get_stats() for name, path in self.ingest_paths.items()})
+        self.metrics.collect_stats("aggregates", self.aggregates.get_stats)
+        self.metrics.collect_stats("scheduler", self.scheduler.get_stats)
+        self.metrics.collect_stats("sampling", self.sampler.get_stats)
+        self.metrics.collect_stats("delivery", self.commands.get_stats)
+        self.metrics.collect_stats("recent", self.recent.get_stats)
+        self.metrics.collect_stats("alarm_outcomes", self.outcomes.get_stats)
+        self.metrics.collect_stats("live", self.live.get_stats)
+        self.metrics.collect_stats("startup", lambda: {**self.startup_stats, "ready": all(self.readiness.values())})
+        self.metrics.collect_stats("weather_cache", self.weather_cache.get_stats)
+        self.metrics.collect_stats("alarm_listing_cache", lambda: {"hits": self.alarm_listings.hits,
+                                                                   "misses": self.alarm_listings.misses})
+        self.metrics.collect_stats("inventory", lambda: {"devices": len(self.devices.all()), "alarms": len(self.alarms)})
+
+    # ----- Avvio ----- #
+    def open_alarm_db(self):
+        """Apre AlarmDB, con la migrazione una tantum dal vecchio alarms.json (bloccante)."""
+        self.alarm_db = AlarmDB(self.alarm_filename)
+        if self.alarm_db.count() == 0 and os.path.exists(self.legacy_alarm_filename):
+            self.alarm_db.save_many(load_alarms_from(self.legacy_alarm_filename))
+        return self.alarm_db
+
+    def open_cluster(self, default_url):
+        """Crea lo ShardCoordinator se cluster_db è impostato (bloccante: apre il database condiviso)."""
+        if not os.getenv("cluster_db"):
+            return None
+        self.cluster = ShardCoordinator(
+            os.getenv("cluster_db"),
+            worker_id=os.getenv("worker_id"),
+            url=os.getenv("worker_url", default_url),
+            shards=int(os.getenv("cluster_shards", 64)),
+            lease_ttl=float(os.getenv("cluster_lease_ttl", 15)),
+        )
+        self.metrics.collect_stats("cluster", self.cluster.get_stats)
+        return self.cluster
+
+    def load_alarms(self, rows, summaries):
+        """Sveglie ed esiti letti da AlarmDB all'avvio (senza cluster): indicizzate e pianificate."""
+        for alarm in rows:
+            if not self._valid_row(alarm):
+                continue
+            self.devices.get(alarm["device_id"])
+            self.alarms.add(alarm)
+            self.scheduler.schedule(AlarmStore.key(alarm), alarm)
+        self.outcomes.load(summaries)
+        log.info("alarms loaded", extra={"alarms": len(self.alarms)})
+
+    @staticmethod
+    def _valid_row(alarm):
+        ## Le righe di AlarmDB non valide (es. scritte da versioni precedenti) vengono saltate, non fermano l'avvio
+        alarm.setdefault("device_id", DEFAULT_DEVICE_ID)
+        try:
+            DeviceRegistry.validate(alarm["device_id"])
+            if alarm.get("alarm_id") is None:
+                raise InvalidAlarm("missing alarm_id")
+            validate_alarm(alarm.get("alarm_time"), alarm.get("alarm_frequency"))
+        except (InvalidDeviceId, InvalidAlarm) as e:
+            log.warning("invalid alarm skipped", extra={"device_id": alarm.get("device_id"),
+                                                        "alarm_id": alarm.get("alarm_id"), "error": str(e)})
+            return False
+        return True
+
+    def set_ready(self, check, ok):
+        with self._readiness_lock:
+            self.readiness[check] = ok
+            if not all(self.readiness.values()) or self.startup_stats["ready_after_s"] is not None:
+                return
+            elapsed = time.perf_counter() - self.started_at
+            self.startup_stats["ready_after_s"] = elapsed
+        if elapsed > self.startup_budget:
+            log.warning("startup over budget", extra={"startup_s": round(elapsed, 3), "budget_s": self.startup_budget})
+        else:
+            log.info("proxy ready", extra={"startup_s": round(elapsed, 3)})
+
+    def healthz(self):
+        return Result({"status": "ok", "uptime_s": round(time.perf_counter() - self.started_at, 3)})
+
+    def readyz(self):
+        ready = all(self.readiness.values())
+        return Result({
+            "ready": ready,
+            "checks": dict(self.readiness),
+            "startup_s": self.startup_stats["ready_after_s"],
+            "budget_s": self.startup_budget,
+        }, 200 if ready else 503)
+
+    # ----- Cluster ----- #
+    def is_local(self, device_id):
+        """In modalità cluster ogni worker gestisce solo i dispositivi dei propri shard."""
+        return self.cluster is None or self.cluster.owns(device_id)
+
+    def route(self, device_id, forwarded=False):
+        """Chi serve una richiesta per il dispositivo: None se questo worker, l'URL del proprietario,
+        o un Result 503 se lo shard è in transizione (lease scaduto o non ancora acquisito)."""
+        if self.is_local(device_id):
+            return None
+        owner = self.cluster.owner(device_id)
+        if owner is None or owner[0] == self.cluster.worker_id or forwarded:
+            return error("Device shard is moving, retry", 503, {"Retry-After": "1"})
+        return owner[1]
+
+    def load_shards(self, shards, rows, summaries):
+        """Shard acquisiti: le loro sveglie (rows, da AlarmDB) vengono indicizzate e pianificate.
+
+        Le sveglie vengono pianificate da adesso e non dall'inizio del minuto: se il
+        passaggio avviene nel minuto di una sveglia, il worker precedente l'ha già fatta suonare.
+        """
+        now = self.scheduler.now()
+        loaded = 0
+        for alarm in rows:
+            if not self._valid_row(alarm) or self.cluster.shard(alarm["device_id"]) not in shards:
+                continue
+            key = AlarmStore.key(alarm)
+            self.devices.get(alarm["device_id"])
+            self.alarms.remove(*key)
+            self.alarms.add(alarm)
+            self.scheduler.schedule(key, alarm, after=now)
+            loaded += 1
+        self.outcomes.load({device_id: summary for device_id, summary in summaries.items()
+                            if self.cluster.shard(device_id) in shards})
+        log.info("shards acquired", extra={"shards": sorted(shards), "alarms": loaded})
+
+    def unload_shards(self, shards):
+        """Shard persi: le loro sveglie e i loro dispositivi non sono più di questo worker."""
+        for device in self.devices.all():
+            if self.cluster.shard(device.device_id) in shards:
+                for alarm in self.alarms.remove_device(device.device_id):
+                    self.scheduler.unschedule((device.device_id, alarm["alarm_id"]))
+                self.outcomes.forget(device.device_id)
+                self.devices.remove(device.device_id)
+        log.info("shards released", extra={"shards": sorted(shards)})
+
+    def cluster_status(self):
+        if self.cluster is None:
+            return error("Cluster mode disabled", 404)
+        return Result(self.cluster.status())
+
+    # ----- Eventi live ----- #
+    def publish_settings(self, device):
+        self.live.publish("device", device.device_id, device.settings())
+
+    def publish_alarms(self, device_id):
+        self.live.publish("alarms", device_id, {"alarms": self.alarms.list(device_id)})
+
+    def live_filters(self, args):
+        """Filtri di GET /live: ?device=<id> (ripetibile) e ?events=pressure,occupancy,..."""
+        device_ids = set(args.getlist("device")) or None
+        for device_id in device_ids or ():
+            self.devices.validate(device_id)
+        events = set(filter(None, args.get("events", "").split(","))) or None
+        return device_ids, events
+
+    def live_snapshot(self, device_ids=None):
+        ## Stato attuale dei dispositivi: la dashboard parte da qui e poi applica gli eventi
+        snapshot = []
+        for device in self.devices.all():
+            if device_ids is not None and device.device_id not in device_ids:
+                continue
+            snapshot.append({
+                **device.settings(),
+                "occupancy": self.occupancy.state(device.device_id),
+                "alarms": self.alarms.list(device.device_id),
+            })
+        return {"devices": snapshot}
+
+    # ----- Impostazioni dei dispositivi ----- #
+    def list_devices(self):
+        return Result({"devices": [
+            {**device.settings(), "alarms": self.alarms.count(device.device_id)} for device in self.devices.all()
+        ]})
+
+    def update_sampling_rate(self, device_id, data):
+        device = self.devices.get(device_id)
+        if 'sampling_rate' in data:
+            device.sampling_rate = int(data['sampling_rate'])
+        if 'adaptive' in data:
+            device.adaptive_sampling = str(data['adaptive']).lower() == "true"
+
+        # Il valore manuale è la base del controller: al firmware va la frequenza effettiva
+        self.sampler.refresh(device)
+        result = Result({
+            "device_id": device_id,
+            "sampling_rate": device.sampling_rate,
+            "adaptive": device.adaptive_sampling,
+            "effective_sampling_rate": device.effective_sampling_rate,
+            "sampling_mode": device.sampling_mode,
+            "status": "success",
+        })
+        result.command(device, mqtt_topic_sampling_rate, {"sampling_rate": device.effective_sampling_rate})
+
+        self.publish_settings(device)
+        log.info("updated sampling rate", extra={
+            "device_id": device_id,
+            "sampling_rate": device.sampling_rate,
+            "effective_sampling_rate": device.effective_sampling_rate,
+            "sampling_mode": device.sampling_mode,
+        })
+        return result
+
+    def update_stop_alarm(self, device_id, data):
+        device = self.devices.get(device_id)
+        result = Result()
+        if 'stop_alarm' in data:
+            device.stop_alarm = data['stop_alarm'] == "true"
+            result.command(device, mqtt_topic_stop_alarm, {"stop_alarm": device.stop_alarm})
+            if device.stop_alarm:
+                self.sampler.alarm_stopped(device_id)
+                self.outcomes.stopped(device_id, time.time_ns())
+                self.refresh_sampling_rate(device, result)
+
+        self.publish_settings(device)
+        log.info("updated stop alarm", extra={"device_id": device_id, "stop_alarm": device.stop_alarm})
+        result.body = {"device_id": device_id, "stop_alarm": device.stop_alarm, "status": "success"}
+        return result
+
+    def update_alarm_sound(self, device_id, data):
+        device = self.devices.get(device_id)
+        result = Result()
+        if 'alarm_sound' in data:
+            device.alarm_sound = data['alarm_sound']
+            result.command(device, mqtt_topic_alarm_sound, {"alarm_sound": device.alarm_sound})
+
+        self.publish_settings(device)
+        log.info("updated alarm sound", extra={"device_id": device_id, "alarm_sound": device.alarm_sound})
+        result.body = {"device_id": device_id, "alarm_sound": device.alarm_sound, "status": "success"}
+        return result
+
+    def set_alarm_location(self, device_id, data):
+        device = self.devices.get(device_id)
+        # Se non viene fornita una location, utilizza quella attuale
+        location = data.get("location", device.weather_location)
+        if not isinstance(location, str) or not location.strip():
+            return error("Invalid location")
+        device.weather_location = location
+        self.publish_settings(device)
+        return Result({"device_id": device_id, "location": device.weather_location, "status": "success"}, 201)
+
+    # ----- Sveglie ----- #
+    def set_new_alarm(self, device_id, data):
+        self.devices.get(device_id)
+        alarm_id = data.get("alarm_id")
+        alarm_time = data.get("alarm_time")
+        alarm_frequency = data.get("alarm_frequency")
+
+        # Controllo se alarm_id è già presente
+        if (device_id, alarm_id) in self.alarms:
+            return error("Alarm ID already exists")
+
+        # Controllo se alarm_time è presente e valido
+        if not alarm_time:
+            return error("Missing required fields")
+        try:
+            validate_alarm(alarm_time, alarm_frequency)
+        except InvalidAlarm as e:
+            return error(str(e))
+
+        alarm = {
+            "alarm_id": alarm_id,
+            "alarm_time": alarm_time,
+            "alarm_frequency": alarm_frequency,
+            "active": True,
+            "device_id": device_id
+        }
+
+        if not self.alarms.add(alarm):
+            return error("Alarm ID already exists")
+        log.info("alarm created", extra=alarm)
+        self.scheduler.schedule((device_id, alarm_id), alarm)
+        self.publish_alarms(device_id)
+        return Result({"status": "success", "message": "Alarm set successfully"}, 201).write(self.alarm_db.save, alarm)
+
+    def alarm_listing(self, device_id, args):
+        """(etag, corpo JSON) di GET /alarms; InvalidQuery se i filtri non sono validi."""
+        self.devices.validate(device_id)
+        return self.alarm_listings.get(device_id, **parse_listing_args(args))
+
+    def modify_alarm(self, device_id, alarm_id, data):
+        self.devices.validate(device_id)
+        alarm = self.alarms.get(device_id, alarm_id)
+        if alarm is None:
+            return Result({"error": "Alarm not found"}, 400)
+
+        alarm_time = data.get("alarm_time", alarm["alarm_time"])
+        alarm_frequency = data.get("alarm_frequency", alarm["alarm_frequency"])
+        try:
+            validate_alarm(alarm_time, alarm_frequency)
+        except InvalidAlarm as e:
+            return error(str(e))
+
+        alarm = self.alarms.update(
+            device_id, alarm_id,
+            alarm_time=alarm_time,
+            alarm_frequency=alarm_frequency,
+            active=str(data.get("active", alarm["active"])).lower() == "true",
+        )
+        if alarm is None:
+            return Result({"error": "Alarm not found"}, 400)
+
+        self.scheduler.schedule((device_id, alarm_id), alarm)
+        self.publish_alarms(device_id)
+        return Result({"message": "Alarm updated successfully", "alarm": alarm}, 201).write(self.alarm_db.save, alarm)
+
+    def remove_alarm(self, device_id, alarm_id):
+        self.devices.validate(device_id)
+        if self.alarms.remove(device_id, alarm_id) is None:
+            return Result({"message": "Alarm was not deleted."}, 400)
+
+        self.scheduler.unschedule((device_id, alarm_id))
+        self.publish_alarms(device_id)
+        return Result({"message": "Alarm deleted successfully"}, 201).write(self.alarm_db.delete, device_id, alarm_id)
+
+    def remove_all_alarms(self, device_id):
+        self.devices.validate(device_id)
+        for alarm in self.alarms.remove_device(device_id):
+            self.scheduler.unschedule((device_id, alarm["alarm_id"]))
+        self.publish_alarms(device_id)
+        return Result({"message": "All alarms deleted successfully"}, 201).write(self.alarm_db.delete_device, device_id)
+
+    # ----- Ingest ----- #
+    def ingest_sample(self, device_id, pressure_value, timestamp=None, result=None):
+        """Accoda un campione per InfluxDB e aggiorna la stima di occupazione del letto.
+
+        Restituisce False se la coda di ingest è piena. L'I/O delle transizioni di
+        occupazione (pubblicazione MQTT, sampling rate) viene aggiunto a `result`.
+        """
+        # Il timestamp viene fissato alla ricezione perché la scrittura avviene in differita
+        if timestamp is None:
+            timestamp = time.time_ns()
+
+        if not self.ingest.put_sample(device_id, pressure_value, timestamp):
+            return False
+        self.aggregates.add(device_id, pressure_value, timestamp)
+        self.recent.add(device_id, pressure_value, timestamp)
+        self.live.publish("pressure", device_id, {"value": pressure_value, "t": timestamp // 1_000_000})
+
+        transition = self.occupancy.update(device_id, pressure_value, timestamp)
+        if transition is not None:
+            self.publish_occupancy(self.devices.get(device_id), transition, result if result is not None else Result())
+        return True
+
+    def publish_occupancy(self, device, transition, result):
+        ## Le transizioni di occupazione vengono salvate su InfluxDB e pubblicate su MQTT
+        self.ingest.put(occupancy_record(device.device_id, transition["occupied"], transition["probability"],
+                                         transition["timestamp"]))
+        self.recent.add_transition(device.device_id, transition["occupied"], transition["probability"],
+                                   transition["timestamp"])
+        self.outcomes.transition(device.device_id, transition["occupied"], transition["timestamp"])
+        self.live.publish("occupancy", device.device_id, {
+            "occupied": transition["occupied"],
+            "probability": round(transition["probability"], 3),
+            "t": transition["timestamp"] // 1_000_000,
+        })
+        result.publish(device.topic(mqtt_topic_occupancy), {
+            "occupied": transition["occupied"],
+            "probability": round(transition["probability"], 3),
+        }, retain=True)
+        # Es. il letto torna occupato mentre il dispositivo è in modalità idle
+        self.refresh_sampling_rate(device, result)
+
+    def sensor_data(self, device_id, data, forwarded=False):
+        result = Result("OK", 201)
+        if data and 'pressure_value' in data:
+            try:
+                pressure_value = validate_pressure(float(data['pressure_value']))
+            except (TypeError, ValueError):
+                return error("Invalid pressure_value")
+            # Il firmware può indicare il proprio ID anche nel payload
+            device_id = self.devices.validate(data.get("device_id", device_id))
+            timestamp = time.time_ns()
+
+            # L'ID nel payload può appartenere a uno shard di un altro worker
+            owner = self.route(device_id, forwarded)
+            if isinstance(owner, Result):
+                return owner
+            if owner is not None:
+                return result.forward(owner, device_id, [sample_json(device_id, pressure_value, timestamp)])
+
+            self.ingest_paths["http"].record(data.get("sent_at"))
+            if not self.ingest_sample(device_id, pressure_value, timestamp, result):
+                result.body, result.status = "Ingest queue full", 503
+        return result
+
+    def sensor_data_batch(self, device_id, body, content_type, forwarded=False):
+        self.devices.validate(device_id)
+        try:
+            batch = parse_batch(body, content_type, device_id)
+        except InvalidBatch as e:
+            return Result({"status": "error", "errors": e.args[0][:20]}, 400)
+
+        # In modalità cluster i campioni di altri shard vanno ai rispettivi proprietari, uno per worker
+        local, remote = [], {}
+        for sample in batch:
+            owner = self.route(sample[0], forwarded)
+            if isinstance(owner, Result):
+                return owner
+            if owner is None:
+                local.append(sample)
+            else:
+                remote.setdefault(owner, []).append(sample)
+
+        result = Result({"status": "success", "accepted": len(batch)}, 201)
+        for owner_url, samples in remote.items():
+            result.forward(owner_url, samples[0][0], [sample_json(*sample) for sample in samples])
+        for accepted, (sample_device, pressure_value, timestamp) in enumerate(local):
+            self.ingest_paths["http"].record()
+            if not self.ingest_sample(sample_device, pressure_value, timestamp, result):
+                result.body = {"status": "error", "message": "Ingest queue full", "accepted": accepted}
+                result.status = 503
+                result.forwards.clear()
+                break
+        return result
+
+    def forward_failed(self, result, owner_url, device_id, reason):
+        """Inoltro dei campioni non riuscito: il client ritenta l'intera richiesta."""
+        log.warning("forward to shard owner failed", extra={"device_id": device_id, "owner": owner_url, "error": reason})
+        result.body = {"status": "error", "message": "Device shard owner unreachable, retry"}
+        result.status = 503
+        result.headers["Retry-After"] = "1"
+
+    def write_aggregates(self, records):
+        for record in records:
+            if not self.ingest.put(record):
+                log.warning("ingest queue full, dropping aggregate", extra={"record": record})
+
+    def ingest_stats(self):
+        stats = self.ingest.get_stats()
+        stats["paths"] = {name: path.get_stats() for name, path in self.ingest_paths.items()}
+        return Result(stats)
+
+    # ----- MQTT in ingresso ----- #
+    def on_ack(self, topic, payload):
+        ## Conferma di un comando dal firmware: {"cmd_id": ...}
+        device_id = topic.split("/")[-2]
+        if not self.is_local(device_id):
+            return
+        try:
+            cmd_id = int(json.loads(payload)["cmd_id"])
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning("invalid ack", extra={"topic": topic, "error": str(e)})
+            return
+        latency = self.commands.ack(device_id, cmd_id)
+        if latency is not None:
+            log.debug("command acknowledged", extra={"device_id": device_id, "cmd_id": cmd_id,
+                                                     "latency_ms": round(latency * 1000, 1)})
+
+    def on_status(self, topic, payload):
+        ## Stato della connessione del firmware (retained, "offline" è il last will)
+        if not self.is_local(topic.split("/")[-2]):
+            return
+        try:
+            device = self.devices.get(topic.split("/")[-2])
+        except InvalidDeviceId:
+            return
+        device.online = payload == b"online"
+        if device.online:
+            # Riconnessione: i comandi non confermati non aspettano il prossimo backoff
+            self.commands.device_online(device.device_id)
+        self.publish_settings(device)
+
+    def on_pressure(self, topic, payload):
+        """Telemetria via MQTT: iot/bed_alarm/<device_id>/pressure con payload {"pressure_value": ...} o un numero."""
+        result = Result()
+        device_id = topic.split("/")[-2]
+        if not self.is_local(device_id):
+            return result
+        try:
+            self.devices.validate(device_id)
+            data = json.loads(payload)
+            if not isinstance(data, dict):
+                data = {"pressure_value": data}
+            pressure_value = validate_pressure(float(data["pressure_value"]))
+        except (InvalidDeviceId, ValueError, KeyError, TypeError) as e:
+            log.warning("invalid telemetry", extra={"topic": topic, "error": str(e)})
+            return result
+
+        self.ingest_paths["mqtt"].record(data.get("sent_at"))
+        self.ingest_sample(device_id, pressure_value, result=result)
+        return result
+
+    # ----- Sampling rate ----- #
+    def apply_sampling_rate(self, device, result=None):
+        result = result if result is not None else Result()
+        result.command(device, mqtt_topic_sampling_rate, {"sampling_rate": device.effective_sampling_rate})
+        self.publish_settings(device)
+        log.info("sampling rate changed", extra={
+            "device_id": device.device_id,
+            "effective_sampling_rate": device.effective_sampling_rate,
+            "sampling_mode": device.sampling_mode,
+        })
+        return result
+
+    def refresh_sampling_rate(self, device, result=None):
+        result = result if result is not None else Result()
+        if self.sampler.refresh(device):
+            self.apply_sampling_rate(device, result)
+        return result
+
+    # ----- Letture ----- #
+    def occupancy_state(self, device_id):
+        self.devices.validate(device_id)
+        state = self.occupancy.state(device_id)
+        if state is None:
+            return error("No data for device", 404)
+        return Result(state)
+
+    def pressure_aggregates(self, device_id, args):
+        ## Aggregati recenti dalla memoria (min/max/media per minuto o per ora)
+        self.devices.validate(device_id)
+        resolution = args.get("resolution", "1m")
+        try:
+            since = args.get("since", type=int)
+            until = args.get("until", type=int)
+            buckets = self.aggregates.query(
+                device_id, resolution,
+                since=since * 1_000_000 if since is not None else None,
+                until=until * 1_000_000 if until is not None else None,
+            )
+        except InvalidResolution as e:
+            return error(str(e))
+        return Result({"device_id": device_id, "resolution": resolution, "buckets": buckets})
+
+    def pressure_query(self, device_id, args, now=None):
+        """Prima parte di GET /pressure (since/until in ms, oppure gli ultimi `minutes` minuti).
+
+        Restituisce (since, until, covered, serie dalla memoria), con gli istanti in ns:
+        l'intervallo [since, min(until, covered)) va letto da InfluxDB se since < covered.
+        Restituisce un Result di errore se i parametri non sono validi.
+        """
+        self.devices.validate(device_id)
+        now = now or time.time_ns()
+        since = args.get("since", type=int)
+        until = args.get("until", type=int)
+        try:
+            minutes = float(args.get("minutes", 60))
+        except (TypeError, ValueError):
+            minutes = math.nan
+        if not math.isfinite(minutes) or not 0 < minutes <= MAX_QUERY_MINUTES:
+            return error(f"minutes must be a number between 0 and {MAX_QUERY_MINUTES}")
+        since = since * 1_000_000 if since is not None else now - int(minutes * 60e9)
+        until = until * 1_000_000 if until is not None else now
+        if since > until:
+            return error("since must not be after until")
+
+        covered = self.recent.covered_since(device_id)
+        return since, until, covered, self.recent.query(device_id, max(since, covered), until)
+
+    def pressure_result(self, device_id, since, until, covered, series, history=None):
+        """Risposta di GET /pressure: `history` (da InfluxDB, se letta) precede la serie in memoria."""
+        source = "memory"
+        if history is not None:
+            series = concat(history, series)
+            source = "influxdb" if until <= covered else "influxdb+memory"
+        return Result({"device_id": device_id, "since": since // 1_000_000, "until": until // 1_000_000,
+                       "source": source, **to_json(series)})
+
+    def delivery_status(self, device_id):
+        self.devices.validate(device_id)
+        return Result(self.commands.device_status(device_id))
+
+    def alarm_outcomes(self, device_id):
+        self.devices.validate(device_id)
+        return Result(self.outcomes.summary(device_id))
+
+    # ----- Alarm clock ----- #
+    def alarm_sound(self, location, stale_ok=False):
+        """Suono della sveglia in base al meteo di `location` (bloccante se il meteo non è in cache)."""
+        if self.weather_api_key and location:
+            try:
+                condition = self.weather_cache.get(location, stale_ok=stale_ok)
+            except Exception as e:
+                # Senza meteo la sveglia suona comunque, con il suono predefinito
+                log.error("weather lookup failed", extra={"location": location, "error": str(e)})
+                return DEFAULT_ALARM_SOUND
+            sound = weather_sound(condition)
+            log.info("weather sound selected", extra={"location": location, "condition": condition, "sound": sound})
+            return sound
+        return DEFAULT_ALARM_SOUND
+
+    def prefetch_location(self, alarm):
+        ## Location di cui scaricare in anticipo il meteo per una sveglia in arrivo (None se non serve)
+        device = self.devices.get(alarm.get("device_id", DEFAULT_DEVICE_ID))
+        if self.weather_api_key and device.weather_location:
+            return device.weather_location
+        return None
+
+    def alarm_device(self, key, alarm):
+        """Dispositivo di una sveglia che deve suonare, o None se lo shard non è più di questo worker."""
+        device_id = alarm.get("device_id", DEFAULT_DEVICE_ID)
+        if not self.is_local(device_id):
+            # Lease perso prima del trigger: la sveglia la fa suonare il nuovo proprietario dello shard
+            log.warning("alarm skipped, shard not owned", extra={"device_id": key[0], "alarm_id": key[1]})
+            return None
+        return self.devices.get(device_id)
+
+    def ring(self, device, sound):
+        """Comandi che fanno suonare la sveglia sul firmware."""
+        return Result() \
+            .command(device, mqtt_topic_alarm_sound, {"alarm_sound": sound}) \
+            .command(device, mqtt_topic_trigger_alarm, {"trigger_alarm": "trigger_alarm"})
+
+    def alarm_fired(self, device, key, alarm, fire_time, published_at):
+        """Aggiorna lo stato dopo che i comandi di ring() sono stati pubblicati (alle published_at)."""
+        result = Result()
+        self.sampler.alarm_fired(device.device_id, fire_time)
+        self.refresh_sampling_rate(device, result)
+        state = self.occupancy.state(device.device_id)
+        for outcome in self.outcomes.fired(device.device_id, alarm.get("alarm_id"), time.time_ns(),
+                                           state["occupied"] if state is not None else None):
+            self.record_outcome(*outcome, result=result)
+
+        if alarm.get("alarm_frequency", "once") == "once":
+            # Disattiva la sveglia dopo il trigger once perché non deve essere più attiva, negli altri casi rimane attiva per la prossima esecuzione
+            updated = self.alarms.update(*key, active=False)
+            if updated is not None:
+                result.write(self.alarm_db.save, updated)
+                self.scheduler.schedule(key, updated)
+                self.publish_alarms(device.device_id)
+
+        self.live.publish("alarm", device.device_id, {"alarm_id": alarm.get("alarm_id"),
+                                                      "fire_time": fire_time.strftime("%H:%M"),
+                                                      "t": int(published_at.timestamp() * 1000)})
+        log.info("alarm triggered", extra={
+            "device_id": device.device_id,
+            "alarm_id": alarm.get("alarm_id", "unknown"),
+            "fire_time": fire_time.strftime("%H:%M"),
+            "weekday": fire_time.weekday(),
+            "lag_ms": round((published_at - fire_time).total_seconds() * 1000, 1),
+        })
+        return result
+
+    def record_outcome(self, device_id, outcome, summary, result=None):
+        ## Ogni esito aggiorna il riepilogo su SQLite e viene scritto anche su InfluxDB
+        result = result if result is not None else Result()
+        result.write(self.alarm_db.save_outcomes, device_id, summary)
+        self.ingest.put(outcome_record(device_id, outcome, outcome["fired_at"] * 1_000_000))
+        self.live.publish("outcome", device_id, outcome)
+        log.info("alarm outcome", extra={"device_id": device_id, **outcome})
+        return result
+
+    def scheduler_stats(self):
+        return Result(self.scheduler.get_stats())
+
+    def weather_stats(self):
+        return Result(self.weather_cache.get_stats())
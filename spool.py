@@ -0,0 +1,323 @@
+"""Spool su disco dei campioni di pressione non scritti su InfluxDB.
+
+I campioni sono salvati come record a larghezza fissa di 10 byte in file segmento
+(spool-<n>.seg) scritti in append tramite mmap:
+
+    header (64 byte): magic, versione, dimensione record, timestamp base (ns),
+                      record scritti, record già riprodotti, CRC32, flag sealed
+    record:           indice dispositivo (uint16), offset dal timestamp base in ms
+                      (int32), valore (float32)
+
+Gli ID dei dispositivi sono in una tabella comune (devices.txt, una riga per
+indice). Quando un segmento è pieno viene chiuso (sealed): si calcola il CRC dei
+record e il file viene troncato alla parte usata. La riproduzione legge solo
+segmenti chiusi, ne verifica il CRC e avanza il contatore dei record riprodotti
+nell'header, così un errore a metà non duplica i punti già scritti.
+Oltre max_bytes i segmenti più vecchi vengono eliminati.
+
+Una notte di 1000 letti a un campione ogni 5 secondi sono circa 5,8 milioni di
+record, cioè circa 58 MB.
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+MAGIC = b"IOTSPOOL"
+VERSION = 1
+HEADER = struct.Struct("<8sHHqIIII")
+HEADER_SIZE = 64
+COUNT_OFFSET = struct.calcsize("<8sHHq")   # posizione nell'header dei record scritti
+DONE_OFFSET = COUNT_OFFSET + 4             # e di quelli già riprodotti
+COUNTER = struct.Struct("<I")
+RECORD = struct.Struct("<Hif")
+RECORD_DTYPE = np.dtype([("device", "<u2"), ("offset_ms", "<i4"), ("value", "<f4")])
+MAX_DEVICES = 2 ** 16
+MAX_OFFSET_MS = 2 ** 31 - 1
+
+
+class _Segment:
+    __slots__ = ("path", "seq", "base", "count", "done", "crc", "sealed", "file", "map")
+
+    def __init__(self, path, seq):
+        self.path = path
+        self.seq = seq
+        self.base = 0
+        self.count = 0
+        self.done = 0
+        self.crc = 0
+        self.sealed = False
+        self.file = None
+        self.map = None
+
+    def write_header(self):
+        self.map[:HEADER.size] = HEADER.pack(MAGIC, VERSION, RECORD.size, self.base, self.count, self.done,
+                                             self.crc, int(self.sealed))
+
+    def size(self):
+        return HEADER_SIZE + self.count * RECORD.size
+
+
+class SampleSpool:
+    """Spool a segmenti memory-mapped per i campioni (device, timestamp, valore)."""
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.capacity = (segment_bytes - HEADER_SIZE) // RECORD.size
+        self.segment_bytes = HEADER_SIZE + self.capacity * RECORD.size
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sealed = []     # segmenti chiusi, dal più vecchio
+        self._active = None
+        self._draining = None  # segmento in lettura da drain(), escluso dalla retention
+        self._devices = []    # indice -> device_id
+        self._device_index = {}
+        self._next_seq = 0
+        self.stats = {"spooled": 0, "replayed": 0, "evicted": 0, "corrupt": 0}
+
+        os.makedirs(directory, exist_ok=True)
+        self._devices_file = os.path.join(directory, "devices.txt")
+        self._recover()
+
+    # ----- Apertura e recupero ----- #
+    def _recover(self):
+        ## Riapre i segmenti esistenti; quelli rimasti aperti (crash) vengono chiusi subito
+        if os.path.exists(self._devices_file):
+            with open(self._devices_file, "r") as file:
+                self._devices = [line.rstrip("\n") for line in file]
+            self._device_index = {device_id: i for i, device_id in enumerate(self._devices)}
+
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".seg"))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            segment = _Segment(path, int(name[len("spool-"):-len(".seg")]))
+            try:
+                with open(path, "rb") as file:
+                    magic, version, record_size, base, count, done, crc, sealed = HEADER.unpack(file.read(HEADER.size))
+            except (OSError, struct.error):
+                magic = None
+            if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+                log.error("invalid spool segment skipped", extra={"segment": path})
+                self._quarantine(path)
+                continue
+            segment.base, segment.count, segment.done, segment.crc, segment.sealed = base, count, done, crc, bool(sealed)
+            if not segment.sealed:
+                self._open(segment)
+                self._seal(segment)
+            self._sealed.append(segment)
+            self._next_seq = segment.seq + 1
+
+    def _quarantine(self, path):
+        with self._lock:
+            self.stats["corrupt"] += 1
+        try:
+            os.replace(path, path + ".bad")
+        except OSError:
+            pass
+
+    def _open(self, segment):
+        segment.file = open(segment.path, "r+b")
+        size = os.fstat(segment.file.fileno()).st_size
+        if size < self.segment_bytes and not segment.sealed:
+            segment.file.truncate(self.segment_bytes)
+            size = self.segment_bytes
+        segment.map = mmap.mmap(segment.file.fileno(), size)
+
+    def _close(self, segment):
+        if segment.map is not None:
+            segment.map.close()
+            segment.file.close()
+            segment.map = segment.file = None
+
+    def _new_segment(self, base):
+        segment = _Segment(os.path.join(self.directory, f"spool-{self._next_seq:08d}.seg"), self._next_seq)
+        self._next_seq += 1
+        segment.base = base
+        with open(segment.path, "wb") as file:
+            file.truncate(self.segment_bytes)
+        self._open(segment)
+        segment.write_header()
+        return segment
+
+    def _seal(self, segment):
+        ## Calcola il CRC dei record, tronca il file alla parte usata e lo chiude
+        segment.crc = zlib.crc32(segment.map[HEADER_SIZE:segment.size()])
+        segment.sealed = True
+        segment.write_header()
+        segment.map.flush()
+        self._close(segment)
+        os.truncate(segment.path, segment.size())
+
+    # ----- Scrittura ----- #
+    def _device(self, device_id):
+        index = self._device_index.get(device_id)
+        if index is None:
+            if len(self._devices) >= MAX_DEVICES:
+                return None
+            index = len(self._devices)
+            # La tabella va su disco prima dei record che la usano
+            with open(self._devices_file, "a") as file:
+                file.write(device_id + "\n")
+            self._devices.append(device_id)
+            self._device_index[device_id] = index
+        return index
+
+    def append(self, samples):
+        """Aggiunge campioni (device_id, valore, timestamp in ns); restituisce quanti non è riuscito a salvare."""
+        rejected = 0
+        with self._lock:
+            for device_id, value, timestamp in samples:
+                index = self._device(device_id)
+                if index is None:
+                    rejected += 1
+                    continue
+                segment = self._active
+                if segment is not None:
+                    offset = (timestamp - segment.base) // 1_000_000
+                    if segment.count >= self.capacity or not -MAX_OFFSET_MS <= offset <= MAX_OFFSET_MS:
+                        self._rotate()
+                        segment = None
+                if segment is None:
+                    segment = self._active = self._new_segment(timestamp)
+                    offset = 0
+                RECORD.pack_into(segment.map, segment.size(), index, offset, value)
+                segment.count += 1
+                COUNTER.pack_into(segment.map, COUNT_OFFSET, segment.count)
+                self.stats["spooled"] += 1
+            self._enforce_retention()
+        return rejected
+
+    def _rotate(self):
+        if self._active is not None and self._active.count:
+            self._seal(self._active)
+            self._sealed.append(self._active)
+        elif self._active is not None:
+            self._close(self._active)
+            os.remove(self._active.path)
+        self._active = None
+
+    def _enforce_retention(self):
+        ## Elimina i segmenti chiusi più vecchi finché lo spool non rientra in max_bytes
+        ## (il segmento che drain() sta riproducendo resta: lo elimina drain() alla fine)
+        total = sum(segment.size() for segment in self._sealed) + (self._active.size() if self._active else 0)
+        while total > self.max_bytes:
+            candidates = [segment for segment in self._sealed if segment is not self._draining]
+            if not candidates:
+                break
+            segment = candidates[0]
+            self._sealed.remove(segment)
+            total -= segment.size()
+            self.stats["evicted"] += segment.count - segment.done
+            os.remove(segment.path)
+            log.warning("spool full, oldest samples dropped", extra={"max_bytes": self.max_bytes, "samples": segment.count - segment.done})
+
+    # ----- Riproduzione ----- #
+    def pending(self):
+        with self._lock:
+            pending = sum(segment.count - segment.done for segment in self._sealed)
+            return pending + (self._active.count if self._active else 0)
+
+    def _read(self, segment):
+        ## Record non ancora riprodotti del segmento, dopo la verifica del CRC
+        with open(segment.path, "rb") as file:
+            data = file.read()
+        records = data[HEADER_SIZE:segment.size()]
+        if len(records) != segment.count * RECORD.size or zlib.crc32(records) != segment.crc:
+            return None
+        return np.frombuffer(records, dtype=RECORD_DTYPE)[segment.done:]
+
+    def drain(self, write_fn, format_fn, batch_size=10000):
+        """Riproduce lo spool in batch di batch_size record con write_fn(lista di record).
+
+        format_fn(device_id, valore, timestamp) crea il record (es. line protocol).
+        Se write_fn solleva un'eccezione la riproduzione si ferma e l'eccezione viene
+        propagata; i batch già scritti non verranno riprodotti di nuovo.
+        Restituisce il numero di campioni riprodotti.
+        """
+        replayed = 0
+        while True:
+            with self._lock:
+                if not self._sealed:
+                    # Anche il segmento attivo viene chiuso, così lo spool si svuota del tutto
+                    self._rotate()
+                if not self._sealed:
+                    self._reset_devices()
+                    return replayed
+                segment = self._draining = self._sealed[0]
+                devices = list(self._devices)
+            try:
+                replayed += self._drain_segment(segment, devices, write_fn, format_fn, batch_size)
+            finally:
+                with self._lock:
+                    self._draining = None
+
+    def _drain_segment(self, segment, devices, write_fn, format_fn, batch_size):
+        ## Riproduce un segmento chiuso e lo elimina; restituisce i campioni scritti
+        try:
+            records = self._read(segment)
+        except OSError as e:
+            # Segmento sparito o illeggibile: si passa al successivo senza fermare la riproduzione
+            log.error("spool segment unreadable, skipped", extra={"segment": segment.path, "error": str(e)})
+            with self._lock:
+                self._sealed.remove(segment)
+                self.stats["evicted"] += segment.count - segment.done
+            return 0
+        if records is None:
+            log.error("spool segment crc mismatch, skipped", extra={"segment": segment.path})
+            with self._lock:
+                self._sealed.remove(segment)
+                self.stats["evicted"] += segment.count - segment.done
+            self._quarantine(segment.path)
+            return 0
+
+        replayed = 0
+        timestamps = segment.base + records["offset_ms"].astype(np.int64) * 1_000_000
+        for start in range(0, len(records), batch_size):
+            chunk = slice(start, start + batch_size)
+            write_fn([format_fn(devices[device], value, timestamp) for device, value, timestamp in zip(
+                records["device"][chunk].tolist(), records["value"][chunk].tolist(), timestamps[chunk].tolist())])
+            written = len(records["device"][chunk])
+            replayed += written
+            with self._lock:
+                segment.done += written
+                self.stats["replayed"] += written
+                self._mark_done(segment)
+
+        with self._lock:
+            if segment in self._sealed:
+                self._sealed.remove(segment)
+                os.remove(segment.path)
+        return replayed
+
+    def _mark_done(self, segment):
+        ## Aggiorna nell'header il numero di record già riprodotti (a posto, senza riscrivere il file)
+        if segment in self._sealed:
+            with open(segment.path, "r+b") as file:
+                file.seek(DONE_OFFSET)
+                file.write(COUNTER.pack(segment.done))
+
+    def _reset_devices(self):
+        ## Spool vuoto: la tabella dei dispositivi ricomincia da zero
+        if self._active is None and not self._sealed and self._devices:
+            self._devices = []
+            self._device_index = {}
+            os.remove(self._devices_file)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["segments"] = len(self._sealed) + (1 if self._active else 0)
+            stats["bytes"] = sum(segment.size() for segment in self._sealed) + (self._active.size() if self._active else 0)
+            stats["devices"] = len(self._devices)
+        stats["pending"] = self.pending()
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._rotate()
@@ -16,6 +16,21 @@ from telegram.error import BadRequest
 load_dotenv(".env")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 FLASK_SERVER_URL = os.getenv("FLASK_SERVER_URL")
+DEVICE_ID = os.getenv("DEVICE_ID")
+
+# Se è configurato un DEVICE_ID il bot gestisce le sveglie di quel letto
+SERVER_URL = f"{FLASK_SERVER_URL}/devices/{DEVICE_ID}" if DEVICE_ID else FLASK_SERVER_URL
+
+# Client HTTP verso il server: una sola sessione con keep-alive, creata in main()
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=3)
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5  # secondi, raddoppia a ogni tentativo
+MAX_REQUESTS_PER_CHAT = 2
+RETRY_STATUSES = {502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "PUT", "DELETE"}
+
+# Sveglie per messaggio nella lista (un messaggio Telegram ha al massimo 4096 caratteri)
+ALARMS_PER_MESSAGE = 40
 
 # Stati della conversazione
 CHOOSING_ALARM_ID, CHOOSING_TIME, CHOOSING_FREQUENCY, MODIFY_ALARM, REMOVE_ALARM = range(5)
@@ -54,6 +69,48 @@ def validate_time_format(time_str: str) -> bool:
     except ValueError:
         return False
 
+# ===================== CLIENT HTTP =====================
+
+_chat_limits = {}
+
+def create_http_session() -> aiohttp.ClientSession:
+    """Crea la sessione condivisa da tutti gli handler (pool di connessioni persistenti)."""
+    connector = aiohttp.TCPConnector(limit=20, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+
+async def api_request(context: CallbackContext, chat_id: int, method: str, path: str, payload=None):
+    """Esegue una richiesta al server e restituisce (status, json).
+
+    Limita le richieste concorrenti per chat e ritenta con backoff esponenziale gli
+    errori di connessione; timeout e risposte 502/503/504 vengono ritentati solo per
+    i metodi idempotenti, per non creare due volte la stessa sveglia.
+    """
+    session = context.bot_data["http"]
+    limit = _chat_limits.setdefault(chat_id, asyncio.Semaphore(MAX_REQUESTS_PER_CHAT))
+    idempotent = method in IDEMPOTENT_METHODS
+    async with limit:
+        for attempt in range(HTTP_RETRIES):
+            last_attempt = attempt == HTTP_RETRIES - 1
+            try:
+                async with session.request(method, f"{SERVER_URL}{path}", json=payload) as resp:
+                    if resp.status in RETRY_STATUSES and idempotent and not last_attempt:
+                        logging.warning(f"{method} {path}: HTTP {resp.status}, nuovo tentativo")
+                    else:
+                        try:
+                            data = await resp.json(content_type=None)
+                        except ValueError:
+                            data = {}
+                        return resp.status, data if isinstance(data, dict) else {}
+            except aiohttp.ClientConnectorError as e:
+                if last_attempt:
+                    raise
+                logging.warning(f"{method} {path}: connessione fallita ({e}), nuovo tentativo")
+            except asyncio.TimeoutError:
+                if last_attempt or not idempotent:
+                    raise
+                logging.warning(f"{method} {path}: timeout, nuovo tentativo")
+            await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+
 # ===================== COMANDO /START E MENU PRINCIPALE =====================
 
 async def start(update: Update, context: CallbackContext) -> None:
@@ -69,7 +126,8 @@ async def main_menu(update: Update, context: CallbackContext) -> None:
         [InlineKeyboardButton("❌ Rimuovi Sveglia", callback_data='remove_alarm')],
         [InlineKeyboardButton("❌ Rimuovi Tutte le Sveglie", callback_data='remove_all_alarms')],
         [InlineKeyboardButton("🛑 Ferma Allarme", callback_data='stop_alarm')],
-        [InlineKeyboardButton("📋 Lista Sveglie", callback_data='list_alarms')]
+        [InlineKeyboardButton("📋 Lista Sveglie", callback_data='list_alarms')],
+        [InlineKeyboardButton("📊 Statistiche Risvegli", callback_data='wakeup_stats')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -162,19 +220,14 @@ async def receive_frequency(update: Update, context: CallbackContext) -> int:
             "alarm_time": user_data["time"],
             "alarm_frequency": user_data["frequency"]
         }
-        url = f"{FLASK_SERVER_URL}/set_new_alarm"
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as resp:
-                if resp.status == 400: # Errore: ID già esistente
-                    error_data = await resp.json()
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"❌ Errore: {error_data.get('message', 'ID già esistente.')}",
-                        reply_markup=back_to_menu_keyboard()
-                    )
-                    return ConversationHandler.END
-                else:
-                    await resp.json()
+        status, data = await api_request(context, chat_id, "POST", "/set_new_alarm", payload)
+        if status == 400: # Errore: ID già esistente
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"❌ Errore: {data.get('message', 'ID già esistente.')}",
+                reply_markup=back_to_menu_keyboard()
+            )
+            return ConversationHandler.END
         await context.bot.send_message(
             chat_id=chat_id,
             text=(
@@ -191,19 +244,14 @@ async def receive_frequency(update: Update, context: CallbackContext) -> int:
             "alarm_time": user_data["time"],
             "alarm_frequency": user_data["frequency"]
         }
-        url = f"{FLASK_SERVER_URL}/update_alarm/{user_data['alarm_id']}"
-        async with aiohttp.ClientSession() as session:
-            async with session.put(url, json=payload) as resp:
-                if resp.status == 400 or resp.status == 404: # Errore: ID non trovato
-                    error_data = await resp.json()
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"❌ Errore: {error_data.get('message', 'ID NON TROVATO.')}",
-                        reply_markup=back_to_menu_keyboard()
-                    )
-                    return ConversationHandler.END
-                else:
-                    await resp.json()
+        status, data = await api_request(context, chat_id, "PUT", f"/update_alarm/{user_data['alarm_id']}", payload)
+        if status == 400 or status == 404: # Errore: ID non trovato
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"❌ Errore: {data.get('message', 'ID NON TROVATO.')}",
+                reply_markup=back_to_menu_keyboard()
+            )
+            return ConversationHandler.END
         await context.bot.send_message(
             chat_id=chat_id,
             text=(
@@ -262,21 +310,18 @@ async def remove_alarm(update: Update, context: CallbackContext) -> int:
 async def confirm_removal(update: Update, context: CallbackContext) -> int:
     """Conferma l'eliminazione di una sveglia e controlla se l'ID esiste sul server."""
     alarm_id = update.message.text.strip()
-    url = f"{FLASK_SERVER_URL}/remove_alarm/{alarm_id}"
-    async with aiohttp.ClientSession() as session:
-        async with session.delete(url) as resp:
-            data = await resp.json()
-            if resp.status == 400 or resp.status == 404:
-                # L'endpoint ha restituito un errore
-                await update.message.reply_text(
-                    f"❌ Errore: {data.get('message', 'Sveglia non trovata.')}",
-                    reply_markup=back_to_menu_keyboard()
-                )
-            else:
-                await update.message.reply_text(
-                    f"✅ **Sveglia {alarm_id} eliminata con successo!**",
-                    reply_markup=back_to_menu_keyboard()
-                )
+    status, data = await api_request(context, update.message.chat_id, "DELETE", f"/remove_alarm/{alarm_id}")
+    if status == 400 or status == 404:
+        # L'endpoint ha restituito un errore
+        await update.message.reply_text(
+            f"❌ Errore: {data.get('message', 'Sveglia non trovata.')}",
+            reply_markup=back_to_menu_keyboard()
+        )
+    else:
+        await update.message.reply_text(
+            f"✅ **Sveglia {alarm_id} eliminata con successo!**",
+            reply_markup=back_to_menu_keyboard()
+        )
     return ConversationHandler.END
 
 
@@ -286,10 +331,7 @@ async def remove_all_alarms(update: Update, context: CallbackContext) -> None:
     """Elimina tutte le sveglie chiamando l'endpoint dedicato."""
     chat_id = get_chat_id(update)
     await update.callback_query.answer()
-    url = f"{FLASK_SERVER_URL}/remove_all_alarms"
-    async with aiohttp.ClientSession() as session:
-        async with session.delete(url) as resp:
-            await resp.json()
+    await api_request(context, chat_id, "DELETE", "/remove_all_alarms")
     await context.bot.send_message(
         chat_id=chat_id,
         text="✅ **Tutte le sveglie sono state eliminate con successo!**",
@@ -302,11 +344,8 @@ async def stop_alarm(update: Update, context: CallbackContext) -> None:
     """Ferma l'allarme attivo chiamando l'endpoint."""
     chat_id = get_chat_id(update)
     await update.callback_query.answer()
-    url = f"{FLASK_SERVER_URL}/update_stop_alarm"
     payload = {"stop_alarm": "true"}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as resp:
-            await resp.json()
+    await api_request(context, chat_id, "POST", "/update_stop_alarm", payload)
     await context.bot.send_message(
         chat_id=chat_id,
         text="🛑 **Allarme fermato con successo!**",
@@ -316,34 +355,88 @@ async def stop_alarm(update: Update, context: CallbackContext) -> None:
 # ===================== LISTA DELLE SVEGLIE =====================
 
 async def list_alarms(update: Update, context: CallbackContext) -> None:
-    """Recupera e mostra la lista delle sveglie esistenti."""
+    """Recupera e mostra la lista delle sveglie, una pagina per messaggio."""
     chat_id = get_chat_id(update)
     await update.callback_query.answer()
-    url = f"{FLASK_SERVER_URL}/alarms"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            result = await resp.json()
-            status = resp.status
 
-    if status == 200 or status == 201:
+    offset = 0
+    header = "⏰ **Sveglie attive:**\n\n"
+    while True:
+        status, result = await api_request(context, chat_id, "GET", f"/alarms?offset={offset}&limit={ALARMS_PER_MESSAGE}")
+        if status != 200:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="❌ **Errore nel recupero delle sveglie.**",
+                reply_markup=back_to_menu_keyboard()
+            )
+            return
+
         alarms_list = result.get("alarms", [])
-        if not alarms_list:
+        next_offset = result.get("next_offset")
+        if not alarms_list and offset == 0:
             message = "⚠️ **Nessuna sveglia impostata.**"
         else:
-            message = "⏰ **Sveglie attive:**\n\n"
-            for alarm in alarms_list:
-                message += (
-                    f"📌 ID: `{alarm['alarm_id']}` - "
-                    f"🕒 {alarm['alarm_time']} - "
-                    f"📅 {alarm['alarm_frequency']}\n"
-                )
+            message = header + "".join(
+                f"📌 ID: `{alarm['alarm_id']}` - "
+                f"🕒 {alarm['alarm_time']} - "
+                f"📅 {alarm['alarm_frequency']}\n"
+                for alarm in alarms_list
+            )
+            header = ""
+        # Il pulsante per tornare al menu va solo sull'ultimo messaggio
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=message,
+            reply_markup=back_to_menu_keyboard() if next_offset is None else None
+        )
+        if next_offset is None:
+            return
+        offset = next_offset
+
+# ===================== STATISTICHE DEI RISVEGLI =====================
+
+def format_duration(seconds) -> str:
+    """Durata in minuti e secondi (es. 3m 05s), '-' se non disponibile."""
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return f"{minutes}m {seconds:02d}s"
+
+async def wakeup_stats(update: Update, context: CallbackContext) -> None:
+    """Comando "/risvegli" (o pulsante del menu): tempo per alzarsi e snooze delle ultime sveglie."""
+    chat_id = get_chat_id(update)
+    if update.callback_query:
+        await update.callback_query.answer()
+    status, summary = await api_request(context, chat_id, "GET", "/alarm_outcomes")
+    if status != 200:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="❌ **Errore nel recupero delle statistiche.**",
+            reply_markup=back_to_menu_keyboard()
+        )
+        return
+
+    if not summary.get("alarms"):
+        message = "⚠️ **Nessuna sveglia registrata finora.**"
     else:
-        message = "❌ **Errore nel recupero delle sveglie.**"
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=message,
-        reply_markup=back_to_menu_keyboard()
-    )
+        message = (
+            f"📊 **Statistiche risvegli** ({summary['alarms']} sveglie)\n\n"
+            f"🚶 Alzato: {summary['got_up']} - 😴 Non alzato: {summary['missed']} - "
+            f"🛏️ Letto già vuoto: {summary['not_in_bed']}\n"
+            f"⏱️ Tempo medio per alzarsi: {format_duration(summary.get('latency_mean_s'))} "
+            f"(min {format_duration(summary.get('latency_min_s'))}, max {format_duration(summary.get('latency_max_s'))})\n"
+            f"🔁 Rientri a letto (snooze): {summary['snoozes']} - 🛑 Fermate a mano: {summary['manual_stops']}\n"
+        )
+        recent = summary.get("recent", [])[:5]
+        if recent:
+            message += "\n**Ultime sveglie:**\n" + "".join(
+                f"📌 `{outcome['alarm_id']}` {datetime.fromtimestamp(outcome['fired_at'] / 1000).strftime('%d/%m %H:%M')} - "
+                f"{format_duration(outcome['latency_s'])}, snooze {outcome['snoozes']}\n"
+                for outcome in recent
+            )
+    if summary.get("open"):
+        message += "\n⏰ Sveglia in corso: " + ("fuori dal letto" if summary["open"]["out_of_bed"] else "ancora a letto")
+    await context.bot.send_message(chat_id=chat_id, text=message, reply_markup=back_to_menu_keyboard())
 
 # ===================== CANCELLAZIONE DELL'OPERAZIONE =====================
 
@@ -393,15 +486,20 @@ async def main():
     # Aggiunta degli handler al bot
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("risvegli", wakeup_stats))
     application.add_handler(CallbackQueryHandler(main_menu, pattern="^main_menu$"))
     application.add_handler(CallbackQueryHandler(stop_alarm, pattern="^stop_alarm$"))
     application.add_handler(CallbackQueryHandler(list_alarms, pattern="^list_alarms$"))
+    application.add_handler(CallbackQueryHandler(wakeup_stats, pattern="^wakeup_stats$"))
     application.add_handler(CallbackQueryHandler(remove_all_alarms, pattern="^remove_all_alarms$"))
     application.add_handler(CallbackQueryHandler(cancel, pattern="^cancel$"))
 
     application.add_error_handler(error_handler)
 
-    await application.run_polling() # Avvio del bot
+    # Sessione HTTP condivisa per tutta la vita del bot, chiusa all'arresto
+    async with create_http_session() as session:
+        application.bot_data["http"] = session
+        await application.run_polling() # Avvio del bot
 
 if __name__ == "__main__":
     nest_asyncio.apply()
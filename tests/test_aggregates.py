@@ -0,0 +1,72 @@
+import pytest
+
+from aggregates import InvalidResolution, PressureAggregator
+
+S = 1_000_000_000
+T0 = 1_700_000_040 * S   # inizio di un minuto
+
+
+@pytest.fixture
+def aggregator():
+    return PressureAggregator(resolutions={"1m": (60, 3)}, grace=5)
+
+
+def test_bucket_closes_only_after_grace(aggregator):
+    for i, value in enumerate([100, 300, 200]):
+        aggregator.add("bed-1", value, T0 + i * 10 * S)
+
+    assert aggregator.flush(T0 + 60 * S) == []
+    assert aggregator.flush(T0 + 64 * S) == []
+    assert aggregator.flush(T0 + 65 * S) == [
+        f"pressure_1m,device=bed-1 count=3i,mean=200.0,min=100.0,max=300.0 {T0}"]
+    assert aggregator.flush(T0 + 66 * S) == []
+
+
+def test_late_sample_rewrites_closed_bucket(aggregator):
+    aggregator.add("bed-1", 100, T0)
+    aggregator.flush(T0 + 65 * S)
+
+    aggregator.add("bed-1", 500, T0 + 30 * S)
+    assert aggregator.flush(T0 + 70 * S) == [
+        f"pressure_1m,device=bed-1 count=2i,mean=300.0,min=100.0,max=500.0 {T0}"]
+    assert aggregator.flush(T0 + 75 * S) == []
+    assert aggregator.get_stats()["late"] == 1
+
+
+def test_query_marks_open_bucket_partial(aggregator):
+    aggregator.add("bed-1", 100, T0)
+    aggregator.add("bed-1", 200, T0 + 61 * S)
+    aggregator.flush(T0 + 65 * S)
+
+    assert aggregator.query("bed-1", "1m") == [
+        {"start_ms": T0 // 1_000_000, "count": 1, "mean": 100.0, "min": 100, "max": 100, "partial": False},
+        {"start_ms": (T0 + 60 * S) // 1_000_000, "count": 1, "mean": 200.0, "min": 200, "max": 200, "partial": True},
+    ]
+    assert [b["partial"] for b in aggregator.query("bed-1", "1m", since=T0 + 60 * S)] == [True]
+    assert [b["partial"] for b in aggregator.query("bed-1", "1m", until=T0)] == [False]
+    assert aggregator.query("bed-2", "1m") == []
+    with pytest.raises(InvalidResolution):
+        aggregator.query("bed-1", "1d")
+
+
+def test_buckets_older_than_retention_expire(aggregator):
+    aggregator.add("bed-1", 100, T0)
+    # Il primo flush arriva dopo la retention (3 bucket): il bucket non viene scritto
+    assert aggregator.flush(T0 + 5 * 60 * S) == []
+    assert aggregator.get_stats()["expired"] == 1
+
+    for minute in range(5):
+        aggregator.add("bed-1", 100, T0 + minute * 60 * S)
+    now = T0 + 5 * 60 * S + 5 * S
+    aggregator.flush(now)
+    # Restano solo i bucket iniziati negli ultimi 3 minuti
+    assert [b["start_ms"] for b in aggregator.query("bed-1", "1m")] == [(T0 + 180 * S) // 1_000_000,
+                                                                       (T0 + 240 * S) // 1_000_000]
+    assert aggregator.get_stats()["expired"] == 4
+
+
+def test_every_resolution_is_updated():
+    aggregator = PressureAggregator(grace=0)
+    aggregator.add("bed-1", 100, T0)
+    records = aggregator.flush(T0 + 3600 * S)
+    assert sorted(record.split(",")[0] for record in records) == ["pressure_1h", "pressure_1m"]
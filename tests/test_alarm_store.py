@@ -0,0 +1,107 @@
+import json
+import threading
+
+from alarm_store import AlarmStore, AlarmListingCache
+
+DEVICES = 50
+PER_DEVICE = 100
+
+
+def alarm(device, i, **fields):
+    return {"device_id": f"bed-{device}", "alarm_id": str(i), "alarm_time": f"{i % 24:02d}:{i % 60:02d}",
+            "alarm_frequency": "everyday" if i % 2 else "once", "active": i % 3 != 0, **fields}
+
+
+def filled():
+    store = AlarmStore()
+    for device in range(DEVICES):
+        for i in range(PER_DEVICE):
+            assert store.add(alarm(device, i))
+    return store
+
+
+def test_thousands_of_alarms_are_indexed_per_device():
+    store = filled()
+    assert len(store) == store.count() == DEVICES * PER_DEVICE
+    assert store.count("bed-7") == len(store.list("bed-7")) == PER_DEVICE
+    assert not store.add(alarm(7, 0))
+
+    total, page = store.query("bed-7", active=True, frequency="everyday", offset=10, limit=5)
+    assert total == sum(1 for i in range(PER_DEVICE) if i % 2 and i % 3 != 0)
+    assert len(page) == 5
+    assert page == sorted(page, key=lambda a: (a["alarm_time"], a["alarm_id"]))
+
+    assert len(store.remove_device("bed-7")) == PER_DEVICE
+    assert store.count("bed-7") == 0 and store.list("bed-7") == []
+    assert len(store) == (DEVICES - 1) * PER_DEVICE
+
+
+def test_update_replaces_alarm_without_touching_old_copy():
+    store = filled()
+    before = store.get("bed-1", "1")
+    updated = store.update("bed-1", "1", alarm_time="06:15")
+    assert before["alarm_time"] != "06:15" and updated["alarm_time"] == "06:15"
+    assert store.get("bed-1", "1") is updated
+    assert updated in store.list("bed-1") and before not in store.list("bed-1")
+    assert store.update("bed-1", "missing", active=False) is None
+
+
+def test_listing_cache_follows_versions():
+    store = filled()
+    cache = AlarmListingCache(store)
+    etag, body = cache.get("bed-3")
+    assert cache.get("bed-3") == (etag, body) and cache.hits == 1
+    store.remove("bed-3", "0")
+    etag2, body2 = cache.get("bed-3")
+    assert etag2 != etag and json.loads(body2)["total"] == PER_DEVICE - 1
+
+
+def test_concurrent_mutation_keeps_indexes_consistent():
+    store = filled()
+    cache = AlarmListingCache(store, maxsize=8)
+    errors = []
+    stop = threading.Event()
+
+    def writer(device):
+        try:
+            for round_ in range(20):
+                for i in range(PER_DEVICE, PER_DEVICE + 20):
+                    store.add(alarm(device, i))
+                for i in range(0, PER_DEVICE, 7):
+                    store.update(f"bed-{device}", str(i), active=bool(round_ % 2))
+                for i in range(PER_DEVICE, PER_DEVICE + 20):
+                    store.remove(f"bed-{device}", str(i))
+            store.remove_device(f"bed-{device + DEVICES // 2}")
+        except Exception as e:  # noqa: BLE001 - l'errore viene verificato dal test
+            errors.append(e)
+
+    def reader():
+        try:
+            while not stop.is_set():
+                total, page = store.query(limit=100)
+                assert len(page) == min(total, 100)
+                for device in range(0, DEVICES, 10):
+                    listing = json.loads(cache.get(f"bed-{device}")[1])
+                    assert listing["total"] == len(listing["alarms"])
+                store.list()
+        except Exception as e:  # noqa: BLE001
+            errors.append(e)
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    writers = [threading.Thread(target=writer, args=(device,)) for device in range(DEVICES // 2)]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    assert not errors
+    # Restano solo le sveglie iniziali della prima metà dei dispositivi, una volta sola
+    assert len(store) == len(store.list()) == DEVICES // 2 * PER_DEVICE
+    assert sum(store.count(f"bed-{device}") for device in range(DEVICES)) == len(store)
+    for device in range(DEVICES // 2):
+        listing = json.loads(cache.get(f"bed-{device}")[1])
+        assert listing["total"] == PER_DEVICE
+        assert listing == json.loads(AlarmListingCache(store).get(f"bed-{device}")[1])
@@ -0,0 +1,172 @@
+from datetime import datetime
+
+import pytest
+
+from cluster import ShardCoordinator
+from ingest import IngestPipeline
+from live import LiveHub
+from scheduler import AlarmScheduler
+from service import ProxyService, Result
+
+SHARDS = 8
+TTL = 4.0
+
+
+class FakeClock:
+    def __init__(self, t=1000.0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def coordinator(tmp_path, clock):
+    def make(worker_id):
+        return ShardCoordinator(str(tmp_path / "cluster.db"), worker_id=worker_id, url=f"http://{worker_id}",
+                                shards=SHARDS, lease_ttl=TTL, clock=clock)
+    return make
+
+
+def device_on(coordinator, owned=True):
+    ## Un ID di dispositivo il cui shard è (o non è) di `coordinator`
+    for i in range(1000):
+        device_id = f"bed-{i}"
+        if (coordinator.shard(device_id) in coordinator.owned()) == owned:
+            return device_id
+    raise AssertionError("no device found")
+
+
+def balanced(a, b):
+    ## Tick finché i due worker non si dividono tutti gli shard
+    for _ in range(3):
+        a.tick()
+        b.tick()
+    assert a.owned() and b.owned()
+    assert a.owned() | b.owned() == set(range(SHARDS))
+    assert not a.owned() & b.owned()
+
+
+def test_single_worker_owns_all_shards(coordinator):
+    a = coordinator("a")
+    acquired, lost = a.tick()
+    assert acquired == set(range(SHARDS)) and not lost
+    assert a.owns("bed-1")
+
+
+def test_joining_worker_takes_over_only_released_shards(coordinator):
+    a, b = coordinator("a"), coordinator("b")
+    a.tick()
+    # b vuole già i suoi shard ma i lease di a non sono né rilasciati né scaduti
+    acquired, _ = b.tick()
+    assert not acquired
+    _, lost = a.tick()
+    assert lost
+    acquired, _ = b.tick()
+    assert acquired == lost
+    assert not a.owned() & b.owned()
+
+
+def test_release_on_stop_hands_shards_over_immediately(coordinator):
+    a, b = coordinator("a"), coordinator("b")
+    balanced(a, b)
+    lost = a.stop()
+    assert lost and not a.owned()
+    acquired, _ = b.tick()
+    assert acquired == lost
+    assert b.owned() == set(range(SHARDS))
+
+
+def test_crashed_worker_shards_expire_after_ttl(coordinator, clock):
+    a, b = coordinator("a"), coordinator("b")
+    balanced(a, b)
+    crashed = a.owned()
+
+    # a smette di rinnovare: fino alla scadenza del lease i suoi shard restano suoi
+    clock.t += TTL / 2
+    acquired, _ = b.tick()
+    assert not acquired
+    clock.t += TTL
+    acquired, _ = b.tick()
+    assert acquired == crashed
+    assert b.owned() == set(range(SHARDS))
+
+
+def test_owns_stops_before_lease_expires(coordinator, clock):
+    a = coordinator("a")
+    a.tick()
+    clock.t += TTL * 0.7
+    assert a.owns("bed-1")
+    clock.t += TTL * 0.1
+    assert not a.owns("bed-1")
+
+
+def make_service(cluster, now=datetime.now):
+    service = ProxyService(IngestPipeline(lambda records: None, spool_file="unused.lp"), LiveHub(),
+                           AlarmScheduler(lambda *args: None, now=now))
+    service.cluster = cluster
+    return service
+
+
+def test_route_forwards_to_owner_and_refuses_loops(coordinator):
+    a, b = coordinator("a"), coordinator("b")
+    balanced(a, b)
+    service = make_service(a)
+    assert service.route(device_on(a)) is None
+    assert service.route(device_on(a, owned=False)) == "http://b"
+
+    moving = service.route(device_on(a, owned=False), forwarded=True)
+    assert isinstance(moving, Result) and moving.status == 503
+
+
+def test_batch_is_split_by_owner(coordinator):
+    a, b = coordinator("a"), coordinator("b")
+    balanced(a, b)
+    service = make_service(a)
+    local, remote = device_on(a), device_on(a, owned=False)
+    body = ('[{"device_id": "%s", "pressure_value": 100, "timestamp": 1700000000000},'
+            ' {"device_id": "%s", "pressure_value": 200, "timestamp": 1700000001000}]' % (local, remote)).encode()
+
+    result = service.sensor_data_batch(local, body, "application/json")
+
+    assert result.status == 201 and result.body["accepted"] == 2
+    assert service.ingest_paths["http"].samples == 1
+    assert result.forwards == [("http://b", remote, [
+        {"device_id": remote, "pressure_value": 200, "timestamp": 1700000001000},
+    ])]
+
+
+def test_body_device_of_another_shard_is_forwarded(coordinator):
+    a, b = coordinator("a"), coordinator("b")
+    balanced(a, b)
+    service = make_service(a)
+    remote = device_on(a, owned=False)
+
+    result = service.sensor_data(device_on(a), {"device_id": remote, "pressure_value": 100})
+
+    assert service.ingest_paths["http"].samples == 0
+    [(owner_url, device_id, samples)] = result.forwards
+    assert (owner_url, device_id) == ("http://b", remote)
+
+    result = service.sensor_data(device_on(a), {"device_id": remote, "pressure_value": 100}, forwarded=True)
+    assert result.status == 503 and not result.forwards
+
+
+def test_handover_inside_firing_minute_does_not_fire_again(coordinator):
+    a = coordinator("a")
+    a.tick()
+    # Il worker precedente ha già fatto suonare la sveglia delle 7:00, lo shard passa alle 7:00:30
+    now = datetime(2026, 3, 2, 7, 0, 30)
+    service = make_service(a, now=lambda: now)
+    alarm = {"device_id": "bed-1", "alarm_id": "1", "alarm_time": "07:00", "alarm_frequency": "everyday",
+             "active": True}
+
+    service.load_shards(a.owned(), [alarm], {})
+
+    fire_time, _, _ = service.scheduler._entries[("bed-1", "1")]
+    assert fire_time == datetime(2026, 3, 3, 7, 0)
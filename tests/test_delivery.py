@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from benchmark_fakes import FakeBroker
+from delivery import CommandDelivery
+from devices import Device, TOPIC_PREFIX
+
+
+class FakeClock:
+    def __init__(self, t=0.0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.01)
+
+
+def client(broker, name, on_message=None, subscribe=()):
+    c = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=name)
+    if on_message is not None:
+        c.on_message = on_message
+    c.connect(broker.host, broker.port)
+    c.loop_start()
+    subscribed = threading.Event()
+    c.on_subscribe = lambda *args: subscribed.set()
+    for topic in subscribe:
+        subscribed.clear()
+        c.subscribe(topic, qos=1)
+        assert subscribed.wait(5)
+    return c
+
+
+class FakeFirmware:
+    """Dispositivo che riceve i comandi e conferma su <device>/ack, ignorando i primi `drop`."""
+
+    def __init__(self, broker, device_id, drop=0):
+        self.device_id = device_id
+        self.drop = drop
+        self.received = []   # (comando, messaggio, retained)
+        self.client = client(broker, f"fw-{device_id}", self._on_message, [f"{TOPIC_PREFIX}/{device_id}/+"])
+
+    def _on_message(self, c, userdata, message):
+        command = message.topic.rsplit("/", 1)[-1]
+        if command == "ack":
+            return
+        payload = json.loads(message.payload)
+        self.received.append((command, payload, bool(message.retain)))
+        if self.drop:
+            self.drop -= 1
+            return
+        c.publish(f"{TOPIC_PREFIX}/{self.device_id}/ack", json.dumps({"cmd_id": payload["cmd_id"]}), qos=1)
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+@pytest.fixture
+def broker():
+    broker = FakeBroker().start()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def delivery(clock):
+    return CommandDelivery(min_backoff=2, max_backoff=8, expiry={"trigger_alarm": 30}, clock=clock)
+
+
+@pytest.fixture
+def proxy(broker, delivery):
+    ## Lato proxy: pubblica i comandi e passa le conferme a CommandDelivery, come service.on_ack
+    def on_ack(c, userdata, message):
+        delivery.ack(message.topic.split("/")[-2], int(json.loads(message.payload)["cmd_id"]))
+
+    c = client(broker, "proxy", on_ack, [f"{TOPIC_PREFIX}/+/ack"])
+    yield c
+    c.disconnect()
+    c.loop_stop()
+
+
+def send(proxy, delivery, device, command, payload):
+    topic, message, retain = delivery.prepare(device, command, payload)
+    proxy.publish(topic, json.dumps(message), qos=1, retain=retain)
+    return message["cmd_id"]
+
+
+def retry(proxy, delivery):
+    messages = delivery.due()
+    for topic, message, retain in messages:
+        proxy.publish(topic, json.dumps(message), qos=1, retain=retain)
+    return messages
+
+
+def test_unacked_command_is_redelivered_until_acked(broker, proxy, delivery, clock):
+    firmware = FakeFirmware(broker, "bed-1", drop=1)
+    try:
+        cmd_id = send(proxy, delivery, Device("bed-1"), "trigger_alarm", {"trigger_alarm": "trigger_alarm"})
+        wait_for(lambda: len(firmware.received) == 1)
+        assert delivery.device_status("bed-1")["pending"]["trigger_alarm"]["attempts"] == 1
+
+        clock.t = 1.0
+        assert retry(proxy, delivery) == []
+        clock.t = 2.0
+        assert len(retry(proxy, delivery)) == 1
+        wait_for(lambda: delivery.get_stats()["acked"] == 1)
+
+        # Stesso cmd_id a ogni ritentativo: il firmware può riconoscere i duplicati
+        assert [payload["cmd_id"] for _, payload, _ in firmware.received] == [cmd_id, cmd_id]
+        status = delivery.device_status("bed-1")
+        assert status["pending"] == {} and status["acked"]["trigger_alarm"]["cmd_id"] == cmd_id
+        clock.t = 100.0
+        assert retry(proxy, delivery) == []
+    finally:
+        firmware.close()
+
+
+def test_command_expires_when_device_never_acks(broker, proxy, delivery, clock):
+    device = Device("bed-2")
+    cmd_id = send(proxy, delivery, device, "trigger_alarm", {"trigger_alarm": "trigger_alarm"})
+    retries = []
+    for t in range(0, 31):
+        clock.t = float(t)
+        if retry(proxy, delivery):
+            retries.append(t)
+
+    # Backoff esponenziale (2, 4, 8) limitato a max_backoff, poi la scadenza dopo 30 s
+    assert retries == [2, 6, 14, 22]
+    stats = delivery.get_stats()
+    assert stats["expired"] == 1 and stats["pending"] == 0
+    assert delivery.ack("bed-2", cmd_id) is None
+
+
+def test_device_online_triggers_immediate_redelivery(broker, proxy, delivery, clock):
+    # Comando non retained, perso perché il dispositivo era offline
+    send(proxy, delivery, Device("bed-3"), "stop_alarm", {"stop_alarm": True})
+    assert retry(proxy, delivery) == []
+    firmware = FakeFirmware(broker, "bed-3")
+    try:
+        delivery.device_online("bed-3")
+        assert len(retry(proxy, delivery)) == 1
+        wait_for(lambda: delivery.get_stats()["acked"] == 1)
+        assert [command for command, _, _ in firmware.received] == ["stop_alarm"]
+    finally:
+        firmware.close()
+
+
+def test_state_commands_are_retained_events_are_not(broker, proxy, delivery):
+    device = Device("bed-4")
+    send(proxy, delivery, device, "sampling_rate", {"sampling_rate": 30})
+    send(proxy, delivery, device, "trigger_alarm", {"trigger_alarm": "trigger_alarm"})
+    wait_for(lambda: broker.get_stats()["published"] >= 2)
+
+    # Il firmware si connette dopo: riceve solo l'ultimo stato, non la sveglia
+    firmware = FakeFirmware(broker, "bed-4")
+    try:
+        wait_for(lambda: firmware.received)
+        time.sleep(0.1)
+        assert [(command, retained) for command, _, retained in firmware.received] == [("sampling_rate", True)]
+        wait_for(lambda: delivery.device_status("bed-4")["acked"].get("sampling_rate") is not None)
+        assert "trigger_alarm" in delivery.device_status("bed-4")["pending"]
+    finally:
+        firmware.close()
+
+
+def test_newer_command_supersedes_pending_one(delivery):
+    device = Device("bed-5")
+    old = delivery.prepare(device, "sampling_rate", {"sampling_rate": 5})[1]["cmd_id"]
+    new = delivery.prepare(device, "sampling_rate", {"sampling_rate": 1})[1]["cmd_id"]
+    assert delivery.ack("bed-5", old) is None
+    assert delivery.ack("bed-6", new) is None
+    assert delivery.ack("bed-5", new) is not None
+    assert delivery.ack("bed-5", new) is None
+
+    delivery.prepare(device, "trigger_alarm", {"trigger_alarm": "trigger_alarm"})
+    delivery.prepare(device, "stop_alarm", {"stop_alarm": True})
+    assert list(delivery.device_status("bed-5")["pending"]) == ["stop_alarm"]
+    assert delivery.get_stats()["superseded"] == 2
@@ -0,0 +1,14 @@
+import pytest
+
+from devices import DeviceRegistry, InvalidDeviceId
+
+
+@pytest.mark.parametrize("device_id", ["bed-1", "Bed_2.kitchen", "x" * 64])
+def test_validate_accepts(device_id):
+    assert DeviceRegistry.validate(device_id) == device_id
+
+
+@pytest.mark.parametrize("device_id", ["", "abc\n", "\nabc", "a/b", "a+b", "a#", "a b", "x" * 65, None, 7])
+def test_validate_rejects(device_id):
+    with pytest.raises(InvalidDeviceId):
+        DeviceRegistry.validate(device_id)
@@ -0,0 +1,257 @@
+import asyncio
+import time
+
+import pytest
+
+from influxdb_client.rest import ApiException
+
+from ingest import AsyncIngestPipeline, IngestPipeline, PathStats
+from samples import pressure_record
+from spool import SampleSpool
+
+
+def test_record_with_sent_at_tracks_latency():
+    stats = PathStats()
+    stats.record(time.time() * 1000 - 50)
+    result = stats.get_stats()
+    assert result["samples"] == 1
+    assert 40 <= result["latency_ms"]["p50"] < 5000
+
+
+@pytest.mark.parametrize("sent_at", ["x", [], {}, "nan", float("inf"), True, 10 ** 400])
+def test_record_with_malformed_sent_at_counts_sample_without_latency(sent_at):
+    stats = PathStats()
+    stats.record(sent_at)
+    result = stats.get_stats()
+    assert result["samples"] == 1
+    assert "latency_ms" not in result
+
+
+def test_record_accepts_numeric_string():
+    stats = PathStats()
+    stats.record(str(int(time.time() * 1000)))
+    assert "latency_ms" in stats.get_stats()
+
+
+INT64_MAX = 2 ** 63 - 1
+
+
+class FakeInflux:
+    """write_fn che rifiuta con 400 i record fuori dal range int64, come InfluxDB."""
+
+    def __init__(self, status=400):
+        self.status = status
+        self.written = []
+
+    def __call__(self, lines):
+        if any(int(line.split("value=")[1].split("i")[0]) > INT64_MAX for line in lines):
+            raise ApiException(status=self.status, reason="field value out of range")
+        self.written.extend(lines)
+
+
+def poisoned_samples(count):
+    ## Un float32 enorme (accettato prima del controllo sul range) seguito da campioni validi
+    base = time.time_ns()
+    return [("bed-1", 3e38, base)] + [("bed-1", 100 + i, base + i) for i in range(count)]
+
+
+def test_rejected_batch_is_dropped_not_spooled(tmp_path):
+    influx = FakeInflux()
+    pipeline = IngestPipeline(influx, batch_size=10, spool_file=str(tmp_path / "spool.lp"),
+                              sample_spool=SampleSpool(str(tmp_path / "samples")))
+    samples = poisoned_samples(200)
+    for start in range(0, len(samples), 10):
+        pipeline._flush(samples[start:start + 10])
+
+    stats = pipeline.get_stats()
+    assert stats["dropped"] == 10 and stats["written"] == 191
+    assert stats["errors"] == 0 and stats["spooled"] == 0 and stats["backoff_s"] == 0
+    assert len(influx.written) == 191
+
+
+def test_rejected_spooled_batch_does_not_block_replay(tmp_path):
+    influx = FakeInflux()
+    pipeline = IngestPipeline(influx, spool_file=str(tmp_path / "spool.lp"),
+                              sample_spool=SampleSpool(str(tmp_path / "samples")))
+    # Campioni finiti nello spool durante un'interruzione di InfluxDB
+    pipeline.sample_spool.append([("bed-1", 100, time.time_ns())] * 5)
+    pipeline.sample_spool.append(poisoned_samples(200))
+
+    assert pipeline.sample_spool.drain(pipeline._write_replayed, pressure_record, 50) == 206
+    stats = pipeline.get_stats()
+    assert stats["replayed"] == 156 and stats["dropped"] == 50
+    assert stats["sample_spool"]["pending"] == 0
+    assert stats["backoff_s"] == 0
+
+
+def test_authorization_error_is_retried(tmp_path):
+    pipeline = IngestPipeline(FakeInflux(status=401), spool_file=str(tmp_path / "spool.lp"),
+                              sample_spool=SampleSpool(str(tmp_path / "samples")))
+    pipeline._flush(poisoned_samples(3))
+    stats = pipeline.get_stats()
+    assert stats["spooled"] == 4 and stats["dropped"] == 0
+    assert stats["errors"] == 1 and stats["backoff_s"] > 0
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.01)
+
+
+class FakeWriter:
+    """write_fn che registra i batch ricevuti e fallisce finché `down` è True."""
+
+    def __init__(self):
+        self.batches = []
+        self.down = False
+
+    def __call__(self, lines):
+        if self.down:
+            raise ConnectionError("influxdb unreachable")
+        self.batches.append(list(lines))
+
+    @property
+    def lines(self):
+        return [line for batch in self.batches for line in batch]
+
+
+@pytest.fixture
+def writer():
+    return FakeWriter()
+
+
+def test_batches_are_cut_by_size_then_by_age(tmp_path, writer):
+    pipeline = IngestPipeline(writer, batch_size=5, max_batch_age=0.2, spool_file=str(tmp_path / "spool.lp"))
+    for i in range(12):
+        assert pipeline.put(f"m v={i}i")
+    pipeline.start()
+    try:
+        wait_for(lambda: pipeline.get_stats()["written"] == 12)
+    finally:
+        pipeline.stop()
+    assert [len(batch) for batch in writer.batches] == [5, 5, 2]
+    assert writer.lines == [f"m v={i}i" for i in range(12)]
+
+
+def test_partial_batch_is_flushed_after_max_age(tmp_path, writer):
+    pipeline = IngestPipeline(writer, batch_size=100, max_batch_age=0.05, spool_file=str(tmp_path / "spool.lp")).start()
+    try:
+        started = time.monotonic()
+        pipeline.put_sample("bed-1", 100, 1_700_000_000_000_000_000)
+        wait_for(lambda: writer.batches)
+        assert time.monotonic() - started < 1.0
+    finally:
+        pipeline.stop()
+    assert writer.batches == [[pressure_record("bed-1", 100, 1_700_000_000_000_000_000)]]
+
+
+def test_backoff_doubles_up_to_max_and_resets(tmp_path, writer):
+    pipeline = IngestPipeline(writer, spool_file=str(tmp_path / "spool.lp"), min_backoff=0.02, max_backoff=0.08)
+    writer.down = True
+    backoffs = []
+    for _ in range(5):
+        pipeline._flush(["m v=1i"])
+        backoffs.append(pipeline.get_stats()["backoff_s"])
+        # Durante il backoff InfluxDB non viene contattato: il batch va nello spool
+        pipeline._flush(["m v=2i"])
+        time.sleep(backoffs[-1] + 0.01)
+    assert backoffs == [0.02, 0.04, 0.08, 0.08, 0.08]
+    assert pipeline.get_stats()["errors"] == 5 and pipeline.get_stats()["spooled"] == 10
+
+    writer.down = False
+    pipeline._flush(["m v=3i"])
+    stats = pipeline.get_stats()
+    assert stats["backoff_s"] == 0 and stats["written"] == 1 and stats["replayed"] == 10
+
+
+def test_spooled_records_are_replayed_in_order_after_recovery(tmp_path, writer):
+    spool_file = tmp_path / "spool.lp"
+    pipeline = IngestPipeline(writer, batch_size=2, spool_file=str(spool_file), min_backoff=0.05)
+    writer.down = True
+    pipeline._flush(["m v=1i", "m v=2i"])
+    pipeline._flush(["m v=3i"])        # in backoff, direttamente su disco
+    assert spool_file.read_text().splitlines() == ["m v=1i", "m v=2i", "m v=3i"]
+
+    writer.down = False
+    time.sleep(0.06)
+    pipeline._flush(["m v=4i"])
+    # Prima il batch live, poi lo spool nell'ordine di arrivo, a batch di batch_size
+    assert writer.batches == [["m v=4i"], ["m v=1i", "m v=2i"], ["m v=3i"]]
+    assert not spool_file.exists()
+    assert pipeline.get_stats()["replayed"] == 3
+
+
+def test_full_queue_drops_and_counts(tmp_path, writer):
+    pipeline = IngestPipeline(writer, max_queue=2, spool_file=str(tmp_path / "spool.lp"))
+    assert pipeline.put("m v=1i") and pipeline.put("m v=2i")
+    assert not pipeline.put("m v=3i")
+    assert not pipeline.put_sample("bed-1", 100, 1)
+    stats = pipeline.get_stats()
+    assert stats["enqueued"] == 2 and stats["dropped"] == 2
+    assert stats["queue_depth"] == stats["queue_capacity"] == 2
+
+
+def test_sample_spool_replay_hands_back_to_live_path(tmp_path, writer):
+    pipeline = IngestPipeline(writer, batch_size=10, max_batch_age=0.05, spool_file=str(tmp_path / "spool.lp"),
+                              sample_spool=SampleSpool(str(tmp_path / "samples")), replay_batch_size=7,
+                              replay_interval=0.02, min_backoff=0.1)
+    # Lo spool conserva i timestamp al millisecondo
+    base = time.time_ns() // 1_000_000 * 1_000_000
+    spooled = [("bed-1", 100 + i, base + i * 1_000_000) for i in range(20)]
+    writer.down = True
+    pipeline._flush(spooled)
+    assert pipeline.get_stats()["sample_spool"]["pending"] == 20
+    assert not (tmp_path / "spool.lp").exists()
+
+    writer.down = False
+    pipeline.start()
+    try:
+        # Il thread di replay attende la fine del backoff, poi svuota lo spool e azzera il backoff
+        wait_for(lambda: pipeline.get_stats()["replayed"] == 20 and pipeline.get_stats()["backoff_s"] == 0)
+        live = ("bed-1", 500, time.time_ns())
+        pipeline.put_sample(*live)
+        wait_for(lambda: pipeline.get_stats()["written"] == 1)
+    finally:
+        pipeline.stop()
+    assert [len(batch) for batch in writer.batches] == [7, 7, 6, 1]
+    assert writer.lines == [pressure_record(*sample) for sample in spooled + [live]]
+    assert pipeline.get_stats()["sample_spool"]["pending"] == 0
+
+
+def test_async_pipeline_batches_spools_and_recovers(tmp_path):
+    async def run():
+        batches = []
+        down = [True]
+
+        async def write(lines):
+            if down[0]:
+                raise ConnectionError("influxdb unreachable")
+            batches.append(list(lines))
+
+        pipeline = AsyncIngestPipeline(write, max_queue=20, batch_size=5, max_batch_age=0.02,
+                                       spool_file=str(tmp_path / "spool.lp"), min_backoff=0.3)
+        pipeline.start()
+        for i in range(8):
+            pipeline.put(f"m v={i}i")
+        while pipeline.get_stats()["spooled"] < 8:
+            await asyncio.sleep(0.01)
+        assert pipeline.get_stats()["errors"] == 1 and batches == []
+
+        down[0] = False
+        await asyncio.sleep(0.31)
+        pipeline.put("m v=8i")
+        while pipeline.get_stats()["replayed"] < 8:
+            await asyncio.sleep(0.01)
+        for i in range(30):
+            pipeline.put(f"x v={i}i")
+        await pipeline.stop()
+        return pipeline.get_stats(), batches
+
+    stats, batches = asyncio.run(run())
+    assert batches[0] == ["m v=8i"]
+    assert [line for batch in batches[1:3] for line in batch] == [f"m v={i}i" for i in range(8)]
+    assert stats["backoff_s"] == 0
+    assert stats["enqueued"] + stats["dropped"] == 39 and stats["dropped"] == 10
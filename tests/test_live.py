@@ -0,0 +1,73 @@
+import asyncio
+
+from live import AsyncLiveHub, EVICTED_FRAME, HEARTBEAT_FRAME, LiveHub
+
+
+def test_slow_consumer_is_evicted_without_blocking_others():
+    hub = LiveHub(client_buffer=3)
+    slow, fast = hub.subscribe(), hub.subscribe()
+    fast_frames = fast.frames(heartbeat=0.01)
+    received = []
+    for i in range(5):
+        hub.fanout("pressure", "bed-1", {"value": i})
+        received.append(next(fast_frames))
+
+    assert ['"value":%d' % i in frame for i, frame in enumerate(received)] == [True] * 5
+    stats = hub.get_stats()
+    assert stats["evicted"] == 1 and stats["clients"] == 1
+    # Il client escluso riceve ciò che aveva in buffer, poi il frame di eviction e la chiusura
+    frames = list(slow.frames(heartbeat=0.01))
+    assert frames[0].count("event: pressure") == 3 and frames[1:] == [EVICTED_FRAME]
+
+
+def test_disconnect_unsubscribes_client():
+    import proxy
+
+    response = proxy.app.test_client().get("/live?device=bed-1", buffered=False)
+    chunks = iter(response.response)
+    assert next(chunks).startswith(b"event: snapshot")
+    assert proxy.live.get_stats()["clients"] == 1
+    response.close()
+    assert proxy.live.get_stats()["clients"] == 0
+
+
+def test_filters_and_heartbeat():
+    hub = LiveHub()
+    client = hub.subscribe(device_ids={"bed-1"}, events={"alarm"})
+    hub.fanout("alarm", "bed-2", {})
+    hub.fanout("pressure", "bed-1", {"value": 1})
+    hub.fanout("alarm", "bed-1", {"alarm_id": "1"})
+    frames = client.frames(heartbeat=0.01)
+    assert next(frames) == 'id: 1\nevent: alarm\ndata: {"device_id":"bed-1","alarm_id":"1"}\n\n'
+    assert next(frames) == HEARTBEAT_FRAME
+    client.close()
+    assert list(frames) == []
+
+
+def test_max_clients_and_publish_without_clients():
+    hub = LiveHub(max_clients=1)
+    assert not hub.publish("pressure", "bed-1", {"value": 1})
+    client = hub.subscribe()
+    assert hub.subscribe() is None and hub.get_stats()["rejected"] == 1
+    assert hub.publish("pressure", "bed-1", {"value": 1})
+    hub.unsubscribe(client)
+    assert hub.get_stats()["clients"] == 0
+
+
+def test_async_slow_consumer_is_evicted():
+    async def run():
+        hub = AsyncLiveHub(client_buffer=2).start()
+        client = hub.subscribe()
+        for i in range(4):
+            hub.publish("pressure", "bed-1", {"value": i})
+        while hub.queue.qsize():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        frames = [frame async for frame in client.frames(heartbeat=0.01)]
+        stats = hub.get_stats()
+        await hub.stop()
+        return frames, stats
+
+    frames, stats = asyncio.run(run())
+    assert frames[0].count("event: pressure") == 2 and frames[1:] == [EVICTED_FRAME]
+    assert stats["evicted"] == 1 and stats["clients"] == 0
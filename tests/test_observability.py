@@ -0,0 +1,37 @@
+import logging
+
+import pytest
+
+from observability import RateLimitFilter
+from weather import WeatherCache
+
+
+class Collect(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def collected():
+    handler = Collect()
+    handler.addFilter(RateLimitFilter(interval=60, burst=3))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    yield handler.records
+    root.removeHandler(handler)
+
+
+def test_repeated_module_warnings_are_rate_limited(collected):
+    # Porta chiusa: ogni location fallisce subito, con un messaggio diverso solo negli extra
+    cache = WeatherCache("key", api_url="http://127.0.0.1:9/weather", timeout=0.5)
+    for i in range(10):
+        cache.get(f"city-{i}")
+
+    warnings = [r for r in collected if r.name == "weather"]
+    assert len(warnings) == 3
+    assert {r.getMessage() for r in warnings} == {"weather fetch failed"}
+    assert [r.location for r in warnings] == ["city-0", "city-1", "city-2"]
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from occupancy import DEFAULT_MODEL, OccupancyEngine, load_model
+
+# Probabilità che dipende solo dal valore: 2300 -> ~0.95, 2000 -> 0.5, 1700 -> ~0.05
+VALUE_MODEL = {"type": "logistic", "window": 3, "features": ["value"], "weights": [1.0], "bias": 0.0,
+               "mean": [2000.0], "scale": [100.0]}
+HIGH, MIDDLE, LOW = 2300, 2000, 1700
+
+
+def transitions(engine, values, device_id="bed-1"):
+    return [(i, t["occupied"]) for i, value in enumerate(values)
+            if (t := engine.update(device_id, value, timestamp=i)) is not None]
+
+
+def test_first_sample_sets_initial_state():
+    engine = OccupancyEngine(VALUE_MODEL)
+    assert transitions(engine, [HIGH]) == [(0, True)]
+    assert engine.state("bed-1")["occupied"] is True and engine.state("bed-1")["since"] == 0
+    assert engine.state("bed-2") is None
+
+
+def test_hysteresis_needs_consecutive_confirmations():
+    engine = OccupancyEngine(VALUE_MODEL, confirm=2)
+    # Un solo campione basso non basta, e un valore intermedio azzera il conteggio
+    assert transitions(engine, [HIGH, LOW, HIGH, LOW, MIDDLE, LOW, LOW, HIGH, HIGH]) == [
+        (0, True), (6, False), (8, True)]
+
+
+def test_devices_are_independent():
+    engine = OccupancyEngine(VALUE_MODEL, confirm=1)
+    engine.update("bed-1", HIGH)
+    engine.update("bed-2", LOW)
+    assert engine.state("bed-1")["occupied"] is True
+    assert engine.state("bed-2")["occupied"] is False
+
+
+def test_default_model_thresholds_mean_of_window():
+    engine = OccupancyEngine()
+    assert transitions(engine, [4095] * 5) == [(0, True)]
+    # La media della finestra di 5 scende sotto 4060 al primo campione basso, la conferma arriva al secondo
+    assert transitions(engine, [4095, 4095, 4095, 4095, 4095, 0, 0, 0], "bed-2") == [(0, True), (6, False)]
+
+
+def test_load_model_falls_back_to_default(tmp_path, caplog):
+    assert load_model(None) is DEFAULT_MODEL
+    assert load_model(str(tmp_path / "missing.json")) is DEFAULT_MODEL
+
+    broken = tmp_path / "broken.json"
+    broken.write_text("{not json")
+    assert load_model(str(broken)) is DEFAULT_MODEL
+    assert any(record.msg == "occupancy model not loaded, using default" for record in caplog.records)
+
+
+def test_load_model_rejects_unsupported_spec(tmp_path):
+    spec = tmp_path / "model.json"
+    spec.write_text(json.dumps({**VALUE_MODEL, "features": ["value", "entropy"]}))
+    with pytest.raises(ValueError):
+        load_model(str(spec))
+    spec.write_text(json.dumps({**VALUE_MODEL, "type": "forest"}))
+    with pytest.raises(ValueError):
+        load_model(str(spec))
+
+
+def test_shipped_model_separates_empty_and_occupied_bed():
+    engine = OccupancyEngine(load_model("occupancy_model.json"))
+    assert transitions(engine, [4095] * 10 + [0] * 10) == [(0, True), (11, False)]
@@ -0,0 +1,88 @@
+import pytest
+
+from outcomes import AlarmOutcomes, GOT_UP, MISSED, NOT_IN_BED
+
+S = 1_000_000_000
+FIRED = 1_700_000_000 * S
+
+
+class FakeClock:
+    def __init__(self, t):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(FIRED)
+
+
+@pytest.fixture
+def outcomes(clock):
+    return AlarmOutcomes(settle=300, timeout=3600, clock=clock)
+
+
+def test_got_up_after_settling(outcomes):
+    outcomes.fired("bed-1", "1", FIRED, occupied=True)
+    outcomes.transition("bed-1", False, FIRED + 40 * S)
+    assert outcomes.tick(FIRED + 339 * S) == []
+
+    [(device_id, outcome, summary)] = outcomes.tick(FIRED + 340 * S)
+    assert device_id == "bed-1"
+    assert outcome["outcome"] == GOT_UP and outcome["latency_s"] == 40 and outcome["snoozes"] == 0
+    assert summary["got_up"] == 1 and summary["latency_mean_s"] == 40
+
+
+def test_back_to_bed_counts_as_snooze(outcomes):
+    outcomes.fired("bed-1", "1", FIRED, occupied=True)
+    outcomes.transition("bed-1", False, FIRED + 30 * S)
+    outcomes.transition("bed-1", True, FIRED + 60 * S)
+    # Tornato a letto prima di settle: la sessione resta aperta
+    assert outcomes.tick(FIRED + 400 * S) == []
+    outcomes.transition("bed-1", False, FIRED + 600 * S)
+
+    [(_, outcome, summary)] = outcomes.tick(FIRED + 900 * S)
+    assert outcome["outcome"] == GOT_UP and outcome["snoozes"] == 1
+    assert outcome["latency_s"] == 600 and outcome["first_get_up_s"] == 30
+    assert summary["snoozes_per_alarm"] == 1
+
+
+def test_missed_after_timeout_and_manual_stop(outcomes):
+    outcomes.fired("bed-1", "1", FIRED, occupied=True)
+    outcomes.stopped("bed-1", FIRED + 10 * S)
+    assert outcomes.tick(FIRED + 3599 * S) == []
+    [(_, outcome, summary)] = outcomes.tick(FIRED + 3600 * S)
+    assert outcome["outcome"] == MISSED and outcome["latency_s"] is None
+    assert outcome["stopped_manually"] is True and summary["manual_stops"] == 1
+
+
+def test_not_in_bed_closes_immediately(outcomes):
+    [(_, outcome, _)] = outcomes.fired("bed-1", "1", FIRED, occupied=False)
+    assert outcome["outcome"] == NOT_IN_BED
+    assert outcomes.get_stats()["open"] == 0
+
+
+def test_late_transition_and_new_alarm_close_previous_session(outcomes):
+    outcomes.fired("bed-1", "1", FIRED, occupied=None)
+    # Transizione precedente al trigger (arrivata in ritardo): ignorata
+    outcomes.transition("bed-1", False, FIRED - 5 * S)
+    [(_, outcome, summary)] = outcomes.fired("bed-1", "2", FIRED + 600 * S, occupied=True)
+    assert outcome["alarm_id"] == "1" and outcome["outcome"] == MISSED
+    assert outcomes.summary("bed-1")["open"]["alarm_id"] == "2"
+
+
+def test_summary_is_incremental_and_survives_reload(outcomes, clock):
+    for i, latency in enumerate([20, 60]):
+        fired = FIRED + i * 86400 * S
+        outcomes.fired("bed-1", str(i), fired, occupied=True)
+        outcomes.transition("bed-1", False, fired + latency * S)
+        *_, summary = outcomes.tick(fired + (latency + 300) * S)[0]
+    assert (summary["latency_min_s"], summary["latency_max_s"], summary["latency_mean_s"]) == (20, 60, 40)
+    assert [outcome["alarm_id"] for outcome in summary["recent"]] == ["1", "0"]
+
+    reloaded = AlarmOutcomes(clock=clock)
+    reloaded.load({"bed-1": summary})
+    view = reloaded.summary("bed-1")
+    assert view["alarms"] == 2 and view["latency_mean_s"] == 40 and "latency_sum_s" not in view
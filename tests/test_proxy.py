@@ -0,0 +1,54 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import proxy
+import proxy_async
+
+ALARM = {"device_id": "bed-1", "alarm_id": "1", "alarm_time": "07:00", "alarm_frequency": "once", "active": True}
+
+
+def broken_weather(location, stale_ok=False):
+    raise RuntimeError("weather cache broken")
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+    for module in (proxy, proxy_async):
+        monkeypatch.setattr(module.service, "alarm_sound", broken_weather)
+    monkeypatch.setattr(proxy, "send_command", lambda device, command, payload: sent.append((command, payload)))
+
+    async def send_command(device, command, payload):
+        sent.append((command, payload))
+    monkeypatch.setattr(proxy_async, "send_command", send_command)
+    return sent
+
+
+def test_weather_error_does_not_suppress_alarm(sent):
+    assert proxy.trigger_alarm(("bed-1", "1"), ALARM, datetime(2026, 3, 2, 7, 0)) is not None
+    assert sent[:2] == [("alarm_sound", {"alarm_sound": 1}), ("trigger_alarm", {"trigger_alarm": "trigger_alarm"})]
+
+
+def test_weather_error_does_not_suppress_alarm_async(sent):
+    assert asyncio.run(proxy_async.trigger_alarm(("bed-1", "1"), ALARM, datetime(2026, 3, 2, 7, 0))) is not None
+    assert sent[:2] == [("alarm_sound", {"alarm_sound": 1}), ("trigger_alarm", {"trigger_alarm": "trigger_alarm"})]
+
+
+def test_spawned_tasks_are_kept_until_done_and_errors_logged(monkeypatch, caplog):
+    def broken_get(location, stale_ok=False):
+        raise RuntimeError("weather api down")
+
+    monkeypatch.setattr(proxy_async.service, "weather_api_key", "key")
+    monkeypatch.setattr(proxy_async.service.weather_cache, "get", broken_get)
+
+    async def run():
+        await proxy_async.prefetch_weather(("bed-1", "1"), ALARM, datetime(2026, 3, 2, 7, 0))
+        assert len(proxy_async.pending_tasks) == 1
+        await asyncio.gather(*proxy_async.pending_tasks, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert not proxy_async.pending_tasks
+    assert [record.error for record in caplog.records if record.msg == "background task failed"] == ["weather api down"]
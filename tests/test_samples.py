@@ -0,0 +1,94 @@
+import json
+import time
+
+import pytest
+
+from samples import BINARY_RECORD, InvalidBatch, parse_batch
+
+NOW_MS = int(time.time() * 1000)
+
+
+def errors(body, content_type="application/json", device="bed-1"):
+    with pytest.raises(InvalidBatch) as e:
+        parse_batch(body, content_type, device)
+    return e.value.args[0]
+
+
+def test_json_list_and_samples_object():
+    samples = [{"pressure_value": 200, "timestamp": NOW_MS}, {"pressure_value": 100, "timestamp": NOW_MS - 1000}]
+    expected = [("bed-1", 100, (NOW_MS - 1000) * 1_000_000), ("bed-1", 200, NOW_MS * 1_000_000)]
+    assert parse_batch(json.dumps(samples).encode(), "application/json", "bed-1") == expected
+    assert parse_batch(json.dumps({"samples": samples}).encode(), "application/json; charset=utf-8", "bed-1") == expected
+    # Senza content type si assume JSON
+    assert parse_batch(json.dumps(samples).encode(), None, "bed-1") == expected
+
+
+def test_ndjson_with_device_per_line():
+    body = (json.dumps({"device_id": "bed-2", "pressure_value": 4095, "timestamp": NOW_MS}) + "\n\n"
+            + json.dumps({"pressure_value": 0, "timestamp": NOW_MS}) + "\n").encode()
+    assert parse_batch(body, "application/x-ndjson", "bed-1") == [
+        ("bed-2", 4095, NOW_MS * 1_000_000), ("bed-1", 0, NOW_MS * 1_000_000)]
+
+
+def test_binary_records():
+    body = BINARY_RECORD.pack(NOW_MS, 1960.0) + BINARY_RECORD.pack(NOW_MS - 5, 12.5)
+    assert parse_batch(body, "application/octet-stream", "bed-1") == [
+        ("bed-1", 12.5, (NOW_MS - 5) * 1_000_000), ("bed-1", 1960.0, NOW_MS * 1_000_000)]
+
+
+def test_binary_truncated_trailing_record():
+    body = BINARY_RECORD.pack(NOW_MS, 1960.0) + BINARY_RECORD.pack(NOW_MS, 100.0)[:-3]
+    assert "multiple of 12" in errors(body, "application/octet-stream")[0]["error"]
+
+
+def test_binary_value_outside_adc_range():
+    body = BINARY_RECORD.pack(NOW_MS, 100.0) + BINARY_RECORD.pack(NOW_MS, 3e38)
+    assert [error["index"] for error in errors(body, "application/octet-stream")] == [1]
+
+
+@pytest.mark.parametrize("body, content_type", [
+    (b"not json", "application/json"),
+    (b'{"samples": 5}', "application/json"),
+    (b'{"pressure_value": 1}\nnope', "application/x-ndjson"),
+    (b"\xff\xfe", "application/x-ndjson"),
+])
+def test_malformed_payloads(body, content_type):
+    assert len(errors(body, content_type)) == 1
+
+
+def test_wrong_content_type_is_not_parsed_as_binary():
+    # Un payload binario dichiarato come JSON viene rifiutato, non interpretato
+    assert "malformed payload" in errors(BINARY_RECORD.pack(NOW_MS, 1.0), "application/json")[0]["error"]
+
+
+def test_errors_are_reported_per_index():
+    samples = [
+        {"pressure_value": 100},
+        {"pressure_value": True},
+        {"pressure_value": "100"},
+        {"pressure_value": float("nan")},
+        {"pressure_value": float("inf")},
+        {"pressure_value": 100, "device_id": "bed 1"},
+        {"pressure_value": 100, "device_id": "abc\n"},
+        {"timestamp": NOW_MS},
+        "100",
+    ]
+    reported = errors(json.dumps(samples).encode())
+    assert [error["index"] for error in reported] == list(range(1, len(samples)))
+
+
+def test_missing_timestamp_uses_now_and_ms_are_converted():
+    # Senza timestamp si usa l'istante di ricezione, al millisecondo
+    before = time.time_ns() // 1_000_000 * 1_000_000
+    [(_, _, timestamp)] = parse_batch(b'[{"pressure_value": 100}]', "application/json", "bed-1")
+    assert before <= timestamp <= time.time_ns()
+
+    [(_, _, timestamp)] = parse_batch(json.dumps([{"pressure_value": 100, "timestamp": 1700000000123}]).encode(),
+                                      "application/json", "bed-1")
+    assert timestamp == 1700000000123 * 1_000_000
+
+
+@pytest.mark.parametrize("timestamp", [1000, NOW_MS + 2 * 86_400_000, "1700000000000", True])
+def test_timestamps_out_of_range_or_not_numbers(timestamp):
+    body = json.dumps([{"pressure_value": 100, "timestamp": timestamp}]).encode()
+    assert errors(body)[0]["index"] == 0
@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from alarm_store import AlarmStore
+from devices import DeviceRegistry
+from occupancy import OccupancyEngine
+from sampling import SamplingController, BASELINE, FAST, IDLE, MANUAL, STABLE
+
+ALARM_TIME = datetime(2026, 3, 2, 7, 0)
+VALUE_MODEL = {"type": "logistic", "window": 1, "features": ["value"], "weights": [1.0], "bias": 0.0,
+               "mean": [2000.0], "scale": [100.0]}
+
+
+def ns(moment):
+    return int(moment.timestamp() * 1e9)
+
+
+@pytest.fixture
+def occupancy():
+    return OccupancyEngine(VALUE_MODEL, confirm=1)
+
+
+@pytest.fixture
+def controller(occupancy):
+    alarms = AlarmStore()
+    alarms.add({"device_id": "bed-1", "alarm_id": "1", "alarm_time": "07:00", "alarm_frequency": "everyday",
+                "active": True})
+    return SamplingController(DeviceRegistry(sampling_rate=5), alarms, occupancy)
+
+
+def in_bed(occupancy, moment, occupied=True):
+    occupancy.update("bed-1", 3000 if occupied else 0, ns(moment))
+
+
+def target(controller, moment, device_id="bed-1"):
+    return controller.target(controller.devices.get(device_id), moment)
+
+
+def test_fast_rate_starts_before_the_alarm(controller):
+    assert target(controller, ALARM_TIME - timedelta(minutes=6)) == (5, BASELINE)
+    assert target(controller, ALARM_TIME - timedelta(minutes=5)) == (1, FAST)
+    assert target(controller, ALARM_TIME - timedelta(minutes=5), "bed-2") == (5, BASELINE)
+
+
+def test_alarm_window_closes_when_bed_empties(controller, occupancy):
+    in_bed(occupancy, ALARM_TIME - timedelta(hours=8))
+    controller.alarm_fired("bed-1", ALARM_TIME)
+    assert target(controller, ALARM_TIME + timedelta(minutes=10)) == (1, FAST)
+
+    in_bed(occupancy, ALARM_TIME + timedelta(minutes=12), occupied=False)
+    assert target(controller, ALARM_TIME + timedelta(minutes=13)) == (5, BASELINE)
+    # Dopo 10 minuti di letto libero si passa alla frequenza idle
+    assert target(controller, ALARM_TIME + timedelta(minutes=22)) == (60, IDLE)
+
+
+def test_alarm_window_closes_after_timeout_or_stop(controller, occupancy):
+    in_bed(occupancy, ALARM_TIME - timedelta(hours=8))
+    controller.alarm_fired("bed-1", ALARM_TIME)
+    assert target(controller, ALARM_TIME + timedelta(minutes=30)) == (1, FAST)
+    assert target(controller, ALARM_TIME + timedelta(minutes=31)) == (30, STABLE)
+
+    controller.alarm_fired("bed-1", ALARM_TIME)
+    controller.alarm_stopped("bed-1")
+    assert target(controller, ALARM_TIME + timedelta(minutes=1)) == (30, STABLE)
+
+
+def test_stable_occupied_and_idle_rates(controller, occupancy):
+    night = datetime(2026, 3, 2, 1, 0)
+    in_bed(occupancy, night)
+    assert target(controller, night + timedelta(minutes=9)) == (5, BASELINE)
+    assert target(controller, night + timedelta(minutes=10)) == (30, STABLE)
+
+    in_bed(occupancy, night + timedelta(minutes=20), occupied=False)
+    assert target(controller, night + timedelta(minutes=25)) == (5, BASELINE)
+    assert target(controller, night + timedelta(minutes=30)) == (60, IDLE)
+
+    # Un sampling rate manuale più lento non viene mai accelerato
+    controller.devices.get("bed-1").sampling_rate = 120
+    assert target(controller, night + timedelta(minutes=30)) == (120, IDLE)
+
+
+def test_manual_devices_keep_their_rate(controller):
+    device = controller.devices.get("bed-1")
+    device.adaptive_sampling = False
+    assert target(controller, ALARM_TIME) == (5, MANUAL)
+
+
+def test_plan_returns_only_changed_devices(controller):
+    controller.devices.get("bed-1")
+    controller.devices.get("bed-2")
+    assert [d.device_id for d in controller.plan(ALARM_TIME - timedelta(minutes=1))] == ["bed-1"]
+    assert controller.devices.get("bed-1").effective_sampling_rate == 1
+    assert controller.plan(ALARM_TIME - timedelta(minutes=1)) == []
+    stats = controller.get_stats()
+    assert stats["changes"] == 1 and stats["modes"] == {FAST: 1, BASELINE: 1}
@@ -0,0 +1,128 @@
+import time
+from datetime import datetime
+
+import pytest
+
+from scheduler import AlarmScheduler, InvalidAlarm, next_fire_time, validate_alarm
+
+MONDAY_6AM = datetime(2026, 3, 2, 6, 0)
+
+
+def alarm(**fields):
+    return {"alarm_id": "1", "alarm_time": "07:00", "alarm_frequency": "everyday", "active": True, **fields}
+
+
+def test_next_fire_time_today_and_weekdays():
+    assert next_fire_time(alarm(), MONDAY_6AM) == datetime(2026, 3, 2, 7, 0)
+    assert next_fire_time(alarm(alarm_frequency="weekends"), MONDAY_6AM) == datetime(2026, 3, 7, 7, 0)
+
+
+@pytest.mark.parametrize("fields", [
+    {"alarm_time": 700},
+    {"alarm_time": None},
+    {"alarm_time": "25:99"},
+    {"alarm_frequency": ["everyday"]},
+    {"alarm_frequency": {"days": 1}},
+    {"alarm_frequency": "sometimes"},
+    {"active": False},
+])
+def test_next_fire_time_returns_none_for_invalid_alarms(fields):
+    assert next_fire_time(alarm(**fields), MONDAY_6AM) is None
+
+
+@pytest.mark.parametrize("alarm_time, alarm_frequency", [
+    ("25:99", "once"), ("7", "once"), (700, "once"), ("07:00", "daily"), ("07:00", ["once"]),
+])
+def test_validate_alarm_rejects(alarm_time, alarm_frequency):
+    with pytest.raises(InvalidAlarm):
+        validate_alarm(alarm_time, alarm_frequency)
+
+
+def test_validate_alarm_accepts_missing_frequency():
+    assert validate_alarm("23:59", None).hour == 23
+
+
+class FakeClock:
+    def __init__(self, t):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(datetime(2026, 3, 2, 6, 59, 50))
+
+
+@pytest.fixture
+def fired():
+    return []
+
+
+@pytest.fixture
+def scheduler(clock, fired):
+    scheduler = AlarmScheduler(lambda key, alarm, fire_time: fired.append((key, fire_time)), now=clock).start()
+    yield scheduler
+    scheduler.stop()
+
+
+def test_alarms_in_the_same_minute_all_fire_once(scheduler, clock, fired):
+    for alarm_id in ("1", "2", "3"):
+        scheduler.schedule(("bed-1", alarm_id), alarm(alarm_id=alarm_id))
+    clock.t = datetime(2026, 3, 2, 7, 0, 5)
+    scheduler.schedule(("bed-2", "1"), alarm(alarm_time="08:00"))   # risveglia il thread
+    wait_for(lambda: len(fired) == 3)
+    assert sorted(key for key, _ in fired) == [("bed-1", "1"), ("bed-1", "2"), ("bed-1", "3")]
+    assert {fire_time for _, fire_time in fired} == {datetime(2026, 3, 2, 7, 0)}
+    # Le sveglie ricorrenti ripartono dal giorno dopo
+    wait_for(lambda: scheduler.next_fire(("bed-1", "1")) == datetime(2026, 3, 3, 7, 0))
+    assert scheduler.get_stats()["fired"] == 3
+
+
+def test_create_and_update_wake_the_thread(scheduler, clock, fired):
+    # Il thread dorme fino a MAX_SLEEP: solo il risveglio di schedule() fa suonare subito la sveglia
+    scheduler.schedule(("bed-1", "1"), alarm(alarm_time="09:00"))
+    clock.t = datetime(2026, 3, 2, 7, 0, 1)
+    scheduler.schedule(("bed-1", "2"), alarm(alarm_id="2"))
+    wait_for(lambda: [key for key, _ in fired] == [("bed-1", "2")])
+
+    scheduler.schedule(("bed-1", "1"), alarm(alarm_time="07:00"))
+    wait_for(lambda: [key for key, _ in fired] == [("bed-1", "2"), ("bed-1", "1")])
+
+
+def test_deleted_alarm_does_not_fire(scheduler, clock, fired):
+    scheduler.schedule(("bed-1", "1"), alarm())
+    scheduler.schedule(("bed-1", "2"), alarm(alarm_id="2"))
+    assert scheduler.unschedule(("bed-1", "1"))
+    clock.t = datetime(2026, 3, 2, 7, 0, 5)
+    scheduler.schedule(("bed-1", "2"), alarm(alarm_id="2"))
+    wait_for(lambda: fired)
+    time.sleep(0.1)
+    assert [key for key, _ in fired] == [("bed-1", "2")]
+    assert scheduler.next_fire(("bed-1", "1")) is None
+
+
+def test_editing_alarm_in_its_firing_minute_does_not_fire_again(scheduler, clock, fired):
+    scheduler.schedule(("bed-1", "1"), alarm())
+    clock.t = datetime(2026, 3, 2, 7, 0, 5)
+    scheduler.schedule(("bed-2", "1"), alarm(alarm_time="08:00"))
+    wait_for(lambda: len(fired) == 1)
+
+    clock.t = datetime(2026, 3, 2, 7, 0, 40)
+    assert scheduler.schedule(("bed-1", "1"), alarm(alarm_frequency="weekdays")) == datetime(2026, 3, 3, 7, 0)
+    time.sleep(0.1)
+    assert len(fired) == 1
+
+    # Dal minuto successivo la sveglia modificata torna a seguire il proprio orario
+    clock.t = datetime(2026, 3, 2, 7, 1, 0)
+    assert scheduler.schedule(("bed-1", "1"), alarm(alarm_time="07:01")) == datetime(2026, 3, 2, 7, 1)
+    wait_for(lambda: len(fired) == 2)
@@ -0,0 +1,109 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from ingest import IngestPipeline
+from live import LiveHub
+from scheduler import AlarmScheduler
+from service import ProxyService, Result
+from utils import AlarmDB
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = ProxyService(IngestPipeline(lambda records: None, spool_file=str(tmp_path / "spool.lp")), LiveHub(),
+                           AlarmScheduler(lambda *args: None))
+    service.alarm_db = AlarmDB(str(tmp_path / "alarms.db"))
+    yield service
+    service.alarm_db.close()
+
+
+def perform(result):
+    for write, args in result.writes:
+        write(*args)
+    return result
+
+
+@pytest.mark.parametrize("data", [
+    {"alarm_id": "1", "alarm_time": "25:99", "alarm_frequency": "once"},
+    {"alarm_id": "1", "alarm_time": 700, "alarm_frequency": "once"},
+    {"alarm_id": "1", "alarm_time": "07:00", "alarm_frequency": ["once"]},
+    {"alarm_id": "1", "alarm_time": "07:00", "alarm_frequency": "daily"},
+])
+def test_set_new_alarm_rejects_invalid_alarm_before_saving(service, data):
+    result = perform(service.set_new_alarm("bed-1", data))
+    assert result.status == 400
+    assert not result.writes and not result.messages
+    assert ("bed-1", "1") not in service.alarms
+    assert service.alarm_db.count() == 0
+
+
+def test_set_new_alarm_saves_and_schedules(service):
+    result = perform(service.set_new_alarm("bed-1", {"alarm_id": "1", "alarm_time": "07:00", "alarm_frequency": "weekdays"}))
+    assert result.status == 201
+    assert service.alarm_db.count() == 1
+    assert service.scheduler.get_stats()["pending"] == 1
+
+
+def test_modify_alarm_rejects_invalid_fields(service):
+    perform(service.set_new_alarm("bed-1", {"alarm_id": "1", "alarm_time": "07:00", "alarm_frequency": "once"}))
+
+    result = perform(service.modify_alarm("bed-1", "1", {"alarm_time": "24:00"}))
+    assert result.status == 400 and not result.writes
+    assert service.alarms.get("bed-1", "1")["alarm_time"] == "07:00"
+
+    result = perform(service.modify_alarm("bed-1", "1", {"alarm_time": "08:30", "active": False}))
+    assert result.status == 201
+    assert service.alarms.get("bed-1", "1")["alarm_time"] == "08:30"
+    assert service.alarms.get("bed-1", "1")["active"] is False
+
+
+def test_startup_load_skips_invalid_rows(service, caplog):
+    rows = [
+        {"device_id": "bed-1", "alarm_id": "1", "alarm_time": "07:00", "alarm_frequency": "once", "active": True},
+        {"device_id": "bed-1", "alarm_id": "2", "alarm_time": 700, "alarm_frequency": "once", "active": True},
+        {"device_id": "bed-1", "alarm_id": "3", "alarm_time": "07:00", "alarm_frequency": ["once"], "active": True},
+        {"device_id": "bed 1", "alarm_id": "4", "alarm_time": "07:00", "alarm_frequency": "once", "active": True},
+    ]
+    service.load_alarms(rows, {})
+    assert len(service.alarms) == 1
+    assert [r.getMessage() for r in caplog.records].count("invalid alarm skipped") == 3
+
+
+@pytest.mark.parametrize("location", [123, "", "   ", None, ["Bologna"]])
+def test_set_alarm_location_rejects_non_string(service, location):
+    result = service.set_alarm_location("bed-1", {"location": location})
+    assert result.status == 400
+    assert service.devices.get("bed-1").weather_location == "Bologna"
+
+
+def test_alarm_sound_falls_back_to_default_on_weather_error(service):
+    class BrokenCache:
+        def get(self, location, stale_ok=False):
+            raise AttributeError("'int' object has no attribute 'strip'")
+
+    service.weather_api_key = "key"
+    service.weather_cache = BrokenCache()
+    assert service.alarm_sound(123) == 1
+
+
+@pytest.mark.parametrize("value", [1e300, -1, 4096, float("nan")])
+def test_sensor_data_rejects_values_outside_adc_range(service, value):
+    assert service.sensor_data("bed-1", {"pressure_value": value}).status == 400
+    body = ('[{"pressure_value": 100}, {"pressure_value": %r}]' % value).replace("nan", "NaN").encode()
+    result = service.sensor_data_batch("bed-1", body, "application/json")
+    assert result.status == 400 and result.body["errors"][0]["index"] == 1
+    assert service.ingest.get_stats()["enqueued"] == 0
+
+
+@pytest.mark.parametrize("minutes", ["nan", "inf", "-5", "0", "abc", str(7 * 24 * 60 + 1)])
+def test_pressure_query_rejects_invalid_minutes(service, minutes):
+    result = service.pressure_query("bed-1", MultiDict({"minutes": minutes}))
+    assert isinstance(result, Result) and result.status == 400
+
+
+def test_pressure_query_minutes_window(service):
+    now = 1_700_000_000_000_000_000
+    since, until, _, _ = service.pressure_query("bed-1", MultiDict({"minutes": "1.5"}), now=now)
+    assert (since, until) == (now - 90 * 10 ** 9, now)
+    since, _, _, _ = service.pressure_query("bed-1", MultiDict(), now=now)
+    assert since == now - 3600 * 10 ** 9
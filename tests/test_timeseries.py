@@ -0,0 +1,90 @@
+import numpy as np
+from werkzeug.datastructures import MultiDict
+
+from ingest import IngestPipeline
+from live import LiveHub
+from scheduler import AlarmScheduler
+from service import ProxyService
+from timeseries import RecentSeries, concat, to_json
+
+MS = 1_000_000
+T0 = 1_700_000_000_000 * MS
+
+
+def recent(capacity=4):
+    return RecentSeries(capacity=capacity, transitions=4, clock=lambda: T0)
+
+
+def test_ring_keeps_last_samples_after_wraparound():
+    series = recent()
+    for i in range(6):
+        series.add("bed-1", 100 + i, T0 + i * MS)
+
+    timestamps, values = series.query("bed-1")["pressure"]
+    assert values.tolist() == [102, 103, 104, 105]
+    assert timestamps.tolist() == [T0 + i * MS for i in range(2, 6)]
+    # Completo solo dopo l'ultimo campione sovrascritto
+    assert series.covered_since("bed-1") == T0 + 1 * MS + 1
+    assert series.get_stats()["buffered"] == 4
+
+
+def test_covered_since_is_start_until_first_wrap():
+    series = recent()
+    assert series.covered_since("bed-1") == T0
+    series.add("bed-1", 100, T0 + MS)
+    assert series.covered_since("bed-1") == T0
+
+
+def test_out_of_order_samples_are_sorted_by_query():
+    series = recent(capacity=8)
+    for offset, value in [(3, 3), (1, 1), (2, 2), (5, 5)]:
+        series.add("bed-1", value, T0 + offset * MS)
+    timestamps, values = series.query("bed-1", since=T0 + 2 * MS, until=T0 + 5 * MS)["pressure"]
+    assert values.tolist() == [2, 3, 5]
+
+
+def test_initial_occupancy_state_before_interval():
+    series = recent()
+    series.add_transition("bed-1", True, 0.9, T0 + 1 * MS)
+    series.add_transition("bed-1", False, 0.1, T0 + 5 * MS)
+    result = series.query("bed-1", since=T0 + 3 * MS)
+    assert result["occupancy"][0].tolist() == [T0 + 5 * MS]
+    assert result["initial"] == {"timestamp": T0 + 1 * MS, "occupied": True, "probability": 0.9}
+
+
+def test_pressure_query_reads_older_range_from_influxdb(tmp_path):
+    service = ProxyService(IngestPipeline(lambda records: None, spool_file=str(tmp_path / "spool.lp")), LiveHub(),
+                           AlarmScheduler(lambda *args: None))
+    service.recent = recent()
+    for i in range(6):
+        service.recent.add("bed-1", 100 + i, T0 + i * MS)
+    now = T0 + 10 * MS
+
+    # Intervallo coperto dalla memoria: nessuna query a InfluxDB
+    since, until, covered, series = service.pressure_query("bed-1", MultiDict({"since": T0 // MS + 3}), now=now)
+    assert since >= covered
+    assert service.pressure_result("bed-1", since, until, covered, series).body["source"] == "memory"
+
+    # Dati sovrascritti nel buffer: la parte prima di `covered` viene da InfluxDB
+    since, until, covered, series = service.pressure_query("bed-1", MultiDict({"since": T0 // MS}), now=now)
+    assert since < covered == T0 + 1 * MS + 1
+    history = {"pressure": (np.array([T0, T0 + MS], np.int64), np.array([100.0, 101.0])),
+               "occupancy": (np.empty(0, np.int64), np.empty(0, np.int8), np.empty(0, np.float32)),
+               "initial": None}
+    body = service.pressure_result("bed-1", since, until, covered, series, history).body
+    assert body["source"] == "influxdb+memory"
+    assert body["pressure"]["value"] == [100.0, 101.0, 102.0, 103.0, 104.0, 105.0]
+    assert body["pressure"]["t"] == [T0 // MS + i for i in range(6)]
+
+
+def test_to_json_uses_milliseconds():
+    series = recent()
+    series.add("bed-1", 100, T0 + 7 * MS)
+    series.add_transition("bed-1", True, 0.87654, T0 + 7 * MS)
+    empty = {"pressure": (np.empty(0, np.int64), np.empty(0, np.float64)),
+             "occupancy": (np.empty(0, np.int64), np.empty(0, np.int8), np.empty(0, np.float32)), "initial": None}
+    assert to_json(concat(empty, series.query("bed-1"))) == {
+        "pressure": {"t": [T0 // MS + 7], "value": [100.0]},
+        "occupancy": {"t": [T0 // MS + 7], "occupied": [True], "probability": [0.877]},
+        "initial": None,
+    }
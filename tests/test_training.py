@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from sklearn.model_selection import GroupKFold
+
+from training import block_groups, build_features, evaluate, purge, window_features
+
+WINDOW = 5
+FOLDS = 4
+
+
+def recordings(lengths, seed=0):
+    ## Registrazioni sintetiche: pressione alta quando la persona è sdraiata, con rumore
+    rng = np.random.default_rng(seed)
+    values, labels, offsets = [], [], []
+    for length in lengths:
+        offsets.append(sum(len(v) for v in values))
+        label = (np.arange(length) // 40) % 2
+        values.append(label * 1500 + 200 + rng.normal(0, 50, length))
+        labels.append(label.astype(np.int8))
+    return np.concatenate(values), np.concatenate(labels), offsets
+
+
+def folds(offsets, n):
+    groups = block_groups(offsets, n, FOLDS)
+    for train, test in GroupKFold(n_splits=FOLDS).split(np.zeros((n, 1)), groups=groups):
+        yield groups, purge(train, test, WINDOW, n), test
+
+
+def test_blocks_are_contiguous_and_ordered_within_each_recording():
+    offsets, n = [0, 150, 250], 400
+    groups = block_groups(offsets, n, FOLDS)
+    for recording, (a, b) in enumerate(zip(offsets, offsets[1:] + [n])):
+        assert np.all(np.diff(groups[a:b]) >= 0)
+        assert set(groups[a:b]) == set(range(recording * FOLDS, (recording + 1) * FOLDS))
+
+
+def test_no_fold_trains_on_its_validation_blocks():
+    values, _, offsets = recordings([150, 100, 230])
+    for groups, train, test in folds(offsets, len(values)):
+        assert not set(groups[train]) & set(groups[test])
+        assert not set(train) & set(test)
+
+
+def test_no_training_window_overlaps_the_validation_samples():
+    values, _, offsets = recordings([150, 100, 230])
+    n = len(values)
+    for _, train, test in folds(offsets, n):
+        # La finestra di un campione di training comprende i WINDOW-1 campioni che lo precedono:
+        # nessuno di questi può essere un campione di validazione
+        in_test = np.zeros(n, dtype=bool)
+        in_test[test] = True
+        for i in train:
+            assert not in_test[max(i - WINDOW + 1, 0):i + 1].any()
+        # Il purge toglie solo i campioni subito dopo un blocco di validazione
+        assert len(train) >= n - len(test) - (WINDOW - 1) * len(np.flatnonzero(np.diff(in_test.astype(int)) == -1))
+
+
+def test_features_do_not_cross_recording_boundaries():
+    values, _, offsets = recordings([60, 60])
+    features = build_features(values, offsets, WINDOW)
+    np.testing.assert_array_equal(features[60:], window_features(values[60:], WINDOW))
+
+
+@pytest.mark.parametrize("kind, param", [("tree", 2), ("logistic", 1.0)])
+def test_evaluate_on_separable_recordings(kind, param):
+    values, labels, offsets = recordings([200, 160])
+    X = build_features(values, offsets, WINDOW)
+    groups = block_groups(offsets, len(values), FOLDS)
+    result = evaluate((kind, param, WINDOW, X, labels, groups, FOLDS))
+    assert result["kind"] == kind and result["window"] == WINDOW
+    assert result["accuracy"] > 0.9 and result["f1"] > 0.9
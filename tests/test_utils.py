@@ -0,0 +1,58 @@
+import sqlite3
+
+import pytest
+
+import utils
+from utils import AlarmDB, load_alarms_from
+
+
+def alarm(alarm_id, device_id="bed-1"):
+    return {"device_id": device_id, "alarm_id": alarm_id, "alarm_time": "07:00", "alarm_frequency": "once", "active": True}
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = AlarmDB(str(tmp_path / "alarms.db"))
+    yield db
+    db.close()
+
+
+def test_save_many_is_all_or_nothing(db):
+    db.save(alarm("existing"))
+    # Un trigger fa fallire l'inserimento a metà batch
+    db._conn.execute("CREATE TRIGGER reject_bad BEFORE INSERT ON alarms WHEN NEW.alarm_id = 'bad'"
+                     " BEGIN SELECT RAISE(ABORT, 'bad alarm'); END")
+
+    with pytest.raises(sqlite3.IntegrityError):
+        db.save_many([alarm("1"), alarm("2"), alarm("bad"), alarm("3")])
+
+    assert not db._conn.in_transaction
+    assert [a["alarm_id"] for a in db.load_all()] == ["existing"]
+    db.save_many([alarm("1"), alarm("2")])
+    assert db.count() == 3
+
+
+def test_save_many_replaces_existing_rows(db):
+    db.save_many([alarm(str(i)) for i in range(1000)])
+    db.save_many([{**alarm("1"), "active": False}])
+    assert db.count() == 1000
+    assert {a["alarm_id"]: a["active"] for a in db.load_all()}["1"] is False
+
+
+def test_load_alarms_from_missing_db_does_not_create_it(tmp_path):
+    path = tmp_path / "missing.db"
+    assert load_alarms_from(str(path)) == []
+    assert not path.exists()
+
+
+def test_load_alarms_from_db_closes_connection(tmp_path, monkeypatch):
+    path = str(tmp_path / "alarms.db")
+    db = AlarmDB(path)
+    db.save_many([alarm("1"), alarm("2", "bed-2")])
+    db.close()
+
+    closed = []
+    close = AlarmDB.close
+    monkeypatch.setattr(utils.AlarmDB, "close", lambda self: closed.append(self) or close(self))
+    assert len(load_alarms_from(path)) == 2
+    assert len(closed) == 1
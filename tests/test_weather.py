@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from weather import DEFAULT_CONDITION, WeatherCache
+
+
+class FakeWeather:
+    """API meteo locale: risponde con `status` e `body` e conta le richieste per città."""
+
+    def __init__(self):
+        self.status = 200
+        self.body = {"weather": [{"main": "Rain"}]}
+        self.delay = 0.0
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests.append(self.path)
+                time.sleep(fake.delay)
+                body = fake.body if isinstance(fake.body, bytes) else json.dumps(fake.body).encode()
+                self.send_response(fake.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/weather"
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+
+@pytest.fixture
+def fake():
+    fake = FakeWeather()
+    yield fake
+    fake.server.shutdown()
+    fake.server.server_close()
+
+
+def cache_for(fake, **kwargs):
+    return WeatherCache("key", api_url=fake.url, **kwargs)
+
+
+def test_fresh_entries_are_served_from_cache(fake):
+    cache = cache_for(fake)
+    assert cache.get("Bologna") == "Rain"
+    assert cache.get(" bologna ") == "Rain"
+    assert len(fake.requests) == 1
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_expired_entry_is_refreshed_but_stale_ok_skips_network(fake):
+    cache = cache_for(fake, ttl=0.05)
+    cache.get("Bologna")
+    time.sleep(0.1)
+    fake.body = {"weather": [{"main": "Snow"}]}
+    # Al momento della sveglia va bene l'ultimo valore noto, senza chiamate
+    assert cache.get("Bologna", stale_ok=True) == "Rain"
+    assert len(fake.requests) == 1
+    assert cache.get("Bologna") == "Snow"
+    assert len(fake.requests) == 2
+
+
+def test_concurrent_misses_are_coalesced(fake):
+    fake.delay = 0.2
+    cache = cache_for(fake)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("Bologna"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["Rain"] * 8
+    assert len(fake.requests) == 1
+    assert cache.get_stats()["coalesced"] == 7
+
+
+@pytest.mark.parametrize("status, body", [
+    (500, {"message": "boom"}),
+    (200, b"not json"),
+    (200, {"weather": []}),
+    (200, {"weather": [{}]}),
+    (200, {"weather": ["Rain"]}),
+    (200, {"weather": None}),
+    (200, ["weather"]),
+])
+def test_upstream_errors_keep_last_known_condition(fake, status, body):
+    cache = cache_for(fake, ttl=0.05, retry_after=10)
+    assert cache.get("Bologna") == "Rain"
+    time.sleep(0.1)
+    fake.status, fake.body = status, body
+
+    assert cache.get("Bologna") == "Rain"
+    # Il valore scaduto resta valido per retry_after: niente nuove chiamate nel frattempo
+    assert cache.get("Bologna") == "Rain"
+    assert len(fake.requests) == 2
+    stats = cache.get_stats()
+    assert stats["errors"] == 1 and stats["stale"] == 1
+
+
+def test_upstream_error_without_cached_value_returns_default(fake):
+    fake.status, fake.body = 200, {"weather": [{"description": "no main"}]}
+    assert cache_for(fake).get("Bologna") == DEFAULT_CONDITION
@@ -0,0 +1,206 @@
+import threading
+import time
+import numpy as np
+
+
+# Query Flux per i dati più vecchi del buffer in memoria. I parametri (_bucket, _device,
+# _start, _stop) vengono passati con params= di query_api, non interpolati nel testo.
+PRESSURE_QUERY = """
+from(bucket: _bucket)
+  |> range(start: _start, stop: _stop)
+  |> filter(fn: (r) => r._measurement == "pressure" and r._field == "value" and r.device == _device)
+  |> keep(columns: ["_time", "_value"])
+"""
+
+OCCUPANCY_QUERY = """
+from(bucket: _bucket)
+  |> range(start: _start, stop: _stop)
+  |> filter(fn: (r) => r._measurement == "occupancy" and r.device == _device)
+  |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+  |> keep(columns: ["_time", "occupied", "probability"])
+"""
+
+
+class _Ring:
+    """Buffer circolare a colonne (array NumPy preallocati) per un singolo dispositivo."""
+
+    __slots__ = ("columns", "capacity", "next", "size", "ordered", "last", "evicted")
+
+    def __init__(self, capacity, dtypes):
+        self.columns = [np.empty(capacity, dtype=dtype) for dtype in dtypes]
+        self.capacity = capacity
+        self.next = 0        # prossima posizione da scrivere
+        self.size = 0
+        self.ordered = True  # False se è arrivato un campione con timestamp precedente all'ultimo
+        self.last = None
+        self.evicted = None  # timestamp più recente tra quelli sovrascritti
+
+    def append(self, *values):
+        i = self.next
+        if self.size == self.capacity:
+            old = int(self.columns[0][i])
+            self.evicted = old if self.evicted is None else max(self.evicted, old)
+        for column, value in zip(self.columns, values):
+            column[i] = value
+        timestamp = values[0]
+        if self.last is not None and timestamp < self.last:
+            self.ordered = False
+        self.last = timestamp if self.last is None else max(self.last, timestamp)
+        self.next = (i + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+        elif self.next == 0:
+            # Il buffer ha fatto un giro completo: se nel frattempo i campioni sono stati
+            # scritti in ordine, l'intero contenuto è di nuovo ordinato
+            self.ordered = bool(np.all(np.diff(self.columns[0]) >= 0))
+
+    def wrapped(self):
+        return self.size == self.capacity
+
+    def snapshot(self):
+        # Copia in ordine di inserimento: le query lavorano fuori dal lock
+        if not self.wrapped():
+            return [column[:self.size].copy() for column in self.columns], self.ordered
+        return [np.concatenate((column[self.next:], column[:self.next])) for column in self.columns], self.ordered
+
+
+class RecentSeries:
+    """Ultimi campioni di pressione e transizioni di occupazione per dispositivo, in memoria.
+
+    Ogni dispositivo ha un buffer circolare di `capacity` campioni (timestamp int64
+    in ns, valore float64) e uno più piccolo per le transizioni di occupazione,
+    alimentati dal percorso di ingest. Le query su un intervallo interamente
+    coperto dal buffer non toccano InfluxDB; covered_since() dice da quando il
+    buffer è completo, cioè dall'avvio del proxy finché il buffer non fa il primo
+    giro e poi dal campione successivo all'ultimo sovrascritto.
+    """
+
+    def __init__(self, capacity=65536, transitions=4096, clock=time.time_ns):
+        self.capacity = capacity
+        self.transitions = transitions
+        self.started = clock()
+        self._pressure = {}   # device_id -> _Ring(timestamp, valore)
+        self._occupancy = {}  # device_id -> _Ring(timestamp, occupato, probabilità)
+        self._lock = threading.Lock()
+        self.stats = {"samples": 0, "transitions": 0, "queries": 0}
+
+    def add(self, device_id, value, timestamp):
+        with self._lock:
+            ring = self._pressure.get(device_id)
+            if ring is None:
+                ring = self._pressure[device_id] = _Ring(self.capacity, (np.int64, np.float64))
+            ring.append(timestamp, value)
+            self.stats["samples"] += 1
+
+    def add_transition(self, device_id, occupied, probability, timestamp):
+        with self._lock:
+            ring = self._occupancy.get(device_id)
+            if ring is None:
+                ring = self._occupancy[device_id] = _Ring(self.transitions, (np.int64, np.int8, np.float32))
+            ring.append(timestamp, int(occupied), probability)
+            self.stats["transitions"] += 1
+
+    def covered_since(self, device_id):
+        """Timestamp (ns) da cui in poi i dati in memoria del dispositivo sono completi."""
+        with self._lock:
+            ring = self._pressure.get(device_id)
+            if ring is None or ring.evicted is None:
+                return self.started
+            # Dopo il primo giro è completo solo ciò che segue l'ultimo campione sovrascritto
+            return max(self.started, ring.evicted + 1)
+
+    @staticmethod
+    def _select(ring_snapshot, since, until):
+        columns, ordered = ring_snapshot
+        timestamps = columns[0]
+        if not ordered:
+            order = np.argsort(timestamps, kind="stable")
+            columns = [column[order] for column in columns]
+            timestamps = columns[0]
+        lo = 0 if since is None else np.searchsorted(timestamps, since, side="left")
+        hi = len(timestamps) if until is None else np.searchsorted(timestamps, until, side="right")
+        return [column[lo:hi] for column in columns], lo
+
+    def query(self, device_id, since=None, until=None):
+        """Campioni e transizioni tra since e until (ns) come array NumPy.
+
+        Restituisce {"pressure": (timestamp, valori), "occupancy": (timestamp,
+        occupato, probabilità), "initial": stato di occupazione all'inizio
+        dell'intervallo o None}.
+        """
+        with self._lock:
+            self.stats["queries"] += 1
+            pressure = self._pressure.get(device_id)
+            occupancy = self._occupancy.get(device_id)
+            pressure = pressure.snapshot() if pressure is not None else None
+            occupancy = occupancy.snapshot() if occupancy is not None else None
+
+        result = {
+            "pressure": (np.empty(0, np.int64), np.empty(0, np.float64)),
+            "occupancy": (np.empty(0, np.int64), np.empty(0, np.int8), np.empty(0, np.float32)),
+            "initial": None,
+        }
+        if pressure is not None:
+            result["pressure"] = tuple(self._select(pressure, since, until)[0])
+        if occupancy is not None:
+            columns, lo = self._select(occupancy, since, until)
+            result["occupancy"] = tuple(columns)
+            if lo > 0:
+                # Ultima transizione prima dell'intervallo: lo stato con cui il grafico parte
+                before = self._select(occupancy, None, since - 1)[0]
+                result["initial"] = {"timestamp": int(before[0][-1]), "occupied": bool(before[1][-1]),
+                                     "probability": round(float(before[2][-1]), 3)}
+        return result
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["devices"] = len(self._pressure)
+            stats["buffered"] = sum(ring.size for ring in self._pressure.values())
+        return stats
+
+
+def _ns(record_time):
+    return int(record_time.timestamp() * 1_000_000) * 1000
+
+
+def history_from_tables(pressure_tables, occupancy_tables):
+    """Converte le tabelle Flux di PRESSURE_QUERY e OCCUPANCY_QUERY nel formato di RecentSeries.query()."""
+    pressure = [(_ns(r.get_time()), r.get_value()) for table in pressure_tables for r in table.records]
+    occupancy = [(_ns(r.get_time()), r["occupied"], r["probability"])
+                 for table in occupancy_tables for r in table.records]
+    pressure.sort()
+    occupancy.sort()
+    return {
+        "pressure": (np.array([p[0] for p in pressure], dtype=np.int64),
+                     np.array([p[1] for p in pressure], dtype=np.float64)),
+        "occupancy": (np.array([o[0] for o in occupancy], dtype=np.int64),
+                      np.array([o[1] or 0 for o in occupancy], dtype=np.int8),
+                      np.array([o[2] or 0.0 for o in occupancy], dtype=np.float32)),
+        "initial": None,
+    }
+
+
+def concat(older, newer):
+    """Unisce il risultato di InfluxDB (intervallo precedente) con quello in memoria."""
+    return {
+        "pressure": tuple(np.concatenate(pair) for pair in zip(older["pressure"], newer["pressure"])),
+        "occupancy": tuple(np.concatenate(pair) for pair in zip(older["occupancy"], newer["occupancy"])),
+        "initial": older["initial"] if older["initial"] is not None or len(older["occupancy"][0]) else newer["initial"],
+    }
+
+
+def to_json(series):
+    """Serie a colonne (timestamp in ms) pronte per jsonify."""
+    timestamps, values = series["pressure"]
+    occ_timestamps, occupied, probability = series["occupancy"]
+    initial = series["initial"]
+    return {
+        "pressure": {"t": (timestamps // 1_000_000).tolist(), "value": values.tolist()},
+        "occupancy": {
+            "t": (occ_timestamps // 1_000_000).tolist(),
+            "occupied": occupied.astype(bool).tolist(),
+            "probability": probability.astype(np.float64).round(3).tolist(),
+        },
+        "initial": initial and {**initial, "timestamp": initial["timestamp"] // 1_000_000},
+    }
@@ -0,0 +1,230 @@
+"""Training e valutazione del classificatore di occupazione del letto.
+
+Sostituisce i notebook in Evaluation/: carica i CSV con NumPy, calcola le feature
+sulla finestra mobile in modo vettoriale (stesse definizioni di occupancy.FEATURES),
+valuta in cross-validation alberi di decisione e regressioni logistiche in
+parallelo su più core ed esporta il modello migliore nel formato compatto letto
+dal proxy all'avvio (occupancy_model.json).
+
+I file passati con --data devono essere registrazioni dello stesso tipo dei campioni
+che arrivano al proxy, cioè letture grezze: merged_with_average.csv contiene valori
+già mediati e non va mescolato con quelle (il modello userebbe feature diverse da
+quelle calcolate da OccupancyEngine).
+
+Esempio:
+    python training.py --data Evaluation/merged_without_average.csv
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
+from sklearn.model_selection import GroupKFold
+from sklearn.tree import DecisionTreeClassifier
+
+from occupancy import FEATURES
+
+
+@contextmanager
+def stage(name, timings):
+    ## Misura la durata di una fase della pipeline
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+    print(f"[{name}] {timings[name] * 1000:.1f} ms")
+
+
+def load_csv(paths):
+    """Carica uno o più CSV (colonne value, sdraiato) e restituisce (values, labels, offsets).
+
+    offsets contiene l'indice di inizio di ogni file, per non mescolare le finestre tra registrazioni.
+    """
+    values, labels, offsets = [], [], [0]
+    for path in paths:
+        data = np.loadtxt(path, delimiter=",", skiprows=1, dtype=np.float64, ndmin=2)
+        values.append(data[:, 0])
+        labels.append(data[:, 1].astype(np.int8))
+        offsets.append(offsets[-1] + len(data))
+    return np.concatenate(values), np.concatenate(labels), offsets[:-1]
+
+
+def window_features(values, window):
+    """Feature sulla finestra mobile per una singola registrazione, come OccupancyEngine.
+
+    Nei primi window-1 campioni la finestra è parziale (contiene solo i campioni già visti).
+    """
+    n = len(values)
+    idx = np.arange(n)
+    counts = np.minimum(idx + 1, window).astype(np.float64)
+
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    csum_sq = np.concatenate(([0.0], np.cumsum(values * values)))
+    start = np.maximum(idx + 1 - window, 0)
+    mean = (csum[idx + 1] - csum[start]) / counts
+    variance = np.maximum((csum_sq[idx + 1] - csum_sq[start]) / counts - mean * mean, 0.0)
+
+    # Ripetere il primo valore all'inizio non cambia min/max delle finestre parziali
+    padded = np.concatenate((np.full(window - 1, values[0]), values))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window)
+
+    delta = np.concatenate(([0.0], np.diff(values)))
+
+    columns = {
+        "value": values,
+        "mean": mean,
+        "min": windows.min(axis=1),
+        "max": windows.max(axis=1),
+        "std": np.sqrt(variance),
+        "delta": delta,
+    }
+    return np.column_stack([columns[name] for name in FEATURES])
+
+
+def build_features(values, offsets, window):
+    ## Calcola le feature separatamente per ogni registrazione e le concatena
+    bounds = list(offsets) + [len(values)]
+    return np.vstack([window_features(values[a:b], window) for a, b in zip(bounds[:-1], bounds[1:])])
+
+
+def block_groups(offsets, n, blocks):
+    """Gruppo di cross-validation di ogni campione: `blocks` blocchi contigui per registrazione.
+
+    I campioni vicini nel tempo hanno finestre sovrapposte e quasi la stessa etichetta:
+    valutare su blocchi interi evita di stimare l'accuratezza su campioni "già visti".
+    """
+    bounds = list(offsets) + [n]
+    groups = np.empty(n, dtype=np.int64)
+    for recording, (a, b) in enumerate(zip(bounds[:-1], bounds[1:])):
+        groups[a:b] = recording * blocks + np.arange(b - a) * blocks // (b - a)
+    return groups
+
+
+def purge(train, test, window, n):
+    ## Esclude dal training i campioni la cui finestra contiene campioni di test
+    in_test = np.zeros(n, dtype=np.float64)
+    in_test[test] = 1.0
+    overlaps = np.convolve(in_test, np.ones(window), mode="full")[:n] > 0
+    return train[~overlaps[train]]
+
+
+def make_model(kind, param):
+    if kind == "tree":
+        return DecisionTreeClassifier(max_depth=param, random_state=42)
+    return LogisticRegression(C=param, max_iter=1000)
+
+
+def standardize(X):
+    mean = X.mean(axis=0)
+    scale = X.std(axis=0)
+    scale[scale == 0] = 1.0
+    return mean, scale
+
+
+def evaluate(args):
+    """Cross-validation di un candidato su blocchi contigui (eseguita in un processo separato).
+
+    Un blocco di test contiene spesso una sola classe, per cui le metriche sono calcolate
+    sulle predizioni di tutti i fold insieme invece che come media per fold.
+    """
+    kind, param, window, X, y, groups, folds = args
+    y_pred = np.empty_like(y)
+    for train, test in GroupKFold(n_splits=folds).split(X, y, groups):
+        train = purge(train, test, window, len(y))
+        X_train, X_test = X[train], X[test]
+        if kind == "logistic":
+            mean, scale = standardize(X_train)
+            X_train, X_test = (X_train - mean) / scale, (X_test - mean) / scale
+        y_pred[test] = make_model(kind, param).fit(X_train, y[train]).predict(X_test)
+    return {
+        "kind": kind, "param": param, "window": window,
+        "accuracy": float(accuracy_score(y, y_pred)),
+        "precision": float(precision_score(y, y_pred, zero_division=0)),
+        "recall": float(recall_score(y, y_pred, zero_division=0)),
+        "f1": float(f1_score(y, y_pred, zero_division=0)),
+    }
+
+
+def export_model(kind, param, window, X, y, feature_names):
+    """Addestra il modello scelto su tutti i dati e lo converte nel formato compatto di occupancy.py."""
+    if kind == "tree":
+        tree = make_model(kind, param).fit(X, y).tree_
+        counts = tree.value[:, 0, :]
+        totals = counts.sum(axis=1)
+        totals[totals == 0] = 1.0
+        return {
+            "type": "tree",
+            "window": window,
+            "features": feature_names,
+            "feature": tree.feature.tolist(),
+            "threshold": tree.threshold.tolist(),
+            "left": tree.children_left.tolist(),
+            "right": tree.children_right.tolist(),
+            "value": (counts[:, 1] / totals).tolist(),
+        }
+
+    mean, scale = standardize(X)
+    model = make_model(kind, param).fit((X - mean) / scale, y)
+    return {
+        "type": "logistic",
+        "window": window,
+        "features": feature_names,
+        "weights": model.coef_[0].tolist(),
+        "bias": float(model.intercept_[0]),
+        "mean": mean.tolist(),
+        "scale": scale.tolist(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the bed occupancy classifier.")
+    parser.add_argument("--data", nargs="+", default=["Evaluation/merged_without_average.csv"],
+                        help="raw recordings (value, sdraiato), one file per recording")
+    parser.add_argument("--out", default="occupancy_model.json")
+    parser.add_argument("--windows", nargs="+", type=int, default=[1, 3, 5, 10])
+    parser.add_argument("--depths", nargs="+", type=int, default=[1, 2, 3, 4, 6])
+    parser.add_argument("--cs", nargs="+", type=float, default=[0.1, 1.0, 10.0])
+    parser.add_argument("--folds", type=int, default=5, help="contiguous blocks per recording")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    timings = {}
+
+    with stage("load", timings):
+        values, labels, offsets = load_csv(args.data)
+    print(f"{len(values)} samples from {len(args.data)} file(s)")
+
+    with stage("features", timings):
+        datasets = {window: build_features(values, offsets, window) for window in args.windows}
+        groups = block_groups(offsets, len(values), args.folds)
+
+    candidates = [("tree", depth) for depth in args.depths] + [("logistic", c) for c in args.cs]
+    jobs = [(kind, param, window, datasets[window], labels, groups, args.folds)
+            for window in args.windows for kind, param in candidates]
+
+    with stage("cross_validation", timings):
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(evaluate, jobs))
+
+    results.sort(key=lambda r: (r["f1"], r["accuracy"], -r["window"]), reverse=True)
+    for r in results[:10]:
+        print(f"{r['kind']:8} param={r['param']:<5} window={r['window']:<3} "
+              f"acc={r['accuracy']:.4f} prec={r['precision']:.4f} rec={r['recall']:.4f} f1={r['f1']:.4f}")
+
+    best = results[0]
+    with stage("export", timings):
+        spec = export_model(best["kind"], best["param"], best["window"], datasets[best["window"]], labels, list(FEATURES))
+        spec["metrics"] = {k: best[k] for k in ("accuracy", "precision", "recall", "f1")}
+        with open(args.out, "w") as file:
+            json.dump(spec, file)
+
+    print(f"Best model: {best['kind']} (param={best['param']}, window={best['window']}) saved to {args.out}")
+    print("Timings: " + ", ".join(f"{name}={t * 1000:.1f}ms" for name, t in timings.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,148 @@
 import os
 import json
 import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
 import requests
 
+log = logging.getLogger(__name__)
+
+
+class AlarmDB:
+    """Archivio delle sveglie su SQLite in modalità WAL.
+
+    Ogni modifica aggiorna una sola riga in una transazione, quindi il costo non
+    dipende dal numero di sveglie e un crash non lascia il file a metà. La
+    connessione è in autocommit (ogni statement è una transazione a sé): le
+    operazioni su più righe usano _transaction().
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS alarms ("
+            " device_id TEXT NOT NULL,"
+            " alarm_id TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " PRIMARY KEY (device_id, alarm_id))"
+        )
+        # Riepilogo degli esiti delle sveglie per dispositivo (vedi outcomes.AlarmOutcomes)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS alarm_outcomes ("
+            " device_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL)"
+        )
+
+    @contextmanager
+    def _transaction(self):
+        ## BEGIN/COMMIT espliciti: con isolation_level=None "with self._conn" non apre transazioni
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    @staticmethod
+    def _key(alarm):
+        return str(alarm.get("device_id", "default")), str(alarm.get("alarm_id"))
+
+    def save(self, alarm):
+        ## Inserisce o aggiorna una singola sveglia
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO alarms (device_id, alarm_id, data) VALUES (?, ?, ?)",
+                (*self._key(alarm), json.dumps(alarm)),
+            )
+
+    def save_many(self, alarms):
+        ## Tutte le sveglie o nessuna (es. la migrazione da alarms.json)
+        rows = [(*self._key(alarm), json.dumps(alarm)) for alarm in alarms]
+        with self._transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO alarms (device_id, alarm_id, data) VALUES (?, ?, ?)", rows)
+
+    def delete(self, device_id, alarm_id):
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM alarms WHERE device_id = ? AND alarm_id = ?", (str(device_id), str(alarm_id))
+            )
+        return cursor.rowcount > 0
+
+    def delete_device(self, device_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM alarms WHERE device_id = ?", (str(device_id),))
+
+    def load_all(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM alarms").fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def save_outcomes(self, device_id, summary):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO alarm_outcomes (device_id, data) VALUES (?, ?)",
+                (str(device_id), json.dumps(summary)),
+            )
+
+    def load_outcomes(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT device_id, data FROM alarm_outcomes").fetchall()
+        return {device_id: json.loads(data) for device_id, data in rows}
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM alarms").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
 def load_alarms_from(alarm_file):
-    ## Carica gli allarmi da un file JSON
-    global alarms
+    ## Carica gli allarmi da un database SQLite (.db) o da un file JSON
+    if alarm_file.endswith(".db"):
+        if not os.path.exists(alarm_file):
+            log.info("alarm file missing, starting with empty alarms", extra={"alarm_file": alarm_file})
+            return []
+        db = AlarmDB(alarm_file)
+        try:
+            alarms = db.load_all()
+        finally:
+            db.close()
+        log.info("alarms loaded", extra={"alarm_file": alarm_file, "alarms": len(alarms)})
+        return alarms
+
     if os.path.exists(alarm_file):
         try:
             with open(alarm_file, 'r') as file:
                 alarms = json.load(file)
-                logging.info(f"Loaded alarms from {alarm_file}.")
+                log.info("alarms loaded", extra={"alarm_file": alarm_file, "alarms": len(alarms)})
         except json.JSONDecodeError:
-            logging.error(f"Failed to parse {alarm_file}. Starting with empty alarms.")
+            log.error("alarm file unreadable, starting with empty alarms", extra={"alarm_file": alarm_file})
             alarms = []
     else:
-        logging.info(f"{alarm_file} does not exist. Starting with empty alarms.")
+        log.info("alarm file missing, starting with empty alarms", extra={"alarm_file": alarm_file})
         alarms = []
     return alarms
 
-def save_alarms_to(alarm_file, alarms):
-    ## Salva gli allarmi in un file JSON
-    try:
-        with open(alarm_file, 'w') as file:
-            json.dump(alarms, file, indent=4)
-            logging.info(f"Alarms saved to {alarm_file}.")
-    except Exception as e:
-        logging.error(f"Failed to save alarms to {alarm_file}: {e}")
-    
-
 # Gestione delle API del meteo
-def get_weather_data(city, WEATHER_API_KEY):
-    """Ottiene la condizione meteo da OpenWeatherMap usando il nome della città."""
-    api_url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={WEATHER_API_KEY}&units=metric"
-    
-    try:
-        response = requests.get(api_url)
-        if response.status_code == 200:
-            payload = response.json()
-            print(f"Weather API Response: {json.dumps(payload, indent=2)}")
-            
-            if "weather" in payload and len(payload["weather"]) > 0:
-                return payload["weather"][0]["main"]
-    except requests.RequestException as e:
-        print(f"Error fetching weather data: {e}")
-    
-    return "Clear"  
+WEATHER_API_URL = "http://api.openweathermap.org/data/2.5/weather"
+
+def fetch_weather_condition(city, WEATHER_API_KEY, session=None, timeout=(2, 5), api_url=WEATHER_API_URL):
+    """Ottiene la condizione meteo da OpenWeatherMap; solleva un'eccezione in caso di errore."""
+    http = session or requests
+    response = http.get(api_url, params={"q": city, "appid": WEATHER_API_KEY, "units": "metric"}, timeout=timeout)
+    response.raise_for_status()
+    payload = response.json()
+    log.debug("weather api response", extra={"payload": payload})
+
+    if "weather" in payload and len(payload["weather"]) > 0:
+        return payload["weather"][0]["main"]
+    raise ValueError(f"Unexpected weather payload for {city}")
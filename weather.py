@@ -0,0 +1,116 @@
+import threading
+import time
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from utils import fetch_weather_condition, WEATHER_API_URL
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CONDITION = "Clear"
+
+# Suono della sveglia in base alla condizione meteo
+SOUND_MAPPING = {
+    "Clear": 1,  # Soleggiato = Energico
+    "Clouds": 2,  # Nuvoloso = Medio
+    "Mist": 2,  # Nebbia = Medio
+    "Rain": 3,  # Pioggia = Rilassante
+    "Drizzle": 3,  # Piovigginoso = Rilassante
+    "Snow": 3,  # Neve = Rilassante
+    "Thunderstorm": 4  # Temporale = Allerta
+}
+
+
+def weather_sound(condition):
+    return SOUND_MAPPING.get(condition, 1)
+
+
+class WeatherCache:
+    """Cache delle condizioni meteo per location, con TTL configurabile.
+
+    Le richieste concorrenti per la stessa location vengono unite in un'unica
+    chiamata HTTP (le altre attendono il risultato). Se l'API fallisce viene
+    restituito l'ultimo valore noto, anche se scaduto.
+    """
+
+    def __init__(self, api_key, ttl=600.0, timeout=(2, 5), api_url=WEATHER_API_URL, pool_size=10, retry_after=60.0):
+        self.api_key = api_key
+        self.ttl = ttl
+        self.retry_after = min(retry_after, ttl)
+        self.timeout = timeout
+        self.api_url = api_url
+
+        # Sessione HTTP condivisa con connessioni persistenti
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._entries = {}    # location -> (condition, fetched_at)
+        self._inflight = {}   # location -> threading.Event
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "stale": 0, "errors": 0}
+
+    @staticmethod
+    def _key(location):
+        return location.strip().lower()
+
+    def get(self, location, stale_ok=False):
+        """Restituisce la condizione meteo (es. "Clear", "Rain") per la location.
+
+        Con stale_ok=True un valore già in cache viene restituito anche se scaduto,
+        senza chiamate di rete.
+        """
+        key = self._key(location)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and (stale_ok or time.monotonic() - entry[1] < self.ttl):
+                self.stats["hits"] += 1
+                return entry[0]
+
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                inflight = self._inflight[key] = threading.Event()
+                self.stats["misses"] += 1
+                leader = True
+            else:
+                self.stats["coalesced"] += 1
+                leader = False
+
+        if not leader:
+            inflight.wait(sum(self.timeout) if isinstance(self.timeout, tuple) else self.timeout)
+            entry = self._entries.get(key)
+            return entry[0] if entry else DEFAULT_CONDITION
+
+        try:
+            return self._refresh(key, location, entry)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            inflight.set()
+
+    def _refresh(self, key, location, entry):
+        # Un payload inatteso (es. "weather" vuoto o senza "main") conta come un errore dell'API
+        try:
+            condition = fetch_weather_condition(location, self.api_key, self.session, self.timeout, self.api_url)
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            with self._lock:
+                self.stats["errors"] += 1
+                if entry:
+                    self.stats["stale"] += 1
+                    # Il valore scaduto resta valido ancora per retry_after secondi
+                    self._entries[key] = (entry[0], time.monotonic() - self.ttl + self.retry_after)
+            log.warning("weather fetch failed", extra={"location": location, "error": str(e)})
+            return entry[0] if entry else DEFAULT_CONDITION
+
+        with self._lock:
+            self._entries[key] = (condition, time.monotonic())
+        return condition
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["locations"] = len(self._entries)
+        stats["ttl_s"] = self.ttl
+        return stats